@@ -1,10 +1,13 @@
 import os
 import json
+import logging
 import random
 import re
+import tempfile
+import time
 import uuid
+from functools import partial, wraps
 from datetime import datetime
-from collections import defaultdict
 from threading import Lock
 
 from flask import (
@@ -17,46 +20,265 @@ from flask import (
     flash,
     jsonify,
 )
+import click
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_bcrypt import Bcrypt
 from werkzeug.utils import secure_filename
 
-from sqlalchemy import func, or_, and_
+from sqlalchemy import case, func, or_, and_
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+from models import (
+    db,
+    User,
+    Message,
+    Group,
+    GroupMember,
+    GroupMessage,
+    GroupRead,
+    ConversationSummary,
+    UnreadCounter,
+    ModerationFlag,
+    DeliveryWatermark,
+)
+from db_engine import (
+    bench_engine,
+    benchmark_engine,
+    configure_database,
+    engine_options,
+    install_engine_hooks,
+)
+from migrations import explain_hot_queries, run_migrations, rebuild_unread_counters
+from write_batcher import WriteBatcher, benchmark_write_batching
+from cache_invalidation import invalidation_bus_from_env
+from membership_cache import MembershipCache, invalidate_on_commit
+from profile_cache import ProfileCache
+from presence_store import (
+    MemoryPresenceStore,
+    RedisPresenceStore,
+    check_presence_store,
+    presence_store_from_env,
+)
+from presence_broadcast import PresenceBroadcaster, simulate_login_storm
+from typing_coalescer import TypingCoalescer
+from read_receipts import ReceiptCoalescer
+from group_receipts import GroupReadIndex
+from backpressure import backpressure_client_manager, benchmark_group_fanout
+from rate_limit import rate_limiter_from_env, retry_after_header
+from wire_format import (
+    benchmark_wire_formats,
+    negotiate_wire_format,
+    sample_message_payloads,
+)
+from event_log import (
+    EventRing,
+    event_log_head,
+    load_events_since,
+    prune_event_log,
+    record_event,
+)
+from async_runtime import ASYNC_MODE, run_blocking
+from connection_bench import run_connection_bench
+from profanity import (
+    MODERATION_ACTIONS,
+    MODERATION_BUDGET_US,
+    MODERATION_TARGET_RATE,
+    ProfanityMatcher,
+    benchmark_moderation,
+    benchmark_usernames,
+)
+from archive import (
+    MessageArchive,
+    archive_old_messages,
+    group_conversation_key,
+    private_conversation_key,
+    record_to_message,
+)
+from search import (
+    SEARCH_PAGE_MAX,
+    SEARCH_PAGE_SIZE,
+    benchmark_search,
+    index_message,
+    rebuild_search_index,
+    render_highlight,
+    search_available,
+    search_messages,
+    seed_search_benchmark,
+    unindex_message,
+)
+from chat_payload import (
+    FILE_KINDS,
+    benchmark_content_fields,
+    message_fields,
+    preview_from_message,
+)
 
-from models import db, User, Message, Group, GroupMember, GroupMessage, GroupRead
+logger = logging.getLogger(__name__)
 
 # ---------------- APP ----------------
 app = Flask(__name__)
 app.secret_key = "chave_super_secreta"
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-DB_PATH = os.path.join(BASE_DIR, "database.db")
 
-app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DB_PATH}"
+configure_database(app, BASE_DIR)
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
 db.init_app(app)
 
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading")
+# Com vários workers/hosts, SOCKETIO_MESSAGE_QUEUE (ex.: redis://...) faz os
+# emits de um worker chegarem aos sockets conectados nos outros. O
+# gerenciador limita a fila de saída de cada socket (ver backpressure.py).
+socket_manager = backpressure_client_manager(
+    os.environ.get("SOCKETIO_MESSAGE_QUEUE") or None,
+    channel=os.environ.get("SOCKETIO_CHANNEL", "flask-socketio"),
+)
+socket_manager.configure_backpressure(
+    soft_limit=int(os.environ.get("OUTBOUND_SOFT_LIMIT", "200")),
+    hard_limit=int(os.environ.get("OUTBOUND_HARD_LIMIT", "1000")),
+    hwm_seconds=int(os.environ.get("OUTBOUND_HWM_SECONDS", "10")),
+)
+socketio = SocketIO(
+    app,
+    cors_allowed_origins="*",
+    async_mode=ASYNC_MODE,
+    client_manager=socket_manager,
+)
 bcrypt = Bcrypt(app)
 
-# ---------------- PRESENCE ----------------
-online_users = set()
-sid_to_user = {}
-user_to_sids = defaultdict(set)
-presence_lock = Lock()
+# ---------------- PRESENCE / CALLS ----------------
+# Sids online e participantes das chamadas em grupo. Em memória por padrão;
+# PRESENCE_STORE_URL=redis://... compartilha entre workers.
+presence = presence_store_from_env()
+
+# ---------------- TYPING ----------------
+# `typing` repassado no máximo uma vez por intervalo por (usuário, conversa);
+# stop_typing espera TYPING_STOP_GRACE_MS (pausas curtas não viram stop +
+# typing) e sem eventos por TYPING_TIMEOUT_MS o servidor manda o stop sozinho.
+typing_coalescer = TypingCoalescer(
+    interval=int(os.environ.get("TYPING_RELAY_INTERVAL_MS", "5000")) / 1000,
+    timeout=int(os.environ.get("TYPING_TIMEOUT_MS", "6000")) / 1000,
+    stop_grace=int(os.environ.get("TYPING_STOP_GRACE_MS", "1500")) / 1000,
+)
+
+# ---------------- RECEIPTS ----------------
+# mark_as_read (e acks de entrega) da mesma conversa dentro de
+# READ_RECEIPT_WINDOW_MS viram um UPDATE só e um recibo só, com o maior id
+# (0 = sem janela).
+RECEIPT_WINDOW_SECONDS = int(os.environ.get("READ_RECEIPT_WINDOW_MS", "250")) / 1000
+read_receipts = ReceiptCoalescer(window=RECEIPT_WINDOW_SECONDS)
+delivery_receipts = ReceiptCoalescer(window=RECEIPT_WINDOW_SECONDS)
+
+# ---------------- RATE LIMIT ----------------
+# Token bucket por (usuário, evento); limites em rate_limit.DEFAULT_LIMITS,
+# ajustáveis com RATE_LIMITS. RATE_LIMIT_URL=redis://... compartilha.
+rate_limiter = rate_limiter_from_env()
+
+
+def rate_limited(event, on_reject=None):
+    """
+    Limita um handler Socket.IO. A rejeição não toca no banco: no máximo
+    chama `on_reject(data, retry_after)` para avisar o cliente.
+    """
+
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(data=None, *args):
+            key = session.get("user_id") or request.sid
+            allowed, retry_after = rate_limiter.hit(key, event)
+            if not allowed:
+                if on_reject is not None:
+                    on_reject(data if isinstance(data, dict) else {}, retry_after)
+                return None
+            return handler(data, *args)
+
+        return wrapper
+
+    return decorator
+
+
+def receipt_admitted(event):
+    """Ficha para um recibo novo; chamado pelo ReceiptCoalescer depois do merge."""
+    allowed, _ = rate_limiter.hit(session.get("user_id") or request.sid, event)
+    return allowed
+
+
+def reject_rate_limited_message(data, retry_after):
+    emit(
+        "message_rejected",
+        {
+            "temp_id": data.get("temp_id"),
+            "message_id": data.get("message_id"),
+            "reason": "rate_limited",
+            "retry_after": round(retry_after, 1),
+        },
+    )
+
+
+# ---------------- BACKGROUND ----------------
+background_tasks = set()
+background_lock = Lock()
 
-# ---------------- CALLS ----------------
-active_group_calls = defaultdict(set)
-group_call_lock = Lock()
+
+def start_background_once(task):
+    """Inicia `task` na primeira chamada (nunca no import: CLI não precisa)."""
+    if task in background_tasks:
+        return
+    with background_lock:
+        if task not in background_tasks:
+            socketio.start_background_task(task)
+            background_tasks.add(task)
+
+
+# ---------------- WRITE BATCHING ----------------
+# Com MESSAGE_BATCH_WRITES=1 o send_message faz group commit: mensagens que
+# chegam dentro da janela vão para o banco numa transação só.
+message_batcher = None
+if os.environ.get("MESSAGE_BATCH_WRITES") == "1":
+    message_batcher = WriteBatcher(
+        app,
+        db,
+        window_ms=int(os.environ.get("MESSAGE_BATCH_WINDOW_MS", "5")),
+        max_batch=int(os.environ.get("MESSAGE_BATCH_MAX", "200")),
+        start_task=socketio.start_background_task,
+    )
 
 with app.app_context():
+    install_engine_hooks(db.engine)
     db.create_all()
+    run_migrations()
+    SEARCH_ENABLED = search_available(db.engine)
+    startup_event_seq = event_log_head()
+
+# ---------------- EVENT LOG ----------------
+# Eventos com seq para o replay na reconexão (ver event_log.py). O anel em
+# memória só vale com um worker: com fila de mensagens, outros processos
+# também gravam no log e o replay vai sempre ao banco.
+EVENT_REPLAY_MAX = int(os.environ.get("EVENT_REPLAY_MAX", "500"))
+event_ring = None
+if not os.environ.get("SOCKETIO_MESSAGE_QUEUE"):
+    event_ring = EventRing(
+        size=int(os.environ.get("EVENT_LOG_RING", "5000")),
+        floor=startup_event_seq,
+    )
+
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Aplica as migrações de schema pendentes no banco configurado."""
+    applied = run_migrations(log=print)
+    if not applied:
+        print("Banco já está na versão mais recente.")
 
 # ---------------- UPLOADS ----------------
 UPLOAD_FOLDER = os.path.join(BASE_DIR, "static", "uploads")
 CHAT_UPLOAD_FOLDER = os.path.join(BASE_DIR, "static", "chat_uploads")
+MESSAGE_ARCHIVE_DIR = os.environ.get("MESSAGE_ARCHIVE_DIR") or os.path.join(BASE_DIR, "archive")
+
+message_archive = MessageArchive(MESSAGE_ARCHIVE_DIR)
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(CHAT_UPLOAD_FOLDER, exist_ok=True)
@@ -86,7 +308,8 @@ ALLOWED_CHAT_FILE_EXTENSIONS = {
     "m4a",
 }
 
-CHAT_JSON_PREFIX = "__CHATJSON__::"
+MESSAGE_PAGE_SIZE = 50
+MESSAGE_PAGE_MAX = 200
 
 
 # ---------------- HELPERS ----------------
@@ -105,121 +328,167 @@ def group_room_name(group_id):
     return f"group_call_{int(group_id)}"
 
 
-def user_is_online(user_id: int) -> bool:
-    with presence_lock:
-        return int(user_id) in online_users
+def group_chat_room(group_id):
+    return f"group_{int(group_id)}"
 
 
-def load_prohibited_words():
-    whitelist_path = os.path.join(BASE_DIR, "whitelist.txt")
-    if os.path.exists(whitelist_path):
-        with open(whitelist_path, "r", encoding="utf-8") as f:
-            return [linha.strip().lower() for linha in f if linha.strip()]
-    return []
+def user_sids(user_id):
+    return presence.sids_of(user_id)
 
 
-def username_filter_with_whitelist(username: str) -> str:
-    palavras_proibidas = load_prohibited_words()
-
-    substituicoes = {
-        "a": "[a@4ÀÁÂÃÄÅàáâãäå]",
-        "e": "[e3ÈÉÊËèéêë]",
-        "i": "[i1!ÌÍÎÏìíîï]",
-        "o": "[o0ÒÓÔÕÖòóôõö]",
-        "u": "[uùúûüÙÚÛÜ]",
-        "c": "[cçÇ]",
-        "s": "[s5$]",
-        "t": "[t7+]",
-        "b": "[b8]",
-        "g": "[g9]",
-        "z": "[z2]",
-    }
+def load_user_group_ids(user_id):
+    rows = (
+        db.session.query(GroupMember.group_id)
+        .filter(GroupMember.user_id == int(user_id))
+        .all()
+    )
+    return [int(r.group_id) for r in rows]
+
+
+def load_presence_audiences(user_ids):
+    """
+    Quem vê a presença de cada usuário: as pessoas com quem ele tem conversa
+    privada e os membros dos grupos dele.
+    """
+    user_ids = [int(uid) for uid in user_ids]
+    audiences = {uid: set() for uid in user_ids}
+    if not user_ids:
+        return audiences
+
+    peers = db.session.query(ConversationSummary.user_id, ConversationSummary.target_id).filter(
+        ConversationSummary.conversation_type == "user",
+        ConversationSummary.user_id.in_(user_ids),
+    )
+    for uid, peer_id in peers:
+        audiences[int(uid)].add(int(peer_id))
 
-    def gerar_regex(palavra: str):
-        regex = ""
-        for char in palavra:
-            regex += substituicoes.get(char.lower(), re.escape(char.lower()))
-        return re.compile(regex, re.IGNORECASE)
+    mine = aliased(GroupMember)
+    fellows = aliased(GroupMember)
+    rows = (
+        db.session.query(mine.user_id, fellows.user_id)
+        .join(fellows, fellows.group_id == mine.group_id)
+        .filter(mine.user_id.in_(user_ids))
+        .distinct()
+    )
+    for uid, fellow_id in rows:
+        audiences[int(uid)].add(int(fellow_id))
 
-    padroes = [gerar_regex(p) for p in palavras_proibidas if len(p) > 2]
-    nome_limpo = (username or "").lower()
+    for uid in user_ids:
+        audiences[uid].discard(uid)
+    return audiences
 
-    contem_proibida = any(p.search(nome_limpo) for p in padroes)
-    if contem_proibida:
-        return f"Usuário {random.randint(100, 999)}"
 
-    return username
+def online_contacts(user_id):
+    contacts = load_presence_audiences([user_id])[int(user_id)]
+    return sorted(presence.online_among(contacts))
 
 
-def serialize_message_payload(
-    kind="text",
-    text="",
-    file_url=None,
-    file_name=None,
-    file_mime=None,
-    edited=False,
-    deleted=False,
-):
-    payload = {
-        "kind": kind or "text",
-        "text": text or "",
-        "file_url": file_url,
-        "file_name": file_name,
-        "file_mime": file_mime,
-        "edited": bool(edited),
-        "deleted": bool(deleted),
-    }
-    return CHAT_JSON_PREFIX + json.dumps(payload, ensure_ascii=False)
-
-
-def deserialize_message_payload(raw_text: str):
-    if not raw_text:
-        return {
-            "kind": "text",
-            "text": "",
-            "file_url": None,
-            "file_name": None,
-            "file_mime": None,
-            "edited": False,
-            "deleted": False,
-            "is_image": False,
-            "is_audio": False,
-        }
+# ---------------- PRESENCE BROADCAST ----------------
+# Entradas/saídas viram um frame "presence_diff" por destinatário a cada
+# PRESENCE_FLUSH_MS, só para os contatos; saídas esperam
+# PRESENCE_OFFLINE_GRACE_MS para absorver reconexões.
+presence_broadcaster = PresenceBroadcaster(
+    load_presence_audiences,
+    settle=lambda uid: presence.settle_announcement(uid),
+    online_among=lambda ids: presence.online_among(ids),
+    send=lambda recipient, frame: socketio.emit("presence_diff", frame, room=str(recipient)),
+    grace=int(os.environ.get("PRESENCE_OFFLINE_GRACE_MS", "5000")) / 1000,
+)
+PRESENCE_FLUSH_SECONDS = int(os.environ.get("PRESENCE_FLUSH_MS", "1000")) / 1000
+
+
+def enter_group_rooms(sids, group_ids):
+    """Coloca os sockets nas salas de chat dos grupos (um emit por evento de grupo)."""
+    for sid in sids:
+        for group_id in group_ids:
+            # com fila de mensagens, sids de outro worker são repassados a ele
+            try:
+                socketio.server.enter_room(sid, group_chat_room(group_id), namespace="/")
+            except (KeyError, ValueError):
+                pass  # socket desconectou nesse meio-tempo
+
+
+def emit_to_group(event, payload, group_id, skip_user_id=None):
+    """
+    Um único emit para a sala do grupo: o pacote é serializado uma vez e o
+    servidor repassa a cada socket. `skip_user_id` tira todas as abas desse
+    usuário (o remetente), como o laço por membro fazia.
+    """
+    skip_sid = user_sids(skip_user_id) if skip_user_id is not None else None
+    socketio.emit(event, payload, room=group_chat_room(group_id), skip_sid=skip_sid)
+
+
+def emit_logged(logged):
+    """Emite, depois do commit, um evento gravado com record_event."""
+    if event_ring is not None:
+        event_ring.append(logged)
+    if logged.group_id is not None:
+        emit_to_group(logged.event, logged.payload, logged.group_id, skip_user_id=logged.exclude_user_id)
+    else:
+        socketio.emit(logged.event, logged.payload, room=str(logged.user_id))
 
-    if isinstance(raw_text, str) and raw_text.startswith(CHAT_JSON_PREFIX):
-        try:
-            payload = json.loads(raw_text[len(CHAT_JSON_PREFIX):])
-            mime = payload.get("file_mime") or ""
-            kind = payload.get("kind") or "text"
-            is_image = kind == "image" or str(mime).startswith("image/")
-            is_audio = kind == "audio" or str(mime).startswith("audio/")
-            return {
-                "kind": kind,
-                "text": payload.get("text") or "",
-                "file_url": payload.get("file_url"),
-                "file_name": payload.get("file_name"),
-                "file_mime": payload.get("file_mime"),
-                "edited": bool(payload.get("edited")),
-                "deleted": bool(payload.get("deleted")),
-                "is_image": is_image,
-                "is_audio": is_audio,
-            }
-        except Exception:
-            pass
+
+def resume_payload(user_id, group_ids, last_seq):
+    """
+    Resposta do `join`: os eventos depois de `last_seq` ou, se o log já não
+    cobre (ou são eventos demais), {"resync": true} para recarregar tudo.
+    """
+    head = event_ring.head() if event_ring is not None else event_log_head()
+    try:
+        last_seq = int(last_seq)
+    except (TypeError, ValueError):
+        return {"seq": head, "events": []}
+
+    if last_seq > head:
+        return {"seq": head, "resync": True}
+
+    group_ids = set(group_ids)
+    found = None
+    if event_ring is not None:
+        found = event_ring.since(last_seq, user_id, group_ids, EVENT_REPLAY_MAX)
+    if found is None:
+        found = load_events_since(user_id, group_ids, last_seq, EVENT_REPLAY_MAX)
+    if found is None or len(found) > EVENT_REPLAY_MAX:
+        return {"seq": head, "resync": True}
 
     return {
-        "kind": "text",
-        "text": raw_text,
-        "file_url": None,
-        "file_name": None,
-        "file_mime": None,
-        "edited": False,
-        "deleted": False,
-        "is_image": False,
-        "is_audio": False,
+        "seq": max([head] + [e.seq for e in found]),
+        "events": [{"event": e.event, "data": e.payload} for e in found],
     }
 
 
+profanity_matcher = ProfanityMatcher(os.path.join(BASE_DIR, "whitelist.txt"))
+
+# Moderação do texto das mensagens: off | mask | reject | flag
+MESSAGE_MODERATION = os.environ.get("MESSAGE_MODERATION", "off").strip().lower()
+if MESSAGE_MODERATION not in MODERATION_ACTIONS:
+    MESSAGE_MODERATION = "off"
+
+
+def moderate_message_text(text):
+    return profanity_matcher.moderate(text, MESSAGE_MODERATION)
+
+
+def record_moderation_flag(conversation_type, message, words):
+    if not words:
+        return
+    db.session.add(
+        ModerationFlag(
+            conversation_type=conversation_type,
+            message_id=int(message.id),
+            sender_id=int(message.sender_id),
+            words=", ".join(words)[:255],
+        )
+    )
+
+
+def username_filter_with_whitelist(username: str) -> str:
+    if profanity_matcher.contains(username or ""):
+        return f"Usuário {random.randint(100, 999)}"
+
+    return username
+
+
 def serialize_group(group: Group):
     members = (
         db.session.query(GroupMember.user_id)
@@ -262,6 +531,75 @@ def user_groups(user_id):
     return [serialize_group(g) for g in groups]
 
 
+def load_group_member_ids(group_id):
+    rows = (
+        db.session.query(GroupMember.user_id)
+        .filter(GroupMember.group_id == int(group_id))
+        .all()
+    )
+    return [int(r.user_id) for r in rows]
+
+
+# ---------------- CACHE INVALIDATION ----------------
+# Invalidações dos caches em memória; CACHE_INVALIDATION_URL=redis://...
+# repassa para os outros workers.
+cache_bus = invalidation_bus_from_env()
+
+
+def cache_invalidation_loop():
+    cache_bus.listen(sleep=socketio.sleep)
+
+
+@app.before_request
+def start_cache_invalidation():
+    # o join do Socket.IO também inicia; aqui cobre workers só de HTTP
+    if cache_bus.shared:
+        start_background_once(cache_invalidation_loop)
+
+
+# ---------------- MEMBERSHIP CACHE ----------------
+membership_cache = MembershipCache(
+    load_group_member_ids,
+    max_groups=int(os.environ.get("MEMBERSHIP_CACHE_GROUPS", "1024")),
+    ttl_seconds=int(os.environ.get("MEMBERSHIP_CACHE_TTL", "60")),
+)
+cache_bus.register("membership", membership_cache.invalidate, membership_cache.clear)
+invalidate_on_commit(
+    lambda group_id: cache_bus.publish("membership", group_id), db.session, GroupMember
+)
+
+
+def load_user_profiles(user_ids):
+    rows = (
+        db.session.query(User.id, User.username, User.display_name, User.avatar_url)
+        .filter(User.id.in_(list(user_ids)))
+        .all()
+    )
+    return {
+        int(r.id): {
+            "username": r.username,
+            "display_name": r.display_name,
+            "avatar_url": r.avatar_url,
+        }
+        for r in rows
+    }
+
+
+# ---------------- PROFILE CACHE ----------------
+profile_cache = ProfileCache(
+    load_user_profiles,
+    max_users=int(os.environ.get("PROFILE_CACHE_USERS", "10000")),
+    ttl_seconds=int(os.environ.get("PROFILE_CACHE_TTL", "300")),
+)
+cache_bus.register("profile", profile_cache.invalidate, profile_cache.clear)
+
+
+def profile_display_name(profile):
+    if not profile:
+        return "Usuário"
+    return profile["display_name"] or profile["username"] or "Usuário"
+
+
 def user_in_group(user_id, group_id):
     try:
         user_id = int(user_id)
@@ -269,10 +607,7 @@ def user_in_group(user_id, group_id):
     except Exception:
         return False
 
-    return (
-        GroupMember.query.filter_by(user_id=user_id, group_id=group_id).first()
-        is not None
-    )
+    return membership_cache.contains(group_id, user_id)
 
 
 def get_group_members(group_id):
@@ -281,13 +616,7 @@ def get_group_members(group_id):
     except Exception:
         return []
 
-    rows = (
-        db.session.query(GroupMember.user_id)
-        .filter(GroupMember.group_id == group_id)
-        .order_by(GroupMember.user_id.asc())
-        .all()
-    )
-    return [int(r.user_id) for r in rows]
+    return sorted(membership_cache.members(group_id))
 
 
 def get_or_create_group_read(group_id: int, user_id: int):
@@ -303,13 +632,14 @@ def get_or_create_group_read(group_id: int, user_id: int):
     return group_read
 
 
-def build_private_message_response(message, viewer_id: int, target_id=None):
-    payload = deserialize_message_payload(message.text)
+def build_private_message_response(message, viewer_id: int, target_id=None, delivered_up_to=0):
+    """`delivered_up_to`: marca de entrega do destinatário para o remetente."""
+    payload = message_fields(message)
 
     status = "sent"
     if bool(message.seen):
         status = "read"
-    elif int(message.sender_id) == int(viewer_id) and user_is_online(int(message.receiver_id)):
+    elif int(message.sender_id) == int(viewer_id) and int(message.id) <= delivered_up_to:
         status = "delivered"
 
     return {
@@ -333,10 +663,37 @@ def build_private_message_response(message, viewer_id: int, target_id=None):
     }
 
 
-def build_group_message_response(message, viewer_id: int, target_id=None):
-    payload = deserialize_message_payload(message.text)
+def load_delivered_up_to(receiver_id, sender_id):
+    watermark = (
+        db.session.query(DeliveryWatermark.delivered_message_id)
+        .filter(
+            DeliveryWatermark.receiver_id == int(receiver_id),
+            DeliveryWatermark.sender_id == int(sender_id),
+        )
+        .scalar()
+    )
+    return int(watermark or 0)
 
-    return {
+
+def load_group_read_index(group_id):
+    """Marcas de leitura de todos os membros atuais numa consulta só."""
+    rows = (
+        db.session.query(GroupMember.user_id, GroupRead.last_read_message_id)
+        .outerjoin(
+            GroupRead,
+            and_(GroupRead.group_id == GroupMember.group_id, GroupRead.user_id == GroupMember.user_id),
+        )
+        .filter(GroupMember.group_id == int(group_id))
+        .all()
+    )
+    return GroupReadIndex(rows)
+
+
+def build_group_message_response(message, viewer_id: int, target_id=None, read_index=None):
+    """Com `read_index`, as mensagens do próprio viewer trazem "lida por N de M"."""
+    payload = message_fields(message)
+
+    response = {
         "id": int(message.id),
         "sender_id": int(message.sender_id),
         "receiver_id": -int(message.group_id),
@@ -347,7 +704,7 @@ def build_group_message_response(message, viewer_id: int, target_id=None):
         "kind": payload["kind"],
         "edited": payload["edited"],
         "deleted": payload["deleted"],
-        "file_url": payload["file_url"] or message.file_url,
+        "file_url": payload["file_url"],
         "file_name": payload["file_name"],
         "file_mime": payload["file_mime"],
         "is_image": payload["is_image"],
@@ -356,18 +713,228 @@ def build_group_message_response(message, viewer_id: int, target_id=None):
         "target_id": target_id,
     }
 
+    sender_id = int(message.sender_id)
+    if read_index is not None and sender_id == int(viewer_id):
+        read_count = read_index.read_count(int(message.id), sender_id)
+        read_total = read_index.read_total(sender_id)
+        response["read_count"] = read_count
+        response["read_total"] = read_total
+        if read_total and read_count >= read_total:
+            response["seen"] = True
+            response["status"] = "read"
+    return response
+
+
+def dialect_insert(table):
+    """INSERT com suporte a ON CONFLICT para o banco em uso."""
+    if db.session.get_bind().dialect.name == "postgresql":
+        return postgresql_insert(table)
+    return sqlite_insert(table)
+
+
+def upsert_conversation_summary(conversation_type, target_id, message, user_id=None):
+    """
+    Aponta o resumo da conversa para `message` dentro da transação atual.
+    Só avança: um envio concorrente com id menor nunca sobrescreve o último.
+    """
+    table = ConversationSummary.__table__
+
+    stmt = dialect_insert(table).values(
+        conversation_type=conversation_type,
+        user_id=user_id,
+        target_id=int(target_id),
+        last_message_id=int(message.id),
+        last_text=preview_from_message(message),
+        last_at=message.created_at or datetime.utcnow(),
+    )
+
+    if user_id is None:
+        conflict = {
+            "index_elements": [table.c.target_id],
+            "index_where": table.c.conversation_type == "group",
+        }
+    else:
+        conflict = {
+            "index_elements": [table.c.user_id, table.c.conversation_type, table.c.target_id],
+        }
+
+    stmt = stmt.on_conflict_do_update(
+        **conflict,
+        set_={
+            "last_message_id": stmt.excluded.last_message_id,
+            "last_text": stmt.excluded.last_text,
+            "last_at": stmt.excluded.last_at,
+        },
+        where=table.c.last_message_id < stmt.excluded.last_message_id,
+    )
+    db.session.execute(stmt)
+
+
+def record_private_summary(message):
+    sender_id = int(message.sender_id)
+    receiver_id = int(message.receiver_id)
+    upsert_conversation_summary("user", receiver_id, message, user_id=sender_id)
+    if receiver_id != sender_id:
+        upsert_conversation_summary("user", sender_id, message, user_id=receiver_id)
 
-def preview_from_text(raw_text: str):
-    payload = deserialize_message_payload(raw_text)
-    if payload["deleted"]:
-        return "Mensagem apagada"
-    if payload["is_audio"]:
-        return "🎵 Áudio"
-    if payload["is_image"]:
-        return "📷 Imagem"
-    if payload["kind"] == "file":
-        return f"📎 {payload['file_name'] or 'Arquivo'}"
-    return payload["text"] or ""
+
+def record_group_summary(message):
+    upsert_conversation_summary("group", int(message.group_id), message)
+
+
+def refresh_summary_preview(conversation_type, message):
+    """Atualiza a prévia quando a última mensagem da conversa é editada/apagada."""
+    ConversationSummary.query.filter(
+        ConversationSummary.conversation_type == conversation_type,
+        ConversationSummary.last_message_id == int(message.id),
+    ).update(
+        {"last_text": preview_from_message(message)},
+        synchronize_session=False,
+    )
+
+
+def bump_unread_counters(stmt):
+    """Aplica +1 nos contadores inseridos por `stmt` (INSERT ... ON CONFLICT)."""
+    table = UnreadCounter.__table__
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.conversation_type, table.c.target_id],
+        set_={"unread_count": table.c.unread_count + 1},
+    )
+    db.session.execute(stmt)
+
+
+def bump_private_unread(message):
+    bump_unread_counters(
+        dialect_insert(UnreadCounter.__table__).values(
+            user_id=int(message.receiver_id),
+            conversation_type="user",
+            target_id=int(message.sender_id),
+            unread_count=1,
+        )
+    )
+
+
+def bump_group_unread(message):
+    bump_unread_counters(
+        dialect_insert(UnreadCounter.__table__).from_select(
+            ["user_id", "conversation_type", "target_id", "unread_count"],
+            db.select(
+                GroupMember.user_id,
+                db.literal("group"),
+                GroupMember.group_id,
+                db.literal(1),
+            ).where(
+                GroupMember.group_id == int(message.group_id),
+                GroupMember.user_id != int(message.sender_id),
+            ),
+        )
+    )
+
+
+def reset_unread(user_id, conversation_type, target_id):
+    UnreadCounter.query.filter_by(
+        user_id=int(user_id),
+        conversation_type=conversation_type,
+        target_id=int(target_id),
+    ).update({"unread_count": 0}, synchronize_session=False)
+
+
+def set_unread(user_id, conversation_type, target_id, count):
+    UnreadCounter.query.filter_by(
+        user_id=int(user_id),
+        conversation_type=conversation_type,
+        target_id=int(target_id),
+    ).update({"unread_count": int(count)}, synchronize_session=False)
+
+
+def discount_unread(user_id, conversation_type, target_id, amount):
+    """Tira `amount` do contador (leitura parcial), sem passar de zero."""
+    if amount <= 0:
+        return
+    UnreadCounter.query.filter_by(
+        user_id=int(user_id),
+        conversation_type=conversation_type,
+        target_id=int(target_id),
+    ).update(
+        {
+            "unread_count": case(
+                (UnreadCounter.unread_count > amount, UnreadCounter.unread_count - amount),
+                else_=0,
+            )
+        },
+        synchronize_session=False,
+    )
+
+
+def sync_search_index(conversation_type, message):
+    if SEARCH_ENABLED:
+        index_message(db.session, conversation_type, message)
+
+
+def parse_history_cursor(args):
+    """Lê before_id/after_id/limit da query string do histórico."""
+
+    def as_positive_int(value):
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            return None
+        return value if value > 0 else None
+
+    limit = as_positive_int(args.get("limit")) or MESSAGE_PAGE_SIZE
+    return (
+        as_positive_int(args.get("before_id")),
+        as_positive_int(args.get("after_id")),
+        min(limit, MESSAGE_PAGE_MAX),
+    )
+
+
+def fetch_history_page(query, id_column, before_id=None, after_id=None, limit=MESSAGE_PAGE_SIZE):
+    """
+    Paginação por keyset sobre o id da mensagem.
+
+    Sem cursor devolve as `limit` mensagens mais recentes; com `before_id`
+    as anteriores a ele; com `after_id` as posteriores. A lista volta sempre
+    em ordem crescente, junto com o cursor para a próxima página mais antiga.
+    """
+    if after_id is not None:
+        rows = (
+            query.filter(id_column > after_id)
+            .order_by(id_column.asc())
+            .limit(limit + 1)
+            .all()
+        )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_after_id = int(rows[-1].id) if rows and has_more else None
+        return rows, {"has_more": has_more, "next_after_id": next_after_id}
+
+    if before_id is not None:
+        query = query.filter(id_column < before_id)
+
+    rows = query.order_by(id_column.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = list(reversed(rows[:limit]))
+    next_before_id = int(rows[0].id) if rows and has_more else None
+    return rows, {"has_more": has_more, "next_before_id": next_before_id}
+
+
+def continue_into_archive(key, msgs, cursor, before_id, after_id, limit):
+    """
+    Quando a tabela quente acaba antes de encher a página, completa com as
+    mensagens mais antigas do arquivo frio da conversa.
+    """
+    if after_id is not None or cursor["has_more"]:
+        return msgs, cursor
+
+    oldest = int(msgs[0].id) if msgs else before_id
+    older, has_more = run_blocking(message_archive.read_before, key, oldest, limit - len(msgs))
+    msgs = [record_to_message(r) for r in older] + list(msgs)
+
+    return msgs, {
+        "has_more": has_more,
+        "next_before_id": int(msgs[0].id) if msgs and has_more else None,
+    }
 
 
 @app.teardown_appcontext
@@ -510,37 +1077,28 @@ def contacts_meta():
         return jsonify({})
 
     my_id = int(session["user_id"])
-    others = User.query.filter(User.id != my_id).all()
-    groups = user_groups(my_id)
-    meta = {}
+    my_groups = db.session.query(GroupMember.group_id).filter(
+        GroupMember.user_id == my_id
+    )
 
-    for u in others:
-        last = (
-            Message.query.filter(
-                or_(
-                    and_(Message.sender_id == my_id, Message.receiver_id == u.id),
-                    and_(Message.sender_id == u.id, Message.receiver_id == my_id),
-                )
-            )
-            .order_by(Message.created_at.desc())
-            .first()
+    rows = ConversationSummary.query.filter(
+        or_(
+            and_(
+                ConversationSummary.conversation_type == "user",
+                ConversationSummary.user_id == my_id,
+            ),
+            and_(
+                ConversationSummary.conversation_type == "group",
+                ConversationSummary.target_id.in_(my_groups),
+            ),
         )
+    ).all()
 
-        meta[f"user_{u.id}"] = {
-            "last_text": preview_from_text(last.text) if last else "",
-            "last_at": (last.created_at.isoformat() if last and last.created_at else None),
-        }
-
-    for g in groups:
-        gid = int(g["id"])
-        last = (
-            GroupMessage.query.filter(GroupMessage.group_id == gid)
-            .order_by(GroupMessage.created_at.desc())
-            .first()
-        )
-        meta[f"group_{gid}"] = {
-            "last_text": preview_from_text(last.text) if last else "",
-            "last_at": (last.created_at.isoformat() if last and last.created_at else None),
+    meta = {}
+    for row in rows:
+        meta[f"{row.conversation_type}_{int(row.target_id)}"] = {
+            "last_text": row.last_text or "",
+            "last_at": row.last_at.isoformat() if row.last_at else None,
         }
 
     return jsonify(meta)
@@ -548,8 +1106,31 @@ def contacts_meta():
 
 @app.route("/online_users")
 def online_users_api():
-    with presence_lock:
-        return jsonify(list(online_users))
+    if "user_id" not in session:
+        return jsonify([])
+    return jsonify(online_contacts(session["user_id"]))
+
+
+@app.route("/server_stats")
+def server_stats():
+    """Contadores em memória deste worker (caches, lote de escrita, digitação)."""
+    if "user_id" not in session:
+        return jsonify({"error": "Não autenticado"}), 401
+
+    return jsonify(
+        {
+            "membership_cache": membership_cache.stats(),
+            "profile_cache": profile_cache.stats(),
+            "write_batcher": dict(message_batcher.stats) if message_batcher else None,
+            "typing": typing_coalescer.stats(),
+            "read_receipts": read_receipts.stats(),
+            "delivery_receipts": delivery_receipts.stats(),
+            "presence": presence_broadcaster.stats(),
+            "outbound": socket_manager.backpressure_stats(),
+            "rate_limit": rate_limiter.stats(),
+            "event_ring": event_ring.stats() if event_ring else None,
+        }
+    )
 
 
 @app.route("/profile", methods=["GET", "POST"])
@@ -580,7 +1161,7 @@ def profile():
             ext = filename.rsplit(".", 1)[1].lower()
             final_name = f"user_{user_id}.{ext}"
             save_path = os.path.join(UPLOAD_FOLDER, final_name)
-            file.save(save_path)
+            run_blocking(file.save, save_path)
             avatar_url = f"/static/uploads/{final_name}"
 
         if display_name:
@@ -591,6 +1172,7 @@ def profile():
             me.avatar_url = avatar_url
 
         db.session.commit()
+        cache_bus.publish("profile", int(user_id))
         flash("Perfil atualizado com sucesso!", "success")
         return redirect(url_for("profile"))
 
@@ -666,15 +1248,19 @@ def create_group():
                 )
             )
 
+        group_payload = serialize_group(group)
+        created = [
+            record_event("group_created", group_payload, user_id=uid)
+            for uid in group_payload["members"]
+        ]
         db.session.commit()
     except IntegrityError:
         db.session.rollback()
         return jsonify({"ok": False, "error": "Não foi possível criar o grupo"}), 400
 
-    group_payload = serialize_group(group)
-
-    for uid in group_payload["members"]:
-        socketio.emit("group_created", group_payload, room=str(uid))
+    for logged in created:
+        enter_group_rooms(user_sids(logged.user_id), [group_payload["id"]])
+        emit_logged(logged)
 
     return jsonify({"ok": True, "group": group_payload})
 
@@ -684,6 +1270,14 @@ def upload_chat_file():
     if "user_id" not in session:
         return jsonify({"ok": False, "error": "Não autenticado"}), 401
 
+    allowed, retry_after = rate_limiter.hit(session["user_id"], "upload_chat_file")
+    if not allowed:
+        return (
+            jsonify({"ok": False, "error": "Muitos envios seguidos. Tente de novo em instantes."}),
+            429,
+            {"Retry-After": retry_after_header(retry_after)},
+        )
+
     file = request.files.get("file")
     if not file or not file.filename:
         return jsonify({"ok": False, "error": "Arquivo não enviado"}), 400
@@ -695,7 +1289,7 @@ def upload_chat_file():
     ext = safe_name.rsplit(".", 1)[1].lower()
     unique_name = f"{session['user_id']}_{uuid.uuid4().hex}.{ext}"
     save_path = os.path.join(CHAT_UPLOAD_FOLDER, unique_name)
-    file.save(save_path)
+    run_blocking(file.save, save_path)
 
     file_url = f"/static/chat_uploads/{unique_name}"
     file_mime = file.mimetype or "application/octet-stream"
@@ -731,45 +1325,56 @@ def upload_chat_file():
 
 @app.route("/messages/<conversation_type>/<int:target_id>")
 def get_messages(conversation_type, target_id):
+    empty_page = {"messages": [], "has_more": False, "next_before_id": None}
     if "user_id" not in session:
-        return jsonify([])
+        return jsonify(empty_page)
 
     my_id = int(session["user_id"])
+    before_id, after_id, limit = parse_history_cursor(request.args)
 
     if conversation_type == "user":
-        msgs = (
-            Message.query.filter(
-                ((Message.sender_id == my_id) & (Message.receiver_id == target_id))
-                | ((Message.sender_id == target_id) & (Message.receiver_id == my_id))
-            )
-            .order_by(Message.created_at.asc())
-            .all()
+        query = Message.query.filter(
+            ((Message.sender_id == my_id) & (Message.receiver_id == target_id))
+            | ((Message.sender_id == target_id) & (Message.receiver_id == my_id))
+        )
+        msgs, cursor = fetch_history_page(query, Message.id, before_id, after_id, limit)
+        msgs, cursor = continue_into_archive(
+            private_conversation_key(my_id, target_id), msgs, cursor, before_id, after_id, limit
         )
+        delivered_up_to = load_delivered_up_to(target_id, my_id)
         return jsonify(
-            [build_private_message_response(m, my_id, target_id) for m in msgs]
+            {
+                "messages": [
+                    build_private_message_response(m, my_id, target_id, delivered_up_to)
+                    for m in msgs
+                ],
+                **cursor,
+            }
         )
 
     if conversation_type == "group":
         if not user_in_group(my_id, target_id):
-            return jsonify([])
+            return jsonify(empty_page)
 
-        msgs = (
-            GroupMessage.query.filter(GroupMessage.group_id == int(target_id))
-            .order_by(GroupMessage.created_at.asc())
-            .all()
+        query = GroupMessage.query.filter(GroupMessage.group_id == int(target_id))
+        msgs, cursor = fetch_history_page(
+            query, GroupMessage.id, before_id, after_id, limit
         )
+        msgs, cursor = continue_into_archive(
+            group_conversation_key(target_id), msgs, cursor, before_id, after_id, limit
+        )
+
+        profiles = profile_cache.get_many(int(m.sender_id) for m in msgs)
+        read_index = load_group_read_index(target_id)
 
         out = []
         for m in msgs:
-            payload = build_group_message_response(m, my_id, target_id)
-            sender = User.query.get(int(m.sender_id))
-            payload["sender_name"] = (
-                sender.display_name if sender and sender.display_name else sender.username if sender else "Usuário"
-            )
+            payload = build_group_message_response(m, my_id, target_id, read_index)
+            payload["sender_name"] = profile_display_name(profiles.get(int(m.sender_id)))
             out.append(payload)
-        return jsonify(out)
+        return jsonify({"messages": out, **cursor})
 
-    return jsonify([])
+    return jsonify(empty_page)
 
 
 @app.route("/unread_counts")
@@ -778,97 +1383,650 @@ def unread_counts():
         return jsonify({})
 
     my_id = int(session["user_id"])
-    result = {}
 
-    private_rows = (
-        db.session.query(Message.sender_id, func.count(Message.id))
-        .filter(Message.receiver_id == my_id, Message.seen == False)  # noqa: E712
-        .group_by(Message.sender_id)
-        .all()
+    rows = UnreadCounter.query.filter(
+        UnreadCounter.user_id == my_id,
+        UnreadCounter.unread_count > 0,
+    ).all()
+
+    return jsonify(
+        {
+            f"{row.conversation_type}_{int(row.target_id)}": int(row.unread_count)
+            for row in rows
+        }
     )
-    for sender_id, count in private_rows:
-        result[f"user_{int(sender_id)}"] = int(count)
-
-    for g in user_groups(my_id):
-        gid = int(g["id"])
-        group_read = GroupRead.query.filter_by(group_id=gid, user_id=my_id).first()
-        last_read = (
-            int(group_read.last_read_message_id)
-            if group_read and group_read.last_read_message_id
-            else 0
+
+
+@app.route("/search")
+def search():
+    empty = {"results": [], "next_cursor": None}
+    if "user_id" not in session:
+        return jsonify(empty)
+
+    if not SEARCH_ENABLED:
+        return jsonify({**empty, "error": "Busca indisponível"}), 501
+
+    my_id = int(session["user_id"])
+    query = (request.args.get("q") or "").strip()
+
+    cursor = None
+    raw_cursor = request.args.get("cursor") or ""
+    if raw_cursor:
+        try:
+            rank, rowid = raw_cursor.split(",", 1)
+            cursor = (float(rank), int(rowid))
+        except ValueError:
+            cursor = None
+
+    try:
+        limit = int(request.args.get("limit") or SEARCH_PAGE_SIZE)
+    except ValueError:
+        limit = SEARCH_PAGE_SIZE
+    limit = max(1, min(limit, SEARCH_PAGE_MAX))
+
+    rows, next_cursor = search_messages(db.session, my_id, query, cursor, limit)
+
+    private_ids = [int(r.message_id) for r in rows if r.conversation_type == "user"]
+    group_ids = [int(r.message_id) for r in rows if r.conversation_type == "group"]
+    created = {}
+    if private_ids:
+        for m in db.session.query(Message.id, Message.created_at).filter(Message.id.in_(private_ids)):
+            created[("user", int(m.id))] = m.created_at
+    if group_ids:
+        for m in db.session.query(GroupMessage.id, GroupMessage.created_at).filter(
+            GroupMessage.id.in_(group_ids)
+        ):
+            created[("group", int(m.id))] = m.created_at
+
+    results = []
+    for r in rows:
+        conversation_type = r.conversation_type
+        target_id = int(r.target_id)
+        if conversation_type == "user" and target_id == my_id:
+            target_id = int(r.sender_id)
+
+        created_at = created.get((conversation_type, int(r.message_id)))
+        results.append(
+            {
+                "message_id": int(r.message_id),
+                "conversation_type": conversation_type,
+                "target_id": target_id,
+                "sender_id": int(r.sender_id),
+                "highlight": render_highlight(r.snippet),
+                "created_at": created_at.isoformat() if created_at else None,
+            }
         )
 
-        count = (
-            GroupMessage.query.filter(
-                GroupMessage.group_id == gid,
-                GroupMessage.id > last_read,
-                GroupMessage.sender_id != my_id,
+    return jsonify(
+        {
+            "results": results,
+            "next_cursor": f"{next_cursor[0]!r},{next_cursor[1]}" if next_cursor else None,
+        }
+    )
+
+
+@app.cli.command("rebuild-search")
+def rebuild_search_command():
+    """Recria o índice FTS5 de busca a partir das mensagens existentes."""
+    if db.engine.dialect.name != "sqlite":
+        print("Busca FTS5 só é suportada com SQLite.")
+        return
+    with db.engine.begin() as conn:
+        rebuild_search_index(conn)
+    print("Índice de busca reconstruído.")
+
+
+def scratch_app(directory):
+    """App Flask ligado a um SQLite novo em `directory`, para benchmarks que gravam."""
+    url = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+    bench_app = Flask(__name__)
+    bench_app.secret_key = app.secret_key
+    bench_app.config.update(
+        SQLALCHEMY_DATABASE_URI=url,
+        SQLALCHEMY_ENGINE_OPTIONS=engine_options(url),
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+    )
+    db.init_app(bench_app)
+
+    with bench_app.app_context():
+        install_engine_hooks(db.engine)
+        db.create_all()
+        run_migrations(log=lambda *args: None)
+    return bench_app
+
+
+@app.cli.command("bench-search")
+@click.option("--rows", default=200000, show_default=True, help="Mensagens no índice semeado.")
+@click.option("--users", default=20, show_default=True)
+@click.option("--groups", default=200, show_default=True)
+@click.option("--rounds", default=20, show_default=True, help="Repetições por consulta.")
+def bench_search_command(rows, users, groups, rounds):
+    """Semeia um índice FTS5 num SQLite temporário e mede p50/p95 das buscas típicas."""
+    with tempfile.TemporaryDirectory() as tmp:
+        bench_app = scratch_app(tmp)
+        with bench_app.app_context():
+            if not search_available(db.engine):
+                raise click.ClickException("este SQLite não tem FTS5")
+            started = time.perf_counter()
+            with db.engine.begin() as conn:
+                seed_search_benchmark(conn, rows, users=users, groups=groups)
+            print(f"[search] {rows:,} mensagens indexadas em {time.perf_counter() - started:.1f}s")
+
+            for label, (p50, p95, found) in benchmark_search(db.session, rounds=rounds).items():
+                print(f"[search] {label:14} p50 {p50:7.1f} ms  p95 {p95:7.1f} ms  ({found} resultados)")
+            db.session.remove()
+            db.engine.dispose()
+
+
+@app.cli.command("archive-messages")
+@click.option("--days", default=180, show_default=True, help="Idade mínima das mensagens arquivadas.")
+@click.option("--batch-size", default=500, show_default=True, help="Mensagens por segmento/commit.")
+def archive_messages_command(days, batch_size):
+    """Move mensagens antigas para os segmentos comprimidos do arquivo frio."""
+    archive_old_messages(
+        message_archive,
+        older_than_days=days,
+        batch_size=batch_size,
+        search_enabled=SEARCH_ENABLED,
+    )
+
+
+@app.cli.command("bench-moderation")
+@click.option("--action", default="mask", show_default=True, type=click.Choice(sorted(MODERATION_ACTIONS - {"off"})))
+@click.option("--rounds", default=20000, show_default=True, help="Repetições do conjunto de mensagens.")
+@click.option("--budget-us", default=MODERATION_BUDGET_US, show_default=True, help="Limite em µs por mensagem.")
+def bench_moderation_command(action, rounds, budget_us):
+    """Mede o filtro de moderação (mensagens e usernames) e falha se passar do orçamento por mensagem."""
+    per_message = benchmark_moderation(profanity_matcher, action=action, rounds=rounds)
+    capacity = 1_000_000 / per_message if per_message else float("inf")
+    print(
+        f"[moderation] {action}: {per_message:.1f} µs/mensagem "
+        f"(~{capacity:,.0f} msgs/s; alvo {MODERATION_TARGET_RATE:,} msgs/s, orçamento {budget_us:.0f} µs)"
+    )
+    per_username = benchmark_usernames(profanity_matcher, rounds=rounds)
+    print(f"[moderation] usernames: {per_username:.1f} µs/username (filtro do /register)")
+    if per_message > budget_us:
+        raise click.ClickException(f"acima do orçamento: {per_message:.1f} µs > {budget_us:.0f} µs")
+
+
+@app.cli.command("bench-engine")
+@click.option("--url", default=None, help="Banco a usar (ex.: PostgreSQL); padrão: SQLite temporário.")
+@click.option("--readers", default=4, show_default=True, help="Threads lendo.")
+@click.option("--writers", default=8, show_default=True, help="Threads escrevendo.")
+@click.option("--operations", default=300, show_default=True, help="Operações por thread.")
+def bench_engine_command(url, readers, writers, operations):
+    """Leitores/escritores concorrentes com e sem os PRAGMAs do SQLite / pool do PostgreSQL."""
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, tuned in (("padrão", False), ("ajustado", True)):
+            # o WAL fica gravado no arquivo: cada modo usa um SQLite novo
+            target = url or f"sqlite:///{os.path.join(tmp, f'{label}.db')}"
+            result = benchmark_engine(
+                bench_engine(target, tuned), readers=readers, writers=writers, operations=operations
+            )
+            print(f"[engine] {label:8} {result['writes_per_second']:8,.0f} escritas/s "
+                  f"{result['reads_per_second']:8,.0f} leituras/s  {result['errors']} erros")
+
+
+@app.cli.command("bench-query-plans")
+def bench_query_plans_command():
+    """Mostra o plano das consultas quentes e falha se alguma varrer a tabela inteira."""
+    with db.engine.connect() as conn:
+        plans = explain_hot_queries(conn)
+    scans = []
+    for name, details, scan in plans:
+        print(f"[plan] {name:15} {' | '.join(details)}")
+        if scan:
+            scans.append(name)
+    if scans:
+        raise click.ClickException(f"scan completo em: {', '.join(scans)} (faltam os índices da migração 1)")
+
+
+@app.cli.command("bench-payload")
+@click.option("--rows", default=10000, show_default=True, help="Mensagens por rodada.")
+@click.option("--rounds", default=5, show_default=True, help="Rodadas (vale a melhor).")
+def bench_payload_command(rows, rounds):
+    """Compara o custo de montar o conteúdo das mensagens: envelope JSON x colunas."""
+    result = benchmark_content_fields(count=rows, rounds=rounds)
+    print(f"[payload] {rows} mensagens: envelope __CHATJSON__ {result['envelope_ms']:.1f} ms, "
+          f"colunas {result['columns_ms']:.1f} ms "
+          f"({result['envelope_ms'] / result['columns_ms']:.1f}x)")
+
+
+@app.cli.command("bench-history")
+@click.option("--messages", default=5000, show_default=True, help="Mensagens no grupo semeado.")
+@click.option("--senders", default=100, show_default=True, help="Remetentes distintos.")
+@click.option("--limit", "limits", default=(50, 200), multiple=True, show_default=True, help="Tamanho da página.")
+def bench_history_command(messages, senders, limits):
+    """Pagina o histórico de um grupo semeado com o cache de perfis ligado e desligado."""
+    # fora da faixa de ids reais: o arquivo frio não tem segmentos deste grupo
+    group_id = 999_999_001
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bench_app = scratch_app(tmp)
+        bench_app.add_url_rule("/messages/<conversation_type>/<int:target_id>", view_func=get_messages)
+        queries = [0]
+
+        with bench_app.app_context():
+            users = [
+                User(username=f"bench{i}", email=f"bench{i}@bench.local", password="x", display_name=f"Bench {i}")
+                for i in range(senders)
+            ]
+            db.session.add_all(users)
+            db.session.flush()
+            db.session.add(Group(id=group_id, name="bench", created_by=users[0].id))
+            db.session.add_all(GroupMember(group_id=group_id, user_id=u.id) for u in users)
+            now = datetime.utcnow()
+            db.session.add_all(
+                GroupMessage(group_id=group_id, sender_id=users[i % senders].id, text=f"m{i}", created_at=now)
+                for i in range(messages)
+            )
+            db.session.commit()
+            reader_id = users[0].id
+
+            @db.event.listens_for(db.engine, "before_cursor_execute")
+            def count_query(*args):
+                queries[0] += 1
+
+        client = bench_app.test_client()
+        with client.session_transaction() as sess:
+            sess["user_id"] = reader_id
+
+        ttl = profile_cache.ttl
+        try:
+            for label, cache_ttl in (("com cache", ttl), ("sem cache", 0)):
+                profile_cache.ttl = cache_ttl
+                for limit in limits:
+                    profile_cache.clear()
+                    membership_cache.clear()
+                    queries[0] = pages = 0
+                    cursor = None
+                    started = time.perf_counter()
+                    while True:
+                        url = f"/messages/group/{group_id}?limit={limit}"
+                        page = client.get(url + (f"&before_id={cursor}" if cursor else "")).get_json()
+                        pages += 1
+                        cursor = page["next_before_id"]
+                        if not cursor:
+                            break
+                    elapsed = time.perf_counter() - started
+                    print(f"[history] {label} limit={limit}: {pages} páginas, "
+                          f"{queries[0] / pages:.1f} queries/página, {elapsed / pages * 1000:.1f} ms/página")
+        finally:
+            profile_cache.ttl = ttl
+            profile_cache.clear()
+            membership_cache.clear()
+            with bench_app.app_context():
+                db.engine.dispose()
+
+
+@app.cli.command("bench-batching")
+@click.option("--senders", default=8, show_default=True, help="Remetentes simultâneos.")
+@click.option("--messages", default=300, show_default=True, help="Mensagens por remetente.")
+@click.option("--window-ms", default=5, show_default=True, help="Janela do group commit.")
+def bench_batching_command(senders, messages, window_ms):
+    """Vazão do send_message com commit por mensagem x group commit, num SQLite temporário."""
+    with tempfile.TemporaryDirectory() as tmp:
+        bench_app = scratch_app(tmp)
+
+        with bench_app.app_context():
+            users = [
+                User(username=f"bench{i}", email=f"bench{i}@bench.local", password="x", display_name=f"bench{i}")
+                for i in range(senders + 1)
+            ]
+            db.session.add_all(users)
+            db.session.commit()
+            ids = [u.id for u in users]
+
+        receiver_id = ids[-1]
+
+        def make_job(sender, i):
+            content = {"text": f"m{i}", "kind": "text", "file_url": None, "file_name": None, "file_mime": None}
+            return lambda: store_private_message(ids[sender], receiver_id, content, "bench", str(i))
+
+        result = benchmark_write_batching(
+            bench_app, db, make_job, senders=senders, messages=messages, window_ms=window_ms
+        )
+
+        # cada remetente rodou m0..mN duas vezes (direto e em lote), nessa ordem
+        expected = [f"m{i}" for i in range(messages)] * 2
+        with bench_app.app_context():
+            in_order = all(
+                [m.text for m in Message.query.filter_by(sender_id=uid).order_by(Message.id)] == expected
+                for uid in ids[:-1]
             )
-            .count()
+            db.session.remove()
+            db.engine.dispose()
+
+    total = senders * messages
+    print(f"[batching] {senders} remetentes x {messages} mensagens: direto {result['direct']:.0f} msg/s "
+          f"({total} commits), em lote {result['batched']:.0f} msg/s ({result['commits']} commits)")
+    if result["failed"] or not in_order:
+        raise click.ClickException(f"{result['failed']} mensagens falharam; ordem por remetente ok: {in_order}")
+
+
+@app.cli.command("bench-wire")
+@click.option("--rounds", default=2000, show_default=True, help="Repetições do conjunto de mensagens.")
+def bench_wire_command(rounds):
+    """Compara bytes e CPU por receive_message em JSON, compacto e MessagePack."""
+    results = benchmark_wire_formats(sample_message_payloads(), rounds=rounds)
+    baseline = results["json"]["bytes_per_message"]
+    for wire_format, r in results.items():
+        print(
+            f"[wire] {wire_format:8} {r['bytes_per_message']:6.1f} B/mensagem "
+            f"({r['bytes_per_message'] / baseline:.0%})  {r['us_per_message']:5.1f} µs/mensagem"
         )
-        result[f"group_{gid}"] = int(count)
 
-    return jsonify(result)
+
+@app.cli.command("bench-fanout")
+@click.option("--members", default=1000, show_default=True, help="Membros conectados no grupo.")
+@click.option("--rounds", default=50, show_default=True, help="Eventos por modo.")
+def bench_fanout_command(members, rounds):
+    """Compara o fan-out de um evento de grupo: emit por membro x um emit para a sala."""
+    payload = sample_message_payloads()[-1]
+    results = benchmark_group_fanout(payload, members=members, rounds=rounds)
+    for name, label in (("per_member", "por membro"), ("room", "sala única")):
+        r = results[name]
+        print(f"[fanout] {members} membros, {label:10} {r['ms_per_event']:7.2f} ms/evento "
+              f"({r['packets_per_event']:.0f} pacotes)")
+
+
+@app.cli.command("bench-presence")
+@click.option("--users", default=2000, show_default=True)
+@click.option("--group-size", default=50, show_default=True, help="Contatos por usuário (grupos disjuntos).")
+@click.option("--login-seconds", default=60.0, show_default=True, help="Duração da onda de logins.")
+def bench_presence_command(users, group_size, login_seconds):
+    """Simula uma onda de logins e conta os frames de presença (antes x agora)."""
+    result = simulate_login_storm(
+        users=users,
+        group_size=group_size,
+        login_seconds=login_seconds,
+        flush_seconds=PRESENCE_FLUSH_SECONDS,
+        grace=presence_broadcaster.grace,
+    )
+    print(f"[presence] {users} logins em {login_seconds:.0f}s: broadcast para todos "
+          f"{result['naive_frames']:,} frames, diffs por contato {result['batched_frames']:,} frames")
+
+
+@app.cli.command("check-presence-store")
+def check_presence_store_command():
+    """Roda o roteiro de presença contra o store de PRESENCE_STORE_URL (chaves descartáveis)."""
+    url = os.environ.get("PRESENCE_STORE_URL", "").strip()
+    if not url or url.startswith("memory"):
+        store, peer = MemoryPresenceStore(), None
+    else:
+        prefix = f"presence-check-{uuid.uuid4().hex[:8]}"
+        store = RedisPresenceStore(url, prefix=prefix)
+        peer = RedisPresenceStore(url, prefix=prefix, client=store.redis)
+
+    try:
+        failures = check_presence_store(store, peer)
+    finally:
+        if peer is not None:
+            for key in store.redis.scan_iter(store._key("*")):
+                store.redis.delete(key)
+
+    if failures:
+        raise click.ClickException("; ".join(failures))
+    print(f"[presence] {type(store).__name__}: ok")
+
+
+@app.cli.command("bench-connections")
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=5000, show_default=True)
+@click.option("--count", default=1000, show_default=True, help="Conexões ociosas a abrir.")
+@click.option("--hold", default=30, show_default=True, help="Segundos mantendo as conexões.")
+@click.option("--pid", type=int, default=None, help="Pid do worker, para medir o RSS.")
+def bench_connections_command(host, port, count, hold, pid):
+    """Abre conexões Socket.IO ociosas contra um servidor rodando e mede o custo."""
+    result = run_connection_bench(host, port, count, hold_seconds=hold, pid=pid)
+    print(f"[bench] {result['alive']}/{result['requested']} conexões vivas após {hold}s "
+          f"(abertas em {result['connect_seconds']}s)")
+    if "kb_per_connection" in result:
+        print(f"[bench] RSS {result['rss_before_kb']} -> {result['rss_after_kb']} KB, "
+              f"~{result['kb_per_connection']} KB por conexão ociosa")
+    if result["first_error"]:
+        print(f"[bench] primeiro erro: {result['first_error']}")
+
+
+@app.cli.command("rebuild-unread")
+def rebuild_unread_command():
+    """Recalcula unread_counters a partir de messages/group_messages/group_reads."""
+    with db.engine.begin() as conn:
+        rebuild_unread_counters(conn)
+    print("Contadores de não lidas reconstruídos.")
+
+
+@app.cli.command("prune-events")
+@click.option("--hours", default=72, show_default=True, help="Idade mínima dos eventos apagados.")
+def prune_events_command(hours):
+    """Apaga o log de eventos antigo; clientes fora há mais tempo fazem resync."""
+    deleted = prune_event_log(hours)
+    print(f"{deleted} eventos apagados.")
+
+
+# ---------------- ENVIO DE MENSAGENS ----------------
+def commit_message(job):
+    """
+    `job` grava a mensagem na sessão e devolve a função que faz os emits.
+    Sem batching o commit é imediato; com batching o job vai para o lote.
+    """
+    if message_batcher is not None:
+        message_batcher.submit(job)
+        return
+
+    announce = job()
+    db.session.commit()
+    announce()
+
+
+def message_sent_ack(msg, temp_id):
+    return {
+        "temp_id": temp_id,
+        "message_id": int(msg.id),
+        "created_at": msg.created_at.isoformat() if msg.created_at else None,
+    }
+
+
+def store_private_message(sender_id, target_id, content, sender_name, temp_id, flagged_words=()):
+    msg = Message(
+        sender_id=sender_id,
+        receiver_id=target_id,
+        created_at=datetime.utcnow(),
+        seen=False,
+        **content,
+    )
+    db.session.add(msg)
+    db.session.flush()
+    record_private_summary(msg)
+    bump_private_unread(msg)
+    sync_search_index("user", msg)
+    record_moderation_flag("user", msg, flagged_words)
+
+    ack = message_sent_ack(msg, temp_id)
+    payload_receiver = build_private_message_response(msg, target_id, target_id)
+    payload_receiver["sender_name"] = sender_name
+    received = record_event("receive_message", payload_receiver, user_id=target_id)
+
+    def announce():
+        socketio.emit("message_sent", ack, room=str(sender_id))
+        emit_logged(received)
+
+    return announce
+
+
+def store_group_message(sender_id, group_id, content, sender_name, temp_id, flagged_words=()):
+    msg = GroupMessage(
+        group_id=group_id,
+        sender_id=sender_id,
+        created_at=datetime.utcnow(),
+        **content,
+    )
+    db.session.add(msg)
+    db.session.flush()
+    record_group_summary(msg)
+    bump_group_unread(msg)
+    sync_search_index("group", msg)
+    record_moderation_flag("group", msg, flagged_words)
+
+    group = get_group_by_id(group_id)
+    ack = message_sent_ack(msg, temp_id)
+    ack["read_count"] = 0
+    ack["read_total"] = max(0, len(get_group_members(group_id)) - 1)
+    payload_group = build_group_message_response(msg, sender_id, group_id)
+    payload_group["sender_name"] = sender_name
+    payload_group["group_name"] = group.name if group else "Grupo"
+    received = record_event(
+        "receive_message", payload_group, group_id=group_id, exclude_user_id=sender_id
+    )
+
+    def announce():
+        socketio.emit("message_sent", ack, room=str(sender_id))
+        emit_logged(received)
+
+    return announce
 
 
 # ---------------- SOCKET.IO ----------------
+def leave_group_calls(user_id):
+    for gid in presence.leave_all_calls(user_id):
+        socketio.emit(
+            "group_call_user_left",
+            {"group_id": gid, "user_id": user_id},
+            room=group_room_name(gid),
+        )
+
+
+def presence_heartbeat_loop():
+    """Renova este worker no presence compartilhado e limpa workers mortos."""
+    interval = max(1, presence.worker_ttl // 3)
+    while True:
+        socketio.sleep(interval)
+        try:
+            went_offline = presence.heartbeat(force=True)
+        except Exception:
+            logger.exception("Heartbeat do presence falhou")
+            continue
+        for uid in went_offline:
+            presence_broadcaster.offline(uid)
+            leave_group_calls(uid)
+
+
+def presence_flush_loop():
+    """Envia os presence_diff acumulados a cada PRESENCE_FLUSH_MS."""
+    while True:
+        socketio.sleep(PRESENCE_FLUSH_SECONDS)
+        socket_manager.release_held()
+        with app.app_context():
+            try:
+                presence_broadcaster.flush()
+            except Exception:
+                logger.exception("Flush dos presence_diff falhou")
+            finally:
+                db.session.remove()
+
+
+def relay_typing_event(event, key, sender_name=None):
+    sender_id, conversation_type, target_id = key
+    payload = {
+        "sender_id": sender_id,
+        "conversation_type": conversation_type,
+        "target_id": target_id,
+    }
+    if event == "typing":
+        payload["sender_name"] = sender_name
+
+    if conversation_type == "user":
+        socketio.emit(event, payload, room=str(target_id))
+    else:
+        emit_to_group(event, payload, target_id, skip_user_id=sender_id)
+
+
+def typing_sweeper_loop():
+    """stop_typing automático para quem parou de mandar eventos."""
+    interval = min(0.5, typing_coalescer.stop_grace / 2)
+    while True:
+        socketio.sleep(interval)
+        try:
+            for key in typing_coalescer.expired():
+                relay_typing_event("stop_typing", key)
+        except Exception:
+            logger.exception("stop_typing automático falhou")
+
+
+def receipt_flush_loop():
+    """Aplica os recibos de leitura e de entrega acumulados na janela."""
+    interval = max(0.05, RECEIPT_WINDOW_SECONDS / 2)
+    while True:
+        socketio.sleep(interval)
+        due = [(apply_read_receipt, r) for r in read_receipts.due()]
+        due += [(apply_delivery_receipt, r) for r in delivery_receipts.due()]
+        if not due:
+            continue
+        with app.app_context():
+            group_deltas = []
+            for apply, receipt in due:
+                try:
+                    group_deltas.extend(apply(*receipt) or [])
+                except Exception:
+                    db.session.rollback()
+                    logger.exception("Recibo %s falhou", receipt)
+            try:
+                publish_group_read_deltas(group_deltas)
+            except Exception:
+                db.session.rollback()
+                logger.exception("Deltas de leitura de grupo falharam")
+            db.session.remove()
+
+
 @socketio.on("join")
 def handle_join(data):
-    user_id = data.get("user_id") or session.get("user_id")
+    # só a sessão identifica o usuário: o join dá acesso às salas e ao replay
+    user_id = session.get("user_id")
     if not user_id:
         return
+    data = data if isinstance(data, dict) else {}
 
     user_id = int(user_id)
     sid = request.sid
 
-    with presence_lock:
-        sid_to_user[sid] = user_id
-        was_online = user_id in online_users
-        user_to_sids[user_id].add(sid)
-        online_users.add(user_id)
+    was_online = presence.add_sid(user_id, sid)
+    socket_manager.set_wire_format(sid, negotiate_wire_format(data.get("wire")))
+    start_background_once(presence_flush_loop)
+    if presence.shared:
+        start_background_once(presence_heartbeat_loop)
+    if cache_bus.shared:
+        start_background_once(cache_invalidation_loop)
 
     join_room(str(user_id))
+    # o sid já está no presence: um grupo criado depois desta consulta
+    # entra na sala pelo create_group
+    group_ids = load_user_group_ids(user_id)
+    enter_group_rooms([sid], group_ids)
 
     if not was_online:
-        socketio.emit("presence", {"user_id": user_id, "online": True})
+        presence_broadcaster.online(user_id)
 
-    emit("online_list", {"online": list(online_users)})
+    emit("online_list", {"online": online_contacts(user_id)})
+    # reconexão: só os eventos perdidos desde o último seq visto
+    emit("resume", resume_payload(user_id, group_ids, data.get("last_seq")))
 
 
 @socketio.on("disconnect")
 def handle_disconnect():
-    sid = request.sid
-    uid = None
+    socket_manager.forget(request.sid)
+    uid, went_offline = presence.remove_sid(request.sid)
+    if uid is None:
+        return
 
-    with presence_lock:
-        uid = sid_to_user.pop(sid, None)
-        if uid is None:
-            return
-
-        sids = user_to_sids.get(uid)
-        if sids and sid in sids:
-            sids.remove(sid)
-
-        if not sids:
-            user_to_sids.pop(uid, None)
-            if uid in online_users:
-                online_users.discard(uid)
-                socketio.emit("presence", {"user_id": uid, "online": False})
-
-    with group_call_lock:
-        for gid in list(active_group_calls.keys()):
-            if uid in active_group_calls[gid]:
-                active_group_calls[gid].discard(uid)
-                socketio.emit(
-                    "group_call_user_left",
-                    {"group_id": gid, "user_id": uid},
-                    room=group_room_name(gid),
-                )
-                if not active_group_calls[gid]:
-                    active_group_calls.pop(gid, None)
+    if went_offline:
+        presence_broadcaster.offline(uid)
+        for key in typing_coalescer.forget_user(uid):
+            relay_typing_event("stop_typing", key)
+    leave_group_calls(uid)
 
 
 @socketio.on("send_message")
+@rate_limited("send_message", on_reject=reject_rate_limited_message)
 def handle_send_message(data):
     sender_id = session.get("user_id")
     sender_name = session.get("username") or ""
@@ -893,90 +2051,44 @@ def handle_send_message(data):
 
     if kind == "text" and not message_text:
         return
-    if kind in {"file", "image", "audio"} and not file_url:
+    if kind in FILE_KINDS and not file_url:
         return
 
-    payload_text = serialize_message_payload(
-        kind=kind,
-        text=message_text,
-        file_url=file_url,
-        file_name=file_name,
-        file_mime=file_mime,
-        edited=False,
-        deleted=False,
-    )
-
-    if conversation_type == "user":
-        msg = Message(
-            sender_id=sender_id,
-            receiver_id=target_id,
-            text=payload_text,
-            created_at=datetime.utcnow(),
-            seen=False,
-        )
-        db.session.add(msg)
-        db.session.commit()
-
-        payload_receiver = build_private_message_response(msg, target_id, target_id)
-        payload_receiver["sender_name"] = sender_name
-
-        socketio.emit(
-            "message_sent",
-            {
-                "temp_id": temp_id,
-                "message_id": int(msg.id),
-                "created_at": msg.created_at.isoformat() if msg.created_at else None,
-            },
-            room=str(sender_id),
-        )
+    message_text, flagged_words = moderate_message_text(message_text)
+    if message_text is None:
+        emit("message_rejected", {"temp_id": temp_id, "reason": "moderation"})
+        return
 
-        socketio.emit("receive_message", payload_receiver, room=str(target_id))
+    content = {
+        "text": message_text,
+        "kind": kind,
+        "file_url": file_url,
+        "file_name": file_name,
+        "file_mime": file_mime,
+    }
 
-        if user_is_online(target_id):
-            socketio.emit(
-                "message_delivered",
-                {"message_id": int(msg.id)},
-                room=str(sender_id),
+    if conversation_type == "user":
+        commit_message(
+            lambda: store_private_message(
+                sender_id, target_id, content, sender_name, temp_id, flagged_words
             )
+        )
         return
 
     if conversation_type == "group":
         if not user_in_group(sender_id, target_id):
             return
 
-        msg = GroupMessage(
-            group_id=target_id,
-            sender_id=sender_id,
-            text=payload_text,
-            file_url=file_url,
-            created_at=datetime.utcnow(),
-        )
-        db.session.add(msg)
-        db.session.commit()
-
-        group = get_group_by_id(target_id)
-        payload_group = build_group_message_response(msg, sender_id, target_id)
-        payload_group["sender_name"] = sender_name
-        payload_group["group_name"] = group.name if group else "Grupo"
-
-        socketio.emit(
-            "message_sent",
-            {
-                "temp_id": temp_id,
-                "message_id": int(msg.id),
-                "created_at": msg.created_at.isoformat() if msg.created_at else None,
-            },
-            room=str(sender_id),
+        commit_message(
+            lambda: store_group_message(
+                sender_id, target_id, content, sender_name, temp_id, flagged_words
+            )
         )
-
-        for member_id in get_group_members(target_id):
-            if int(member_id) == int(sender_id):
-                continue
-            socketio.emit("receive_message", payload_group, room=str(member_id))
         return
 
 
 @socketio.on("edit_message")
+@rate_limited("edit_message", on_reject=reject_rate_limited_message)
 def handle_edit_message(data):
     user_id = session.get("user_id")
     if not user_id:
@@ -995,72 +2107,66 @@ def handle_edit_message(data):
     except Exception:
         return
 
+    new_text, flagged_words = moderate_message_text(new_text)
+    if new_text is None:
+        emit("message_rejected", {"message_id": message_id, "reason": "moderation"})
+        return
+
     if conversation_type == "group":
         msg = GroupMessage.query.get(message_id)
         if not msg or int(msg.sender_id) != user_id:
             return
 
-        payload = deserialize_message_payload(msg.text)
-        if payload["deleted"] or payload["kind"] != "text":
+        if msg.deleted or (msg.kind or "text") != "text":
             return
 
-        payload["text"] = new_text
-        payload["edited"] = True
-
-        msg.text = serialize_message_payload(
-            kind=payload["kind"],
-            text=payload["text"],
-            file_url=payload["file_url"],
-            file_name=payload["file_name"],
-            file_mime=payload["file_mime"],
-            edited=True,
-            deleted=False,
-        )
-        db.session.commit()
+        msg.text = new_text
+        msg.edited = True
+        refresh_summary_preview("group", msg)
+        sync_search_index("group", msg)
+        record_moderation_flag("group", msg, flagged_words)
 
         shared_payload = {
             "message_id": int(msg.id),
             "text": new_text,
             "edited": True,
         }
+        edited = record_event("message_edited", shared_payload, group_id=int(msg.group_id))
+        db.session.commit()
 
-        for member_id in get_group_members(int(msg.group_id)):
-            socketio.emit("message_edited", shared_payload, room=str(member_id))
+        emit_logged(edited)
         return
 
     msg = Message.query.get(message_id)
     if not msg or int(msg.sender_id) != user_id:
         return
 
-    payload = deserialize_message_payload(msg.text)
-    if payload["deleted"] or payload["kind"] != "text":
+    if msg.deleted or (msg.kind or "text") != "text":
         return
 
-    payload["text"] = new_text
-    payload["edited"] = True
-
-    msg.text = serialize_message_payload(
-        kind=payload["kind"],
-        text=payload["text"],
-        file_url=payload["file_url"],
-        file_name=payload["file_name"],
-        file_mime=payload["file_mime"],
-        edited=True,
-        deleted=False,
-    )
-    db.session.commit()
+    msg.text = new_text
+    msg.edited = True
+    refresh_summary_preview("user", msg)
+    sync_search_index("user", msg)
+    record_moderation_flag("user", msg, flagged_words)
 
     shared_payload = {
         "message_id": int(msg.id),
         "text": new_text,
         "edited": True,
     }
+    edited = [
+        record_event("message_edited", shared_payload, user_id=uid)
+        for uid in sorted({int(msg.sender_id), int(msg.receiver_id)})
+    ]
+    db.session.commit()
 
-    socketio.emit("message_edited", shared_payload, room=str(msg.sender_id))
-    socketio.emit("message_edited", shared_payload, room=str(msg.receiver_id))
+    for logged in edited:
+        emit_logged(logged)
 
 
 @socketio.on("delete_message")
+@rate_limited("delete_message")
 def handle_delete_message(data):
     user_id = session.get("user_id")
     if not user_id:
@@ -1083,219 +2189,310 @@ def handle_delete_message(data):
         if not msg or int(msg.sender_id) != user_id:
             return
 
-        payload = deserialize_message_payload(msg.text)
-        payload["deleted"] = True
-        payload["edited"] = False
-        payload["text"] = ""
-
-        msg.text = serialize_message_payload(
-            kind=payload["kind"],
-            text="",
-            file_url=payload["file_url"],
-            file_name=payload["file_name"],
-            file_mime=payload["file_mime"],
-            edited=False,
-            deleted=True,
-        )
-        db.session.commit()
+        msg.text = ""
+        msg.edited = False
+        msg.deleted = True
+        refresh_summary_preview("group", msg)
+        sync_search_index("group", msg)
 
         shared_payload = {
             "message_id": int(msg.id),
             "deleted": True,
         }
+        deleted = record_event("message_deleted", shared_payload, group_id=int(msg.group_id))
+        db.session.commit()
 
-        for member_id in get_group_members(int(msg.group_id)):
-            socketio.emit("message_deleted", shared_payload, room=str(member_id))
+        emit_logged(deleted)
         return
 
     msg = Message.query.get(message_id)
     if not msg or int(msg.sender_id) != user_id:
         return
 
-    payload = deserialize_message_payload(msg.text)
-    payload["deleted"] = True
-    payload["edited"] = False
-    payload["text"] = ""
-
-    msg.text = serialize_message_payload(
-        kind=payload["kind"],
-        text="",
-        file_url=payload["file_url"],
-        file_name=payload["file_name"],
-        file_mime=payload["file_mime"],
-        edited=False,
-        deleted=True,
-    )
-    db.session.commit()
+    msg.text = ""
+    msg.edited = False
+    msg.deleted = True
+    refresh_summary_preview("user", msg)
+    sync_search_index("user", msg)
 
     shared_payload = {
         "message_id": int(msg.id),
         "deleted": True,
     }
+    deleted = [
+        record_event("message_deleted", shared_payload, user_id=uid)
+        for uid in sorted({int(msg.sender_id), int(msg.receiver_id)})
+    ]
+    db.session.commit()
 
-    socketio.emit("message_deleted", shared_payload, room=str(msg.sender_id))
-    socketio.emit("message_deleted", shared_payload, room=str(msg.receiver_id))
+    for logged in deleted:
+        emit_logged(logged)
 
 
-@socketio.on("mark_as_read")
-def mark_as_read(data):
-    conversation_type = (data.get("conversation_type") or "user").strip().lower()
-    my_id = session.get("user_id")
-    if not my_id:
-        return
-
-    my_id = int(my_id)
-
+def apply_read_receipt(reader_id, conversation_type, target_id, up_to=None):
+    """
+    Marca como lido até `up_to` (None = a última mensagem) com um UPDATE
+    por intervalo de ids, sem carregar as mensagens. O recibo leva só o
+    maior id lido: o remetente marca tudo até ali. `up_to` vem do cliente:
+    é limitado à última mensagem que existe, e o contador de não lidas só
+    zera quando a leitura chega nela.
+    """
     if conversation_type == "user":
-        sender_id = data.get("target_id")
-        if not sender_id:
-            return
-        try:
-            sender_id = int(sender_id)
-        except Exception:
+        last_id = (
+            db.session.query(func.max(Message.id))
+            .filter(Message.sender_id == target_id, Message.receiver_id == reader_id)
+            .scalar()
+        )
+        if last_id is None:
+            reset_unread(reader_id, "user", target_id)
+            db.session.commit()
             return
+        up_to = int(last_id) if up_to is None else min(int(up_to), int(last_id))
 
-        unread_messages = (
-            Message.query.filter_by(
-                sender_id=sender_id,
-                receiver_id=my_id,
-                seen=False,
+        marked = (
+            Message.query.filter(
+                Message.receiver_id == reader_id,
+                Message.seen.is_(False),
+                Message.sender_id == target_id,
+                Message.id <= up_to,
             )
-            .order_by(Message.id.asc())
-            .all()
+            .update({Message.seen: True}, synchronize_session=False)
         )
+        if up_to >= last_id:
+            reset_unread(reader_id, "user", target_id)
+        else:
+            discount_unread(reader_id, "user", target_id, marked)
+
+        read = None
+        if marked:
+            read = record_event(
+                "messages_read",
+                {"reader_id": reader_id, "conversation_type": "user", "up_to": up_to},
+                user_id=target_id,
+            )
+        db.session.commit()
 
-        if not unread_messages:
-            return
+        if read is not None:
+            emit_logged(read)
+        return
 
-        message_ids = [int(m.id) for m in unread_messages]
-        for msg in unread_messages:
-            msg.seen = True
+    last_id = (
+        db.session.query(func.max(GroupMessage.id))
+        .filter(GroupMessage.group_id == target_id)
+        .scalar()
+    )
+    if last_id is None:
+        reset_unread(reader_id, "group", target_id)
         db.session.commit()
-
-        socketio.emit(
-            "messages_read",
-            {"message_ids": message_ids, "reader_id": my_id},
-            room=str(sender_id),
+        return []
+    up_to = int(last_id) if up_to is None else min(int(up_to), int(last_id))
+
+    group_read = get_or_create_group_read(target_id, reader_id)
+    after = int(group_read.last_read_message_id or 0)
+    deltas = []
+    if after < up_to:
+        group_read.last_read_message_id = up_to
+        # quem mandou mensagens em (after, up_to] ganha um leitor em cada uma
+        senders = (
+            db.session.query(GroupMessage.sender_id)
+            .filter(
+                GroupMessage.group_id == target_id,
+                GroupMessage.id > after,
+                GroupMessage.id <= up_to,
+                GroupMessage.sender_id != reader_id,
+            )
+            .distinct()
         )
+        delta = {"group_id": target_id, "reader_id": reader_id, "after": after, "up_to": up_to}
+        deltas = [(int(sender_id), delta) for (sender_id,) in senders]
+    group_read.updated_at = datetime.utcnow()
+    db.session.add(group_read)
+
+    # a marca nunca volta: o que falta ler é o que vem depois dela
+    read_to = max(after, up_to)
+    if read_to >= last_id:
+        reset_unread(reader_id, "group", target_id)
+    else:
+        remaining = (
+            db.session.query(func.count(GroupMessage.id))
+            .filter(
+                GroupMessage.group_id == target_id,
+                GroupMessage.id > read_to,
+                GroupMessage.sender_id != reader_id,
+            )
+            .scalar()
+        )
+        set_unread(reader_id, "group", target_id, remaining)
+    db.session.commit()
+    return deltas
+
+
+def publish_group_read_deltas(deltas):
+    """Um frame "group_reads" por remetente com todos os deltas da janela."""
+    by_sender = {}
+    for sender_id, delta in deltas:
+        by_sender.setdefault(sender_id, []).append(delta)
+    if not by_sender:
         return
 
-    if conversation_type == "group":
-        gid = data.get("target_id")
-        if not gid:
-            return
-        try:
-            gid = int(gid)
-        except Exception:
-            return
+    logged = [
+        record_event("group_reads", {"reads": reads}, user_id=sender_id)
+        for sender_id, reads in sorted(by_sender.items())
+    ]
+    db.session.commit()
+    for event in logged:
+        emit_logged(event)
 
-        if not user_in_group(my_id, gid):
-            return
 
-        last_msg = (
-            GroupMessage.query.filter(GroupMessage.group_id == gid)
-            .order_by(GroupMessage.id.desc())
-            .first()
-        )
-        last_id = int(last_msg.id) if last_msg else None
+@socketio.on("mark_as_read")
+def mark_as_read(data):
+    if not isinstance(data, dict):
+        return
+    conversation_type = (data.get("conversation_type") or "user").strip().lower()
+    my_id = session.get("user_id")
+    if not my_id or conversation_type not in ("user", "group"):
+        return
 
-        group_read = get_or_create_group_read(gid, my_id)
-        group_read.last_read_message_id = last_id
-        group_read.updated_at = datetime.utcnow()
+    my_id = int(my_id)
+    try:
+        target_id = int(data.get("target_id"))
+    except Exception:
+        return
 
-        db.session.add(group_read)
-        db.session.commit()
+    # maior id que o cliente mostrou; sem ele, tudo até a última mensagem
+    try:
+        up_to = int(data["up_to"]) if data.get("up_to") is not None else None
+    except (TypeError, ValueError):
+        up_to = None
 
+    if conversation_type == "group" and not user_in_group(my_id, target_id):
+        return
 
-@socketio.on("typing")
-def on_typing(data):
-    target_id = data.get("target_id")
-    sender_id = session.get("user_id")
-    sender_name = session.get("username")
-    conversation_type = (data.get("conversation_type") or "user").strip().lower()
+    # o rate limit vale depois do merge: recibos repetidos não gastam ficha
+    if RECEIPT_WINDOW_SECONDS <= 0:
+        if receipt_admitted("mark_as_read"):
+            publish_group_read_deltas(apply_read_receipt(my_id, conversation_type, target_id, up_to) or [])
+        return
 
-    if not sender_id or not target_id:
+    admit = partial(receipt_admitted, "mark_as_read")
+    if read_receipts.request(my_id, conversation_type, target_id, up_to, admit=admit):
+        start_background_once(receipt_flush_loop)
+
+
+def apply_delivery_receipt(receiver_id, conversation_type, sender_id, up_to):
+    """
+    Avança a marca de entrega (receiver, sender) até `up_to`, limitada à
+    última mensagem que existe, e avisa o remetente se ela andou.
+    """
+    last_id = (
+        db.session.query(func.max(Message.id))
+        .filter(Message.sender_id == sender_id, Message.receiver_id == receiver_id)
+        .scalar()
+    )
+    if last_id is None:
+        return
+    up_to = min(int(up_to), int(last_id))
+
+    table = DeliveryWatermark.__table__
+    stmt = dialect_insert(table).values(
+        receiver_id=receiver_id,
+        sender_id=sender_id,
+        delivered_message_id=up_to,
+        updated_at=datetime.utcnow(),
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.receiver_id, table.c.sender_id],
+        set_={
+            "delivered_message_id": stmt.excluded.delivered_message_id,
+            "updated_at": stmt.excluded.updated_at,
+        },
+        where=table.c.delivered_message_id < stmt.excluded.delivered_message_id,
+    )
+    advanced = db.session.execute(stmt).rowcount
+
+    delivered = None
+    if advanced:
+        delivered = record_event(
+            "messages_delivered",
+            {"receiver_id": receiver_id, "up_to": up_to},
+            user_id=sender_id,
+        )
+    db.session.commit()
+
+    if delivered is not None:
+        emit_logged(delivered)
+
+
+@socketio.on("message_received")
+def on_message_received(data):
+    """Ack do cliente: mensagens privadas de `sender_id` até `up_to` chegaram."""
+    my_id = session.get("user_id")
+    if not my_id or not isinstance(data, dict):
         return
 
     try:
-        target_id = int(target_id)
-        sender_id = int(sender_id)
-    except Exception:
+        sender_id = int(data.get("sender_id"))
+        up_to = int(data.get("up_to"))
+    except (TypeError, ValueError):
         return
 
-    if conversation_type == "user":
-        emit(
-            "typing",
-            {
-                "sender_id": sender_id,
-                "sender_name": sender_name,
-                "conversation_type": "user",
-                "target_id": target_id,
-            },
-            room=str(target_id),
-        )
+    if RECEIPT_WINDOW_SECONDS <= 0:
+        if receipt_admitted("message_received"):
+            apply_delivery_receipt(int(my_id), "user", sender_id, up_to)
         return
 
-    if conversation_type == "group" and user_in_group(sender_id, target_id):
-        for member_id in get_group_members(target_id):
-            if int(member_id) == int(sender_id):
-                continue
-            emit(
-                "typing",
-                {
-                    "sender_id": sender_id,
-                    "sender_name": sender_name,
-                    "conversation_type": "group",
-                    "target_id": target_id,
-                },
-                room=str(member_id),
-            )
+    admit = partial(receipt_admitted, "message_received")
+    if delivery_receipts.request(int(my_id), "user", sender_id, up_to, admit=admit):
+        start_background_once(receipt_flush_loop)
 
 
-@socketio.on("stop_typing")
-def on_stop_typing(data):
+def typing_event_key(data):
+    """(remetente, tipo, alvo) de um evento de digitação válido, ou None."""
     target_id = data.get("target_id")
     sender_id = session.get("user_id")
     conversation_type = (data.get("conversation_type") or "user").strip().lower()
 
     if not sender_id or not target_id:
-        return
+        return None
 
     try:
         target_id = int(target_id)
         sender_id = int(sender_id)
     except Exception:
-        return
+        return None
 
     if conversation_type == "user":
-        emit(
-            "stop_typing",
-            {
-                "sender_id": sender_id,
-                "conversation_type": "user",
-                "target_id": target_id,
-            },
-            room=str(target_id),
-        )
+        return sender_id, "user", target_id
+    if conversation_type == "group" and user_in_group(sender_id, target_id):
+        return sender_id, "group", target_id
+    return None
+
+
+@socketio.on("typing")
+@rate_limited("typing")
+def on_typing(data):
+    key = typing_event_key(data)
+    if key is None:
         return
 
-    if conversation_type == "group" and user_in_group(sender_id, target_id):
-        for member_id in get_group_members(target_id):
-            if int(member_id) == int(sender_id):
-                continue
-            emit(
-                "stop_typing",
-                {
-                    "sender_id": sender_id,
-                    "conversation_type": "group",
-                    "target_id": target_id,
-                },
-                room=str(member_id),
-            )
+    start_background_once(typing_sweeper_loop)
+    if typing_coalescer.typing(key):
+        relay_typing_event("typing", key, sender_name=session.get("username"))
+
+
+@socketio.on("stop_typing")
+@rate_limited("stop_typing")
+def on_stop_typing(data):
+    key = typing_event_key(data)
+    if key is None:
+        return
+
+    typing_coalescer.stop(key)
 
 
 # ---------------- CHAMADAS 1-1 ----------------
 @socketio.on("call_offer")
+@rate_limited("call_offer")
 def on_call_offer(data):
     to = data.get("to")
     if not to:
@@ -1304,6 +2501,7 @@ def on_call_offer(data):
 
 
 @socketio.on("call_answer")
+@rate_limited("call_answer")
 def on_call_answer(data):
     to = data.get("to")
     if not to:
@@ -1312,6 +2510,7 @@ def on_call_answer(data):
 
 
 @socketio.on("ice_candidate")
+@rate_limited("ice_candidate")
 def on_ice_candidate(data):
     to = data.get("to")
     if not to:
@@ -1320,6 +2519,7 @@ def on_ice_candidate(data):
 
 
 @socketio.on("hangup")
+@rate_limited("hangup")
 def on_hangup(data):
     to = data.get("to")
     if not to:
@@ -1329,6 +2529,7 @@ def on_hangup(data):
 
 # ---------------- CHAMADAS EM GRUPO ----------------
 @socketio.on("invite_group_call")
+@rate_limited("invite_group_call")
 def invite_group_call(data):
     user_id = session.get("user_id")
     if not user_id:
@@ -1347,32 +2548,27 @@ def invite_group_call(data):
     if not user_in_group(user_id, group_id):
         return
 
-    caller = User.query.get(user_id)
     group = get_group_by_id(group_id)
     if not group:
         return
 
-    caller_name = (
-        caller.display_name if caller and caller.display_name
-        else caller.username if caller else "Usuário"
-    )
+    caller_name = profile_display_name(profile_cache.get(user_id))
 
-    for member_id in get_group_members(group_id):
-        if int(member_id) == int(user_id):
-            continue
-        socketio.emit(
-            "group_call_invite",
-            {
-                "group_id": group_id,
-                "group_name": group.name,
-                "from": user_id,
-                "from_name": caller_name,
-            },
-            room=str(member_id),
-        )
+    emit_to_group(
+        "group_call_invite",
+        {
+            "group_id": group_id,
+            "group_name": group.name,
+            "from": user_id,
+            "from_name": caller_name,
+        },
+        group_id,
+        skip_user_id=user_id,
+    )
 
 
 @socketio.on("join_group_call")
+@rate_limited("join_group_call")
 def join_group_call(data):
     user_id = session.get("user_id")
     if not user_id:
@@ -1394,15 +2590,9 @@ def join_group_call(data):
     room = group_room_name(group_id)
     join_room(room)
 
-    user = User.query.get(user_id)
-    user_name = (
-        user.display_name if user and user.display_name
-        else user.username if user else "Usuário"
-    )
+    user_name = profile_display_name(profile_cache.get(user_id))
 
-    with group_call_lock:
-        existing = list(active_group_calls[group_id])
-        active_group_calls[group_id].add(user_id)
+    existing = presence.join_call(group_id, user_id)
 
     emit(
         "group_call_participants",
@@ -1425,6 +2615,7 @@ def join_group_call(data):
 
 
 @socketio.on("leave_group_call")
+@rate_limited("leave_group_call")
 def leave_group_call(data):
     user_id = session.get("user_id")
     if not user_id:
@@ -1443,11 +2634,7 @@ def leave_group_call(data):
     room = group_room_name(group_id)
     leave_room(room)
 
-    with group_call_lock:
-        if group_id in active_group_calls and user_id in active_group_calls[group_id]:
-            active_group_calls[group_id].discard(user_id)
-            if not active_group_calls[group_id]:
-                active_group_calls.pop(group_id, None)
+    presence.leave_call(group_id, user_id)
 
     socketio.emit(
         "group_call_user_left",
@@ -1460,6 +2647,7 @@ def leave_group_call(data):
 
 
 @socketio.on("group_webrtc_offer")
+@rate_limited("group_webrtc_offer")
 def group_webrtc_offer(data):
     to = data.get("to")
     if not to:
@@ -1468,6 +2656,7 @@ def group_webrtc_offer(data):
 
 
 @socketio.on("group_webrtc_answer")
+@rate_limited("group_webrtc_answer")
 def group_webrtc_answer(data):
     to = data.get("to")
     if not to:
@@ -1476,6 +2665,7 @@ def group_webrtc_answer(data):
 
 
 @socketio.on("group_webrtc_ice")
+@rate_limited("group_webrtc_ice")
 def group_webrtc_ice(data):
     to = data.get("to")
     if not to:
@@ -1484,6 +2674,8 @@ def group_webrtc_ice(data):
 
 
 # ---------------- MAIN ----------------
+# Servidor de desenvolvimento. Em produção: gunicorn com o wsgi.py (ver Procfile).
 if __name__ == "__main__":
-    port = 5000
-    socketio.run(app, host="127.0.0.1", port=port)
\ No newline at end of file
+    host = os.environ.get("HOST", "127.0.0.1")
+    port = int(os.environ.get("PORT", "5000"))
+    socketio.run(app, host=host, port=port)
\ No newline at end of file
@@ -0,0 +1,323 @@
+import json
+import os
+import struct
+import zlib
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from sqlalchemy import case, func
+
+from models import db, Message, GroupMessage, GroupMember, GroupRead, UnreadCounter
+from search import unindex_message
+
+
+# ========================== ARQUIVO FRIO ==========================
+#
+# Mensagens antigas saem de messages/group_messages e vão para arquivos
+# de segmento por conversa, só de append:
+#
+#   <conversa>.seg  frames [tamanho u32][zlib(json com uma lista de mensagens)]
+#   <conversa>.idx  uma entrada fixa por frame: first_id, last_id, offset, tamanho
+#
+# O arquivo guarda sempre um prefixo contínuo de ids da conversa (o banco
+# fica com o resto), então o histórico paginado continua no arquivo quando
+# a tabela quente acaba. O frame é gravado e sincronizado antes de as linhas
+# saírem do banco; se o processo cair no meio, a próxima rodada pula os ids
+# que já estão no índice.
+
+INDEX_ENTRY = struct.Struct("<qqQI")
+FRAME_HEADER = struct.Struct("<I")
+
+ARCHIVED_FIELDS = (
+    "id",
+    "sender_id",
+    "text",
+    "kind",
+    "file_url",
+    "file_name",
+    "file_mime",
+    "edited",
+    "deleted",
+)
+
+
+def private_conversation_key(user_a, user_b):
+    low, high = sorted((int(user_a), int(user_b)))
+    return f"user_{low}_{high}"
+
+
+def group_conversation_key(group_id):
+    return f"group_{int(group_id)}"
+
+
+def message_to_record(message):
+    record = {name: getattr(message, name) for name in ARCHIVED_FIELDS}
+    record["created_at"] = message.created_at.isoformat() if message.created_at else None
+    if isinstance(message, Message):
+        record["receiver_id"] = message.receiver_id
+        record["seen"] = bool(message.seen)
+    else:
+        record["group_id"] = message.group_id
+    return record
+
+
+def record_to_message(record):
+    """Objeto com os mesmos atributos de Message/GroupMessage, para os build_*."""
+    data = dict(record)
+    if data.get("created_at"):
+        data["created_at"] = datetime.fromisoformat(data["created_at"])
+    return SimpleNamespace(**data)
+
+
+class MessageArchive:
+    def __init__(self, root):
+        self.root = root
+
+    def _paths(self, key):
+        base = os.path.join(self.root, key)
+        return base + ".seg", base + ".idx"
+
+    def read_index(self, key):
+        _, idx_path = self._paths(key)
+        if not os.path.exists(idx_path):
+            return []
+
+        with open(idx_path, "rb") as f:
+            raw = f.read()
+
+        # uma entrada parcial no fim (append interrompido) é ignorada
+        usable = len(raw) - len(raw) % INDEX_ENTRY.size
+        return [
+            INDEX_ENTRY.unpack_from(raw, offset)
+            for offset in range(0, usable, INDEX_ENTRY.size)
+        ]
+
+    def last_archived_id(self, key):
+        entries = self.read_index(key)
+        return entries[-1][1] if entries else 0
+
+    def append(self, key, records):
+        if not records:
+            return
+
+        os.makedirs(self.root, exist_ok=True)
+        seg_path, idx_path = self._paths(key)
+
+        body = zlib.compress(json.dumps(records, ensure_ascii=False).encode("utf-8"))
+        with open(seg_path, "ab") as seg:
+            offset = seg.seek(0, os.SEEK_END)
+            seg.write(FRAME_HEADER.pack(len(body)))
+            seg.write(body)
+            seg.flush()
+            os.fsync(seg.fileno())
+
+        entry = INDEX_ENTRY.pack(
+            int(records[0]["id"]),
+            int(records[-1]["id"]),
+            offset,
+            FRAME_HEADER.size + len(body),
+        )
+        with open(idx_path, "ab") as idx:
+            idx.write(entry)
+            idx.flush()
+            os.fsync(idx.fileno())
+
+    def _read_frame(self, seg, offset, length):
+        seg.seek(offset)
+        frame = seg.read(length)
+        (size,) = FRAME_HEADER.unpack_from(frame)
+        return json.loads(zlib.decompress(frame[FRAME_HEADER.size:FRAME_HEADER.size + size]))
+
+    def read_before(self, key, before_id=None, limit=50):
+        """
+        Até `limit` mensagens arquivadas com id < before_id, em ordem
+        crescente, e se ainda existem mais antigas.
+        """
+        entries = self.read_index(key)
+        if before_id is not None:
+            entries = [e for e in entries if e[0] < before_id]
+        if not entries or limit <= 0:
+            return [], bool(entries)
+
+        seg_path, _ = self._paths(key)
+        collected = []
+        with open(seg_path, "rb") as seg:
+            for position in range(len(entries) - 1, -1, -1):
+                _, _, offset, length = entries[position]
+                records = self._read_frame(seg, offset, length)
+                if before_id is not None:
+                    records = [r for r in records if int(r["id"]) < before_id]
+                collected = records + collected
+
+                if len(collected) > limit:
+                    return collected[-limit:], True
+                if len(collected) == limit:
+                    return collected, position > 0
+
+        return collected, False
+
+
+# -------- ARQUIVADOR --------
+def private_archive_boundaries(cutoff):
+    """Maior id antigo por par de usuários (as duas direções juntas)."""
+    rows = (
+        db.session.query(Message.sender_id, Message.receiver_id, func.max(Message.id))
+        .filter(Message.created_at < cutoff)
+        .group_by(Message.sender_id, Message.receiver_id)
+        .all()
+    )
+    boundaries = {}
+    for sender_id, receiver_id, last_id in rows:
+        pair = tuple(sorted((int(sender_id), int(receiver_id))))
+        boundaries[pair] = max(boundaries.get(pair, 0), int(last_id))
+    return boundaries
+
+
+def group_archive_boundaries(cutoff):
+    rows = (
+        db.session.query(GroupMessage.group_id, func.max(GroupMessage.id))
+        .filter(GroupMessage.created_at < cutoff)
+        .group_by(GroupMessage.group_id)
+        .all()
+    )
+    boundaries = {int(group_id): int(last_id) for group_id, last_id in rows}
+
+    # group_reads aponta (FK) para group_messages: o que ainda é marca de
+    # leitura de alguém fica no banco, e o arquivo para antes dele.
+    pinned = (
+        db.session.query(GroupRead.group_id, func.min(GroupRead.last_read_message_id))
+        .filter(GroupRead.last_read_message_id.isnot(None))
+        .group_by(GroupRead.group_id)
+        .all()
+    )
+    for group_id, min_read in pinned:
+        group_id = int(group_id)
+        if group_id in boundaries:
+            boundaries[group_id] = min(boundaries[group_id], int(min_read) - 1)
+
+    return boundaries
+
+
+def archived_unread(rows, conversation_type):
+    """Não lidas por (usuário, conversa) entre as linhas que vão para o arquivo."""
+    amounts = {}
+    if conversation_type == "user":
+        for m in rows:
+            if not m.seen:
+                key = (int(m.receiver_id), int(m.sender_id))
+                amounts[key] = amounts.get(key, 0) + 1
+        return amounts
+
+    # o lote é de um grupo só; a marca de leitura é a mesma que
+    # rebuild_unread_counters usa
+    group_id = int(rows[0].group_id)
+    watermarks = dict(
+        db.session.query(GroupRead.user_id, func.max(GroupRead.last_read_message_id))
+        .filter(GroupRead.group_id == group_id)
+        .group_by(GroupRead.user_id)
+        .all()
+    )
+    members = db.session.query(GroupMember.user_id).filter(GroupMember.group_id == group_id).all()
+    for (user_id,) in members:
+        last_read = watermarks.get(user_id) or 0
+        count = sum(1 for m in rows if m.id > last_read and m.sender_id != user_id)
+        if count:
+            amounts[(int(user_id), group_id)] = count
+    return amounts
+
+
+def discount_archived_unread(rows, conversation_type):
+    """
+    Tira dos contadores as não lidas que saem para o arquivo: lá elas não
+    passam mais pelo UPDATE de leitura e o badge ficaria preso.
+    """
+    for (user_id, target_id), amount in archived_unread(rows, conversation_type).items():
+        UnreadCounter.query.filter_by(
+            user_id=user_id,
+            conversation_type=conversation_type,
+            target_id=target_id,
+        ).update(
+            {
+                "unread_count": case(
+                    (UnreadCounter.unread_count > amount, UnreadCounter.unread_count - amount),
+                    else_=0,
+                )
+            },
+            synchronize_session=False,
+        )
+
+
+def delete_archived_rows(rows, conversation_type, search_enabled):
+    # no mesmo commit do delete: ou as linhas saem e o contador desce, ou nada muda
+    discount_archived_unread(rows, conversation_type)
+    for m in rows:
+        if search_enabled:
+            unindex_message(db.session, conversation_type, m.id)
+        db.session.delete(m)
+    db.session.commit()
+
+
+def archive_conversation(archive, key, query, id_column, conversation_type, boundary, batch_size, search_enabled):
+    moved = 0
+    last_id = archive.last_archived_id(key)
+
+    # linhas que sobraram de uma rodada interrompida já estão no arquivo
+    leftovers = query.filter(id_column <= last_id).all()
+    if leftovers:
+        delete_archived_rows(leftovers, conversation_type, search_enabled)
+
+    while True:
+        rows = (
+            query.filter(id_column > last_id, id_column <= boundary)
+            .order_by(id_column.asc())
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+
+        archive.append(key, [message_to_record(m) for m in rows])
+        last_id = int(rows[-1].id)
+        delete_archived_rows(rows, conversation_type, search_enabled)
+        moved += len(rows)
+
+    return moved
+
+
+def archive_old_messages(archive, older_than_days, batch_size=500, search_enabled=False, log=print):
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    moved = 0
+
+    for (user_a, user_b), boundary in private_archive_boundaries(cutoff).items():
+        query = Message.query.filter(
+            ((Message.sender_id == user_a) & (Message.receiver_id == user_b))
+            | ((Message.sender_id == user_b) & (Message.receiver_id == user_a))
+        )
+        moved += archive_conversation(
+            archive,
+            private_conversation_key(user_a, user_b),
+            query,
+            Message.id,
+            "user",
+            boundary,
+            batch_size,
+            search_enabled,
+        )
+
+    for group_id, boundary in group_archive_boundaries(cutoff).items():
+        if boundary <= 0:
+            continue
+        moved += archive_conversation(
+            archive,
+            group_conversation_key(group_id),
+            GroupMessage.query.filter(GroupMessage.group_id == group_id),
+            GroupMessage.id,
+            "group",
+            boundary,
+            batch_size,
+            search_enabled,
+        )
+
+    if log:
+        log(f"[archive] {moved} mensagens movidas para {archive.root}")
+    return moved
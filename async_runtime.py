@@ -0,0 +1,78 @@
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+# ========================== MODO ASSÍNCRONO ==========================
+#
+# SOCKETIO_ASYNC_MODE escolhe o servidor do Socket.IO:
+#
+#   threading  (padrão) uma thread do SO por conexão; bom para desenvolver
+#   eventlet   green threads; produção com `gunicorn -k eventlet wsgi:app`
+#   gevent     idem, com `gunicorn -k gevent wsgi:app` (requer gevent)
+#
+# Em eventlet/gevent o monkey patch precisa acontecer antes de qualquer
+# outro import (socket, threading, ssl, queue...), por isso o wsgi.py chama
+# `monkey_patch()` na primeira linha. Chamadas que bloqueiam o processo
+# inteiro sem passar pelo hub (gravação de arquivo, leitura do arquivo
+# frio) vão para um pool de threads do SO via `run_blocking`.
+
+ASYNC_MODES = ("threading", "eventlet", "gevent")
+
+ASYNC_MODE = os.environ.get("SOCKETIO_ASYNC_MODE", "threading").strip().lower()
+if ASYNC_MODE not in ASYNC_MODES:
+    ASYNC_MODE = "threading"
+
+_patched = False
+
+
+def monkey_patch():
+    """Aplica o monkey patch do modo configurado (só uma vez)."""
+    global _patched
+    if _patched or ASYNC_MODE == "threading":
+        return
+    _patched = True
+
+    if ASYNC_MODE == "eventlet":
+        import eventlet
+
+        eventlet.monkey_patch()
+    else:
+        from gevent import monkey
+
+        monkey.patch_all()
+
+    patch_database_driver()
+
+
+def patch_database_driver():
+    """
+    psycopg2 é C puro: sem o psycogreen cada query bloquearia todas as green
+    threads do worker. SQLite não tem equivalente; com WAL as transações são
+    curtas e o busy_timeout cobre a espera pelo escritor.
+    """
+    if not os.environ.get("DATABASE_URL", "").startswith(("postgres://", "postgresql://")):
+        return
+    try:
+        if ASYNC_MODE == "eventlet":
+            from psycogreen.eventlet import patch_psycopg
+        else:
+            from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        logger.warning("psycogreen não instalado: queries PostgreSQL vão bloquear o worker %s", ASYNC_MODE)
+        return
+    patch_psycopg()
+
+
+def run_blocking(func, *args, **kwargs):
+    """Executa I/O de disco numa thread do SO quando o servidor é cooperativo."""
+    if ASYNC_MODE == "eventlet" and _patched:
+        from eventlet import tpool
+
+        return tpool.execute(func, *args, **kwargs)
+    if ASYNC_MODE == "gevent" and _patched:
+        from gevent import get_hub
+
+        return get_hub().threadpool.apply(func, args, kwargs)
+    return func(*args, **kwargs)
@@ -0,0 +1,290 @@
+import logging
+import time
+from threading import Lock
+
+import socketio
+from engineio import packet as eio_packet
+from socketio import packet
+
+from wire_format import COMPACT_EVENTS, wire_event
+
+
+logger = logging.getLogger(__name__)
+
+
+# ========================== BACKPRESSURE ==========================
+#
+# Cada socket do Engine.IO tem uma fila de saída sem limite: um cliente que
+# para de ler (rede móvel ruim, aba congelada) faz essa fila crescer a cada
+# mensagem de grupo. O BackpressureManager substitui o emit do gerenciador
+# do Socket.IO e olha a profundidade da fila de cada destinatário antes de
+# entregar:
+#
+#   abaixo de soft_limit   entrega normal
+#   acima de soft_limit    descarta eventos efêmeros (digitação, presença),
+#                          junta recibos de leitura pendentes num só e
+#                          desconecta se ficar acima por hwm_seconds
+#   acima de hard_limit    descarta o pacote e desconecta na hora
+#
+# Mensagens estão no banco: o cliente desconectado reconecta e recarrega.
+#
+# É também aqui que cada socket recebe o pacote no formato que negociou no
+# join (ver wire_format.py): cada formato é serializado uma vez por emit.
+
+DROPPABLE_EVENTS = frozenset({"typing", "stop_typing", "presence_diff"})
+COALESCED_EVENTS = frozenset({"messages_read"})
+
+
+class BackpressureManager(socketio.Manager):
+    soft_limit = 200
+    hard_limit = 1000
+    hwm_seconds = 10.0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._bp_lock = Lock()
+        self._over_since = {}
+        self._held = {}
+        self._closing = set()
+        self._wire_formats = {}
+        self.bp_counters = {
+            "dropped": 0,
+            "coalesced": 0,
+            "held_flushed": 0,
+            "disconnected": 0,
+        }
+
+    def configure_backpressure(self, soft_limit=None, hard_limit=None, hwm_seconds=None):
+        if soft_limit is not None:
+            self.soft_limit = soft_limit
+        if hard_limit is not None:
+            self.hard_limit = hard_limit
+        if hwm_seconds is not None:
+            self.hwm_seconds = hwm_seconds
+
+    def set_wire_format(self, sid, wire_format):
+        with self._bp_lock:
+            if wire_format == "json":
+                self._wire_formats.pop(sid, None)
+            else:
+                self._wire_formats[sid] = wire_format
+
+    # -------- PROFUNDIDADE --------
+    def queue_depth(self, eio_sid):
+        eio_socket = self.server.eio.sockets.get(eio_sid)
+        if eio_socket is None:
+            return 0
+        return eio_socket.queue.qsize()
+
+    # -------- EMIT --------
+    def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        if callback:
+            return super().emit(
+                event, data, namespace, room=room, skip_sid=skip_sid, callback=callback, to=to, **kwargs
+            )
+
+        room = to or room
+        if namespace not in self.rooms:
+            return
+        if not isinstance(skip_sid, list):
+            skip_sid = [skip_sid]
+
+        args = list(data) if isinstance(data, tuple) else ([data] if data is not None else [])
+        encoded = {}
+        compactable = event in COMPACT_EVENTS and isinstance(data, dict)
+
+        for sid, eio_sid in self.get_participants(namespace, room):
+            if sid in skip_sid:
+                continue
+            if not self._admit(sid, eio_sid, namespace, event, data):
+                continue
+            wire_format = self._wire_formats.get(sid, "json") if compactable else "json"
+            if wire_format not in encoded:
+                if wire_format == "json":
+                    encoded[wire_format] = self._encode(namespace, event, args)
+                else:
+                    encoded[wire_format] = self._encode(namespace, *wire_event(wire_format, event, data))
+            for pkt in encoded[wire_format]:
+                self.server._send_eio_packet(eio_sid, pkt)
+
+    def _encode(self, namespace, event, args):
+        pkt = self.server.packet_class(packet.EVENT, namespace=namespace, data=[event] + args)
+        encoded = pkt.encode()
+        if not isinstance(encoded, list):
+            encoded = [encoded]
+        return [eio_packet.Packet(eio_packet.MESSAGE, p) for p in encoded]
+
+    def _admit(self, sid, eio_sid, namespace, event, data):
+        """Decide se o pacote vai agora para a fila do socket."""
+        depth = self.queue_depth(eio_sid)
+
+        if depth < self.soft_limit:
+            with self._bp_lock:
+                self._over_since.pop(sid, None)
+                held = self._held.pop(sid, None)
+            if held:
+                self._flush_held(sid, eio_sid, namespace, held)
+            return True
+
+        now = time.monotonic()
+        with self._bp_lock:
+            since = self._over_since.setdefault(sid, now)
+
+        if depth >= self.hard_limit or now - since >= self.hwm_seconds:
+            self._drop()
+            self._disconnect_slow(sid, namespace, depth)
+            return False
+
+        if event in DROPPABLE_EVENTS:
+            self._drop()
+            return False
+
+        if event in COALESCED_EVENTS and isinstance(data, dict):
+            self._hold(sid, event, data)
+            return False
+
+        return True
+
+    def _drop(self):
+        with self._bp_lock:
+            self.bp_counters["dropped"] += 1
+
+    # -------- RECIBOS AGRUPADOS --------
+    def _hold(self, sid, event, data):
+        """Junta recibos do mesmo leitor: um só pacote com o maior id lido."""
+        key = (event, data.get("reader_id"))
+        with self._bp_lock:
+            held = self._held.setdefault(sid, {})
+            pending = held.get(key)
+            if pending is None:
+                held[key] = dict(data)
+                return
+            pending.update(data, up_to=max(pending.get("up_to") or 0, data.get("up_to") or 0))
+            self.bp_counters["coalesced"] += 1
+
+    def _flush_held(self, sid, eio_sid, namespace, held):
+        for (event, _), data in held.items():
+            for pkt in self._encode(namespace, event, [data]):
+                self.server._send_eio_packet(eio_sid, pkt)
+        with self._bp_lock:
+            self.bp_counters["held_flushed"] += len(held)
+
+    def release_held(self, namespace="/"):
+        """Entrega os recibos retidos de sockets cuja fila já esvaziou."""
+        with self._bp_lock:
+            sids = list(self._held)
+
+        for sid in sids:
+            eio_sid = self.eio_sid_from_sid(sid, namespace)
+            if eio_sid is None or self.queue_depth(eio_sid) >= self.soft_limit:
+                continue
+            with self._bp_lock:
+                held = self._held.pop(sid, None)
+                self._over_since.pop(sid, None)
+            if held:
+                self._flush_held(sid, eio_sid, namespace, held)
+
+    # -------- DESCONEXÃO --------
+    def _disconnect_slow(self, sid, namespace, depth):
+        with self._bp_lock:
+            if sid in self._closing:
+                return
+            self._closing.add(sid)
+            self.bp_counters["disconnected"] += 1
+
+        logger.warning("Desconectando consumidor lento %s (fila com %d pacotes)", sid, depth)
+        # fora do emit: o disconnect mexe nas salas que estamos percorrendo
+        self.server.start_background_task(self.server.disconnect, sid, namespace=namespace)
+
+    def forget(self, sid):
+        with self._bp_lock:
+            self._over_since.pop(sid, None)
+            self._held.pop(sid, None)
+            self._closing.discard(sid)
+            self._wire_formats.pop(sid, None)
+
+    # -------- MÉTRICAS --------
+    def backpressure_stats(self, top=5):
+        depths = []
+        for sid, eio_sid in self.get_participants("/", None):
+            depths.append((self.queue_depth(eio_sid), sid))
+        depths.sort(reverse=True)
+
+        with self._bp_lock:
+            counters = dict(
+                self.bp_counters,
+                over_soft_limit=len(self._over_since),
+                compact_sockets=len(self._wire_formats),
+            )
+        return dict(
+            counters,
+            sockets=len(depths),
+            total_depth=sum(d for d, _ in depths),
+            max_depth=depths[0][0] if depths else 0,
+            deepest=[{"sid": sid, "depth": d} for d, sid in depths[:top] if d],
+            soft_limit=self.soft_limit,
+            hard_limit=self.hard_limit,
+        )
+
+
+def backpressure_client_manager(message_queue=None, channel="flask-socketio"):
+    """
+    Gerenciador com backpressure, local ou por cima da fila de mensagens.
+    Com fila, a entrega local (recebida do Redis) passa pelo emit acima.
+    """
+    if not message_queue:
+        return BackpressureManager()
+
+    if message_queue.startswith(("redis://", "rediss://")):
+        queue_class = socketio.RedisManager
+    elif message_queue.startswith("kafka://"):
+        queue_class = socketio.KafkaManager
+    elif message_queue.startswith("zmq"):
+        queue_class = socketio.ZmqManager
+    else:
+        queue_class = socketio.KombuManager
+
+    composed = type("Backpressure" + queue_class.__name__, (queue_class, BackpressureManager), {})
+    return composed(message_queue, channel=channel)
+
+
+# -------- BENCHMARK --------
+def benchmark_group_fanout(payload, members=1000, rounds=50, event="receive_message"):
+    """
+    ms por evento de grupo com `members` sockets: um emit por membro (sala
+    pessoal) x um emit para a sala do grupo. O transporte é substituído por
+    um contador, então mede só codificação e roteamento no servidor.
+    """
+    server = socketio.Server(client_manager=BackpressureManager(), async_mode="threading")
+    sent = [0]
+
+    def count_packet(eio_sid, pkt):
+        sent[0] += 1
+
+    server._send_eio_packet = count_packet
+    manager = server.manager
+    sids = []
+    for uid in range(1, members + 1):
+        sid = manager.connect(f"bench-eio-{uid}", "/")
+        manager.enter_room(sid, "/", str(uid))
+        manager.enter_room(sid, "/", "group_bench")
+        sids.append(sid)
+
+    def per_member():
+        for uid in range(2, members + 1):
+            server.emit(event, payload, room=str(uid))
+
+    def per_room():
+        server.emit(event, payload, room="group_bench", skip_sid=[sids[0]])
+
+    results = {}
+    for name, fan_out in (("per_member", per_member), ("room", per_room)):
+        sent[0] = 0
+        started = time.perf_counter()
+        for _ in range(rounds):
+            fan_out()
+        results[name] = {
+            "ms_per_event": (time.perf_counter() - started) / rounds * 1000,
+            "packets_per_event": sent[0] / rounds,
+        }
+    return results
@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+# ========================== INVALIDAÇÃO ENTRE WORKERS ==========================
+#
+# MembershipCache e ProfileCache ficam na memória de cada worker. Quem grava
+# (entrada/saída de grupo, edição de perfil) invalida o próprio cache, mas os
+# outros workers só veriam a mudança quando o TTL vencesse. Com
+# CACHE_INVALIDATION_URL=redis://... a invalidação também sai num canal
+# pub/sub e cada worker aplica no seu cache. O TTL continua valendo como
+# rede de segurança (worker que perdeu mensagens enquanto reconectava).
+
+
+class LocalInvalidationBus:
+    """Um worker só: a invalidação é aplicada direto no cache local."""
+
+    shared = False
+
+    def __init__(self):
+        self._caches = {}
+
+    def register(self, name, invalidate, clear=None):
+        """`invalidate(key)` é chamado para cada chave publicada em `name`."""
+        self._caches[name] = (invalidate, clear)
+
+    def publish(self, name, key):
+        invalidate, _ = self._caches[name]
+        invalidate(key)
+
+    def clear_all(self):
+        for _, clear in self._caches.values():
+            if clear is not None:
+                clear()
+
+
+class RedisInvalidationBus(LocalInvalidationBus):
+    """Invalidação local e num canal do Redis que os outros workers escutam."""
+
+    shared = True
+
+    def __init__(self, url, channel="chat:cache-invalidation", retry_seconds=1):
+        try:
+            import redis
+        except ImportError as exc:  # pragma: no cover - depende do ambiente
+            raise RuntimeError("CACHE_INVALIDATION_URL=redis://... requer o pacote redis") from exc
+
+        super().__init__()
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.channel = channel
+        self.retry_seconds = retry_seconds
+        self.worker_id = uuid.uuid4().hex
+
+    def publish(self, name, key):
+        super().publish(name, key)
+        message = json.dumps({"cache": name, "key": key, "origin": self.worker_id})
+        try:
+            self.redis.publish(self.channel, message)
+        except Exception:
+            # os outros workers ainda veem a mudança quando o TTL vencer
+            logger.exception("Falha ao publicar invalidação de %s:%s", name, key)
+
+    def listen(self, sleep=time.sleep):
+        """Loop do worker: aplica as invalidações publicadas pelos outros."""
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # o que mudou enquanto não escutávamos se perdeu
+                self.clear_all()
+                for message in pubsub.listen():
+                    self._apply(message.get("data"))
+            except Exception:
+                logger.exception("Canal de invalidação de cache caiu; reconectando")
+                sleep(self.retry_seconds)
+
+    def _apply(self, raw):
+        try:
+            message = json.loads(raw)
+        except (TypeError, ValueError):
+            return
+        if message.get("origin") == self.worker_id:
+            return
+        cache = self._caches.get(message.get("cache"))
+        if cache is not None:
+            cache[0](message.get("key"))
+
+
+def invalidation_bus_from_env():
+    url = os.environ.get("CACHE_INVALIDATION_URL", "").strip()
+    if not url or url.startswith("memory"):
+        return LocalInvalidationBus()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisInvalidationBus(
+            url,
+            channel=os.environ.get("CACHE_INVALIDATION_CHANNEL", "chat:cache-invalidation"),
+        )
+    raise RuntimeError(f"CACHE_INVALIDATION_URL não suportada: {url}")
@@ -0,0 +1,130 @@
+import json
+import time
+from types import SimpleNamespace
+
+
+# Envelope antigo: antes das colunas kind/file_*/edited/deleted, o conteúdo
+# inteiro da mensagem ia serializado em `text` atrás deste prefixo. Só a
+# migração de dados ainda lê esse formato.
+CHAT_JSON_PREFIX = "__CHATJSON__::"
+
+FILE_KINDS = {"file", "image", "audio"}
+
+
+def media_flags(kind, file_mime):
+    mime = file_mime or ""
+    is_image = kind == "image" or mime.startswith("image/")
+    is_audio = kind == "audio" or mime.startswith("audio/")
+    return is_image, is_audio
+
+
+def message_fields(message):
+    """Campos de conteúdo de uma Message/GroupMessage (ou linha equivalente)."""
+    kind = message.kind or "text"
+    is_image, is_audio = media_flags(kind, message.file_mime)
+    return {
+        "kind": kind,
+        "text": message.text or "",
+        "file_url": message.file_url,
+        "file_name": message.file_name,
+        "file_mime": message.file_mime,
+        "edited": bool(message.edited),
+        "deleted": bool(message.deleted),
+        "is_image": is_image,
+        "is_audio": is_audio,
+    }
+
+
+def preview_from_fields(fields):
+    if fields["deleted"]:
+        return "Mensagem apagada"
+    if fields["is_audio"]:
+        return "🎵 Áudio"
+    if fields["is_image"]:
+        return "📷 Imagem"
+    if fields["kind"] == "file":
+        return f"📎 {fields['file_name'] or 'Arquivo'}"
+    return fields["text"] or ""
+
+
+def preview_from_message(message):
+    return preview_from_fields(message_fields(message))
+
+
+def parse_legacy_payload(raw_text: str):
+    """Lê o envelope __CHATJSON__ antigo; texto puro vira uma mensagem de texto."""
+    fields = {
+        "kind": "text",
+        "text": raw_text or "",
+        "file_url": None,
+        "file_name": None,
+        "file_mime": None,
+        "edited": False,
+        "deleted": False,
+    }
+
+    if isinstance(raw_text, str) and raw_text.startswith(CHAT_JSON_PREFIX):
+        try:
+            payload = json.loads(raw_text[len(CHAT_JSON_PREFIX):])
+            fields = {
+                "kind": payload.get("kind") or "text",
+                "text": payload.get("text") or "",
+                "file_url": payload.get("file_url"),
+                "file_name": payload.get("file_name"),
+                "file_mime": payload.get("file_mime"),
+                "edited": bool(payload.get("edited")),
+                "deleted": bool(payload.get("deleted")),
+            }
+        except Exception:
+            pass
+
+    fields["is_image"], fields["is_audio"] = media_flags(fields["kind"], fields["file_mime"])
+    return fields
+
+
+# -------- BENCHMARK --------
+def sample_content_rows(count=10000):
+    """`count` linhas típicas (texto, editada, imagem, arquivo, apagada) em colunas."""
+    samples = [
+        {"kind": "text", "text": "oi, tudo bem?"},
+        {"kind": "text", "text": "Chego em 10 minutos, pode ir pedindo o café", "edited": True},
+        {
+            "kind": "image",
+            "file_url": "/static/chat_uploads/3f9c1d2e4b5a6c7d8e9f0a1b2c3d4e5f.jpg",
+            "file_name": "foto.jpg",
+            "file_mime": "image/jpeg",
+        },
+        {
+            "kind": "file",
+            "file_url": "/static/chat_uploads/0a1b2c3d4e5f60718293a4b5c6d7e8f9.pdf",
+            "file_name": "relatorio-trimestral.pdf",
+            "file_mime": "application/pdf",
+        },
+        {"kind": "text", "text": "", "deleted": True},
+    ]
+    empty = {"text": "", "file_url": None, "file_name": None, "file_mime": None,
+             "edited": False, "deleted": False}
+    return [SimpleNamespace(**dict(empty, **samples[i % len(samples)])) for i in range(count)]
+
+
+def benchmark_content_fields(count=10000, rounds=5):
+    """
+    ms para montar os campos de conteúdo de `count` mensagens lendo o
+    envelope __CHATJSON__ antigo e lendo as colunas (melhor de `rounds`).
+    """
+    rows = sample_content_rows(count)
+    envelopes = [CHAT_JSON_PREFIX + json.dumps(vars(row)) for row in rows]
+
+    def best(fn, items):
+        times = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            for item in items:
+                fn(item)
+            times.append(time.perf_counter() - started)
+        return min(times) * 1000
+
+    return {
+        "envelope_ms": best(parse_legacy_payload, envelopes),
+        "columns_ms": best(message_fields, rows),
+    }
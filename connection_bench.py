@@ -0,0 +1,165 @@
+import base64
+import os
+import selectors
+import socket
+import struct
+import time
+
+
+# ========================== BENCH DE CONEXÕES ==========================
+#
+# Abre N conexões Socket.IO ociosas (WebSocket direto, sem long-polling)
+# contra um servidor rodando e as mantém vivas respondendo aos pings do
+# Engine.IO. Tudo numa thread só com selectors, para que o lado cliente não
+# seja o gargalo. Com o pid do worker, mede o RSS antes/depois e estima a
+# memória por conexão ociosa.
+
+WS_PATH = "/socket.io/?EIO=4&transport=websocket"
+
+
+def read_rss_kb(pid):
+    try:
+        with open(f"/proc/{int(pid)}/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def encode_frame(text):
+    """Frame de texto mascarado (obrigatório do cliente para o servidor)."""
+    payload = text.encode("utf-8")
+    mask = os.urandom(4)
+    header = bytes([0x81])
+    if len(payload) < 126:
+        header += bytes([0x80 | len(payload)])
+    else:
+        header += bytes([0x80 | 126]) + struct.pack("!H", len(payload))
+    masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return header + mask + masked
+
+
+def decode_frames(buffer):
+    """Extrai os frames completos de `buffer`; devolve (textos, resto)."""
+    texts = []
+    while len(buffer) >= 2:
+        length = buffer[1] & 0x7F
+        offset = 2
+        if length == 126:
+            if len(buffer) < 4:
+                break
+            (length,) = struct.unpack_from("!H", buffer, 2)
+            offset = 4
+        elif length == 127:
+            if len(buffer) < 10:
+                break
+            (length,) = struct.unpack_from("!Q", buffer, 2)
+            offset = 10
+        if len(buffer) < offset + length:
+            break
+        if buffer[0] & 0x0F == 0x1:
+            texts.append(buffer[offset:offset + length].decode("utf-8", "replace"))
+        buffer = buffer[offset + length:]
+    return texts, buffer
+
+
+def open_connection(host, port, timeout=10):
+    sock = socket.create_connection((host, port), timeout=timeout)
+    key = base64.b64encode(os.urandom(16)).decode("ascii")
+    sock.sendall(
+        (
+            f"GET {WS_PATH} HTTP/1.1\r\n"
+            f"Host: {host}:{port}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n"
+        ).encode("ascii")
+    )
+
+    response = b""
+    while b"\r\n\r\n" not in response:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError("conexão fechada no handshake")
+        response += chunk
+    head, _, rest = response.partition(b"\r\n\r\n")
+    if b" 101 " not in head.split(b"\r\n", 1)[0]:
+        raise ConnectionError(head.split(b"\r\n", 1)[0].decode("latin-1"))
+
+    # "0{...}" (open do Engine.IO) e então o CONNECT do Socket.IO
+    sock.sendall(encode_frame("40"))
+    sock.setblocking(False)
+    return sock, rest
+
+
+def run_connection_bench(host, port, count, hold_seconds=30, pid=None, log=print):
+    """
+    Abre até `count` conexões e as segura por `hold_seconds`. Devolve um
+    dict com quantas abriram, quantas sobreviveram e a memória do worker.
+    """
+    selector = selectors.DefaultSelector()
+    buffers = {}
+    rss_before = read_rss_kb(pid) if pid else None
+    failures = 0
+    first_error = None
+
+    started = time.monotonic()
+    for i in range(count):
+        try:
+            sock, rest = open_connection(host, port)
+        except OSError as exc:
+            failures += 1
+            first_error = first_error or repr(exc)
+            if failures >= 20:
+                log(f"[bench] parando em {i} conexões: {first_error}")
+                break
+            continue
+        buffers[sock] = rest
+        selector.register(sock, selectors.EVENT_READ)
+        if (i + 1) % 1000 == 0:
+            log(f"[bench] {i + 1} conexões abertas")
+    opened = len(buffers)
+    connect_seconds = time.monotonic() - started
+
+    deadline = time.monotonic() + hold_seconds
+    while buffers and time.monotonic() < deadline:
+        for key, _ in selector.select(timeout=1):
+            sock = key.fileobj
+            try:
+                chunk = sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                continue
+            except OSError:
+                chunk = b""
+            if not chunk:
+                selector.unregister(sock)
+                buffers.pop(sock, None)
+                sock.close()
+                continue
+
+            texts, buffers[sock] = decode_frames(buffers[sock] + chunk)
+            for packet in texts:
+                if packet == "2":
+                    sock.sendall(encode_frame("3"))
+
+    rss_after = read_rss_kb(pid) if pid else None
+    alive = len(buffers)
+    for sock in list(buffers):
+        selector.unregister(sock)
+        sock.close()
+
+    result = {
+        "requested": count,
+        "opened": opened,
+        "alive": alive,
+        "connect_seconds": round(connect_seconds, 2),
+        "first_error": first_error,
+    }
+    if rss_before is not None and rss_after is not None:
+        result["rss_before_kb"] = rss_before
+        result["rss_after_kb"] = rss_after
+        result["kb_per_connection"] = round((rss_after - rss_before) / max(alive, 1), 1)
+    return result
@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import NullPool
+
+
+# ========================== ENGINE ==========================
+#
+# SQLite (padrão) roda em WAL para que leituras não bloqueiem o escritor e
+# os commits concorrentes do modo threading esperem o lock em vez de falhar
+# com "database is locked". Com DATABASE_URL apontando para PostgreSQL, o
+# mesmo app usa um pool de conexões configurável (requer o driver psycopg2).
+
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    "mmap_size": int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+}
+
+
+def database_url(base_dir):
+    url = os.environ.get("DATABASE_URL")
+    if not url:
+        return f"sqlite:///{os.path.join(base_dir, 'database.db')}"
+
+    # Heroku e afins ainda exportam o esquema antigo "postgres://"
+    if url.startswith("postgres://"):
+        url = "postgresql://" + url[len("postgres://"):]
+    return url
+
+
+def engine_options(url):
+    if url.startswith("sqlite"):
+        return {
+            "connect_args": {
+                "timeout": SQLITE_PRAGMAS["busy_timeout"] / 1000,
+                "check_same_thread": False,
+            },
+        }
+
+    return {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", "10")),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", "20")),
+        "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", "1800")),
+        "pool_pre_ping": True,
+    }
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record=None):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+
+def configure_database(app, base_dir):
+    url = database_url(base_dir)
+    app.config["SQLALCHEMY_DATABASE_URI"] = url
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(url)
+    return url
+
+
+def install_engine_hooks(engine):
+    """Registra os PRAGMAs em toda conexão nova do pool (só SQLite)."""
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", apply_sqlite_pragmas)
+
+
+# -------- BENCHMARK --------
+def bench_engine(url, tuned):
+    """Engine de `url` com as opções do app (`tuned`) ou com os padrões."""
+    if tuned:
+        engine = create_engine(url, **engine_options(url))
+        install_engine_hooks(engine)
+        return engine
+    if url.startswith("sqlite"):
+        # padrões do sqlite3: journal DELETE, synchronous FULL, sem mmap
+        return create_engine(url, connect_args={"check_same_thread": False})
+    # sem pool: uma conexão nova por operação
+    return create_engine(url, poolclass=NullPool)
+
+
+def benchmark_engine(engine, readers=4, writers=8, operations=300):
+    """
+    `writers` threads fazem `operations` commits de uma linha cada enquanto
+    `readers` threads leem a tabela no mesmo ritmo. Devolve escritas/s,
+    leituras/s e quantas operações falharam (ex.: "database is locked").
+    """
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS bench_engine_rows"))
+        conn.execute(text("CREATE TABLE bench_engine_rows (id INTEGER PRIMARY KEY, body VARCHAR(40))"))
+
+    counts = {"writes": 0, "reads": 0, "errors": 0}
+    lock = threading.Lock()
+
+    def work(write):
+        done = errors = 0
+        for i in range(operations):
+            try:
+                if write:
+                    with engine.begin() as conn:
+                        conn.execute(text("INSERT INTO bench_engine_rows (body) VALUES (:body)"), {"body": f"row {i}"})
+                else:
+                    with engine.connect() as conn:
+                        conn.execute(text("SELECT count(*) FROM bench_engine_rows")).scalar()
+                done += 1
+            except Exception:
+                errors += 1
+        with lock:
+            counts["writes" if write else "reads"] += done
+            counts["errors"] += errors
+
+    threads = [threading.Thread(target=work, args=(True,)) for _ in range(writers)]
+    threads += [threading.Thread(target=work, args=(False,)) for _ in range(readers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS bench_engine_rows"))
+    engine.dispose()
+
+    return {
+        "writes_per_second": counts["writes"] / elapsed,
+        "reads_per_second": counts["reads"] / elapsed,
+        "errors": counts["errors"],
+    }
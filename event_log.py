@@ -0,0 +1,146 @@
+import bisect
+import json
+from collections import namedtuple
+from datetime import datetime, timedelta
+from threading import Lock
+
+from sqlalchemy import func, or_, and_
+
+from models import db, EventLog
+
+
+# ========================== LOG DE EVENTOS ==========================
+#
+# Eventos que mudam o estado do cliente (mensagem recebida, editada,
+# apagada, lida; grupo criado) são gravados em event_log na mesma transação
+# da mudança e saem com "seq" = id da linha. O cliente guarda o maior seq
+# que viu e manda no `join` ao reconectar; o servidor devolve só o que veio
+# depois, em vez de o cliente recarregar históricos inteiros.
+#
+# Os eventos recentes ficam também num anel em memória (EventRing): com um
+# worker só, o replay de quem caiu há pouco nem consulta o banco. Se o
+# cliente ficou fora além do que o banco ainda guarda (prune-events) ou
+# perdeu eventos demais, a resposta é "resync" e ele recarrega tudo.
+
+LoggedEvent = namedtuple("LoggedEvent", "seq event payload user_id group_id exclude_user_id")
+
+
+def record_event(event, payload, user_id=None, group_id=None, exclude_user_id=None):
+    """Grava o evento na transação atual; o seq sai do flush."""
+    row = EventLog(
+        user_id=user_id,
+        group_id=group_id,
+        exclude_user_id=exclude_user_id,
+        event=event,
+        payload=json.dumps(payload, separators=(",", ":")),
+        created_at=datetime.utcnow(),
+    )
+    db.session.add(row)
+    db.session.flush()
+
+    seq = int(row.id)
+    return LoggedEvent(seq, event, dict(payload, seq=seq), user_id, group_id, exclude_user_id)
+
+
+def visible_to(logged, user_id, group_ids):
+    if logged.user_id is not None:
+        return logged.user_id == user_id
+    return logged.group_id in group_ids and logged.exclude_user_id != user_id
+
+
+class EventRing:
+    """
+    Últimos `size` eventos entregues por este processo, em ordem de seq.
+    `floor` é o maior seq que o anel já não tem (descartado ou anterior ao
+    início do processo): quem pede a partir de um seq menor vai ao banco.
+    """
+
+    def __init__(self, size=5000, floor=0):
+        self.size = size
+        self.floor = floor
+        self._events = []
+        self._lock = Lock()
+        self.counters = {"hits": 0, "misses": 0}
+
+    def append(self, logged):
+        with self._lock:
+            # commits concorrentes podem anunciar fora de ordem
+            bisect.insort(self._events, logged)
+            excess = len(self._events) - self.size
+            if excess > self.size // 4:
+                self.floor = max(self.floor, self._events[excess - 1].seq)
+                del self._events[:excess]
+
+    def head(self):
+        with self._lock:
+            return self._events[-1].seq if self._events else self.floor
+
+    def since(self, last_seq, user_id, group_ids, limit):
+        """Eventos do usuário depois de `last_seq`, ou None se o anel não cobre."""
+        with self._lock:
+            if last_seq < self.floor:
+                self.counters["misses"] += 1
+                return None
+            self.counters["hits"] += 1
+            start = bisect.bisect_right(self._events, (last_seq + 1,)) if self._events else 0
+            found = []
+            for logged in self._events[start:]:
+                if visible_to(logged, user_id, group_ids):
+                    found.append(logged)
+                    if len(found) > limit:
+                        break
+            return found
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, size=len(self._events), floor=self.floor)
+
+
+def event_log_head():
+    return int(db.session.query(func.max(EventLog.id)).scalar() or 0)
+
+
+def load_events_since(user_id, group_ids, last_seq, limit):
+    """
+    Mesma consulta do anel no banco (índices (user_id, id) e (group_id, id)).
+    Devolve None se os eventos depois de `last_seq` já foram apagados.
+    """
+    oldest = db.session.query(func.min(EventLog.id)).scalar()
+    if oldest is not None and oldest > last_seq + 1:
+        return None
+
+    audience = EventLog.user_id == user_id
+    if group_ids:
+        audience = or_(
+            audience,
+            and_(
+                EventLog.group_id.in_(list(group_ids)),
+                or_(EventLog.exclude_user_id.is_(None), EventLog.exclude_user_id != user_id),
+            ),
+        )
+
+    rows = (
+        EventLog.query.filter(EventLog.id > last_seq, audience)
+        .order_by(EventLog.id.asc())
+        .limit(limit + 1)
+        .all()
+    )
+    return [
+        LoggedEvent(
+            int(r.id),
+            r.event,
+            dict(json.loads(r.payload), seq=int(r.id)),
+            r.user_id,
+            r.group_id,
+            r.exclude_user_id,
+        )
+        for r in rows
+    ]
+
+
+def prune_event_log(older_than_hours):
+    """Apaga eventos antigos; quem estava fora há mais tempo recebe resync."""
+    cutoff = datetime.utcnow() - timedelta(hours=older_than_hours)
+    deleted = EventLog.query.filter(EventLog.created_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
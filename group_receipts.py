@@ -0,0 +1,27 @@
+from bisect import bisect_left
+
+
+class GroupReadIndex:
+    """
+    Marcas de leitura (GroupRead.last_read_message_id) dos membros de um
+    grupo, ordenadas. "Lida por N de M" de qualquer mensagem sai com uma
+    busca binária, sem linha de recibo por mensagem: N = membros cuja marca
+    alcança o id, menos o próprio remetente; M = membros menos o remetente.
+
+    Mudanças de marca viram deltas agregados {reader_id, after, up_to}:
+    quem mandou mensagens no intervalo (after, up_to] ganha +1 leitor em
+    cada uma delas.
+    """
+
+    def __init__(self, watermarks):
+        self.by_user = {int(uid): int(mark or 0) for uid, mark in watermarks}
+        self.sorted_marks = sorted(self.by_user.values())
+
+    def read_count(self, message_id, sender_id):
+        count = len(self.sorted_marks) - bisect_left(self.sorted_marks, message_id)
+        if self.by_user.get(sender_id, 0) >= message_id:
+            count -= 1
+        return count
+
+    def read_total(self, sender_id):
+        return len(self.by_user) - (1 if sender_id in self.by_user else 0)
@@ -0,0 +1,134 @@
+import time
+from collections import OrderedDict, defaultdict
+from threading import Lock
+
+from sqlalchemy import event
+
+
+class MembershipCache:
+    """
+    Cache em memória de group_id -> frozenset(user_ids), com LRU limitado
+    a `max_groups` grupos e o mapa reverso user_id -> grupos em cache (para
+    invalidar por usuário). `loader(group_id)` busca os membros no banco
+    quando o grupo não está em cache.
+
+    Cada entrada vale `ttl_seconds`: as invalidações de outros workers
+    chegam pelo pub/sub (cache_invalidation.py), e o TTL cobre as que se
+    perderam. Conjunto vazio (grupo inexistente ou ainda sem membros) não
+    entra no cache, para não esconder um grupo criado em outro worker.
+    """
+
+    def __init__(self, loader, max_groups=1024, ttl_seconds=60, clock=time.monotonic):
+        self.loader = loader
+        self.max_groups = max_groups
+        self.ttl = ttl_seconds
+        self.clock = clock
+
+        # group_id -> (expira_em, membros)
+        self._groups = OrderedDict()
+        self._user_groups = defaultdict(set)
+        self._lock = Lock()
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def members(self, group_id):
+        group_id = int(group_id)
+
+        with self._lock:
+            cached = self._groups.get(group_id)
+            if cached is not None and cached[0] > self.clock():
+                self._groups.move_to_end(group_id)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            generation = self._generation
+
+        members = frozenset(int(uid) for uid in self.loader(group_id))
+
+        with self._lock:
+            # uma invalidação durante o load pode ter tornado `members` velho
+            if members and generation == self._generation:
+                self._store(group_id, members)
+            elif not members:
+                self._drop(group_id)
+        return members
+
+    def contains(self, group_id, user_id):
+        return int(user_id) in self.members(group_id)
+
+    def _store(self, group_id, members):
+        self._drop(group_id)
+        self._groups[group_id] = (self.clock() + self.ttl, members)
+        for uid in members:
+            self._user_groups[uid].add(group_id)
+
+        while len(self._groups) > self.max_groups:
+            self._drop(next(iter(self._groups)))
+            self.evictions += 1
+
+    def _drop(self, group_id):
+        entry = self._groups.pop(group_id, None)
+        if entry is None:
+            return
+        for uid in entry[1]:
+            groups = self._user_groups.get(uid)
+            if groups is None:
+                continue
+            groups.discard(group_id)
+            if not groups:
+                del self._user_groups[uid]
+
+    def invalidate(self, group_id):
+        with self._lock:
+            self._generation += 1
+            self._drop(int(group_id))
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._generation += 1
+            for group_id in list(self._user_groups.get(int(user_id), ())):
+                self._drop(group_id)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._groups.clear()
+            self._user_groups.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "groups": len(self._groups),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def invalidate_on_commit(invalidate, session, model):
+    """
+    Chama `invalidate(group_id)` para os grupos cujas linhas de `model`
+    (GroupMember) mudaram, só depois do commit: antes disso outra thread
+    poderia recarregar o estado antigo. Updates/deletes em massa via Query
+    não passam por aqui.
+    """
+    pending_key = "membership_cache_pending"
+
+    @event.listens_for(session, "after_flush")
+    def collect(sess, flush_context):
+        pending = sess.info.setdefault(pending_key, set())
+        for obj in list(sess.new) + list(sess.dirty) + list(sess.deleted):
+            if isinstance(obj, model) and obj.group_id is not None:
+                pending.add(int(obj.group_id))
+
+    @event.listens_for(session, "after_commit")
+    def apply(sess):
+        for group_id in sess.info.pop(pending_key, ()):
+            invalidate(group_id)
+
+    @event.listens_for(session, "after_rollback")
+    def discard(sess):
+        sess.info.pop(pending_key, None)
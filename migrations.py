@@ -0,0 +1,389 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import and_, func, inspect, literal, select, text, update
+
+from models import (
+    db,
+    Message,
+    GroupMember,
+    GroupMessage,
+    GroupRead,
+    ConversationSummary,
+    UnreadCounter,
+)
+from search import rebuild_search_index
+from chat_payload import (
+    CHAT_JSON_PREFIX,
+    parse_legacy_payload,
+    preview_from_fields,
+    preview_from_message,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# ========================== MIGRAÇÕES ==========================
+#
+# `db.create_all()` só cria tabelas que ainda não existem. Tudo o que muda
+# o schema de um database.db já existente (índices, colunas novas, dados)
+# entra aqui como uma migração numerada. Cada migração roda uma única vez,
+# dentro da própria transação, e a versão aplicada fica gravada em
+# `schema_migrations`. Migrações `batched` recebem o engine e fazem commit
+# por lote; precisam ser retomáveis, já que podem ser interrompidas no meio.
+
+MIGRATIONS = []
+
+
+def migration(version, description, batched=False):
+    def decorator(fn):
+        MIGRATIONS.append((version, description, fn, batched))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return fn
+
+    return decorator
+
+
+# -------- HELPERS --------
+def create_indexes(conn, *models):
+    for model in models:
+        for index in model.__table__.indexes:
+            index.create(bind=conn, checkfirst=True)
+
+
+def table_columns(conn, table_name):
+    return {c["name"] for c in inspect(conn).get_columns(table_name)}
+
+
+def add_column_if_missing(conn, table_name, column_name, ddl):
+    if column_name not in table_columns(conn, table_name):
+        conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {ddl}"))
+
+
+CONTENT_COLUMNS = ("text", "kind", "file_url", "file_name", "file_mime", "edited", "deleted")
+
+
+def content_columns(conn, table):
+    """Colunas de conteúdo que já existem no banco (antes da v4 só há `text`)."""
+    existing = table_columns(conn, table.name)
+    return [table.c[name] for name in CONTENT_COLUMNS if name in existing]
+
+
+def row_preview(row):
+    if "kind" in row._mapping:
+        return preview_from_message(row)
+    return preview_from_fields(parse_legacy_payload(row.text))
+
+
+def chunked(items, size=500):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def rebuild_conversation_summaries(conn):
+    """Recalcula conversation_summaries a partir de messages/group_messages."""
+    summaries = ConversationSummary.__table__
+    messages = Message.__table__
+    group_messages = GroupMessage.__table__
+
+    conn.execute(summaries.delete())
+
+    last_by_pair = {}
+    rows = conn.execute(
+        select(messages.c.sender_id, messages.c.receiver_id, func.max(messages.c.id))
+        .group_by(messages.c.sender_id, messages.c.receiver_id)
+    )
+    for sender_id, receiver_id, last_id in rows:
+        pair = (min(sender_id, receiver_id), max(sender_id, receiver_id))
+        last_by_pair[pair] = max(last_by_pair.get(pair, 0), int(last_id))
+
+    for ids in chunked(last_by_pair.values()):
+        batch = []
+        query = select(
+            messages.c.id,
+            messages.c.sender_id,
+            messages.c.receiver_id,
+            messages.c.created_at,
+            *content_columns(conn, messages),
+        ).where(messages.c.id.in_(ids))
+        for m in conn.execute(query):
+            preview = row_preview(m)
+            sides = {(m.sender_id, m.receiver_id), (m.receiver_id, m.sender_id)}
+            for owner_id, peer_id in sides:
+                batch.append(
+                    {
+                        "conversation_type": "user",
+                        "user_id": owner_id,
+                        "target_id": peer_id,
+                        "last_message_id": m.id,
+                        "last_text": preview,
+                        "last_at": m.created_at,
+                    }
+                )
+        if batch:
+            conn.execute(summaries.insert(), batch)
+
+    last_by_group = conn.execute(
+        select(func.max(group_messages.c.id)).group_by(group_messages.c.group_id)
+    ).scalars().all()
+
+    for ids in chunked(last_by_group):
+        query = select(
+            group_messages.c.id,
+            group_messages.c.group_id,
+            group_messages.c.created_at,
+            *content_columns(conn, group_messages),
+        ).where(group_messages.c.id.in_(ids))
+        batch = [
+            {
+                "conversation_type": "group",
+                "user_id": None,
+                "target_id": m.group_id,
+                "last_message_id": m.id,
+                "last_text": row_preview(m),
+                "last_at": m.created_at,
+            }
+            for m in conn.execute(query)
+        ]
+        if batch:
+            conn.execute(summaries.insert(), batch)
+
+
+def rebuild_unread_counters(conn):
+    """Recalcula unread_counters a partir das tabelas de mensagens e leituras."""
+    counters = UnreadCounter.__table__
+    messages = Message.__table__
+    group_messages = GroupMessage.__table__
+    members = GroupMember.__table__
+    reads = GroupRead.__table__
+    columns = ["user_id", "conversation_type", "target_id", "unread_count"]
+
+    conn.execute(counters.delete())
+
+    conn.execute(
+        counters.insert().from_select(
+            columns,
+            select(
+                messages.c.receiver_id,
+                literal("user"),
+                messages.c.sender_id,
+                func.count(messages.c.id),
+            )
+            .where(messages.c.seen == False)  # noqa: E712
+            .group_by(messages.c.receiver_id, messages.c.sender_id),
+        )
+    )
+
+    last_read = (
+        select(func.coalesce(func.max(reads.c.last_read_message_id), 0))
+        .where(
+            reads.c.group_id == members.c.group_id,
+            reads.c.user_id == members.c.user_id,
+        )
+        .scalar_subquery()
+    )
+    conn.execute(
+        counters.insert().from_select(
+            columns,
+            select(
+                members.c.user_id,
+                literal("group"),
+                members.c.group_id,
+                func.count(group_messages.c.id),
+            )
+            .select_from(
+                members.join(
+                    group_messages,
+                    and_(
+                        group_messages.c.group_id == members.c.group_id,
+                        group_messages.c.sender_id != members.c.user_id,
+                        group_messages.c.id > last_read,
+                    ),
+                )
+            )
+            .group_by(members.c.user_id, members.c.group_id),
+        )
+    )
+
+
+def migrate_legacy_payloads(engine, table, batch_size=1000, log=logger.info):
+    """
+    Reescreve as linhas com envelope __CHATJSON__ para as colunas reais,
+    em lotes de `batch_size` com commit próprio. Linhas já convertidas não
+    têm mais o prefixo, então rodar de novo continua de onde parou.
+    """
+    is_legacy = func.substr(table.c.text, 1, len(CHAT_JSON_PREFIX)) == CHAT_JSON_PREFIX
+    last_id = 0
+    converted = 0
+
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select(table.c.id, table.c.text, table.c.file_url)
+                .where(table.c.id > last_id, is_legacy)
+                .order_by(table.c.id.asc())
+                .limit(batch_size)
+            ).fetchall()
+            if not rows:
+                break
+
+            for row in rows:
+                fields = parse_legacy_payload(row.text)
+                conn.execute(
+                    update(table)
+                    .where(table.c.id == row.id)
+                    .values(
+                        text=fields["text"],
+                        kind=fields["kind"],
+                        file_url=fields["file_url"] or row.file_url,
+                        file_name=fields["file_name"],
+                        file_mime=fields["file_mime"],
+                        edited=fields["edited"],
+                        deleted=fields["deleted"],
+                    )
+                )
+
+        last_id = int(rows[-1].id)
+        converted += len(rows)
+        if log:
+            log(f"[migrations] {table.name}: {converted} mensagens convertidas")
+
+    return converted
+
+
+# -------- VERSÕES --------
+@migration(1, "índices compostos para mensagens, grupos e leituras")
+def add_hot_path_indexes(conn):
+    # group_reads já tem o índice único (group_id, user_id) da constraint
+    create_indexes(conn, Message, GroupMessage, GroupMember)
+    conn.execute(text("ANALYZE"))
+
+
+@migration(2, "preenche conversation_summaries com o histórico existente")
+def backfill_conversation_summaries(conn):
+    rebuild_conversation_summaries(conn)
+
+
+@migration(3, "preenche unread_counters com as não lidas existentes")
+def backfill_unread_counters(conn):
+    rebuild_unread_counters(conn)
+
+
+@migration(4, "colunas kind/file_*/edited/deleted em messages e group_messages")
+def add_message_content_columns(conn):
+    for table_name in ("messages", "group_messages"):
+        add_column_if_missing(conn, table_name, "kind", "VARCHAR(20) NOT NULL DEFAULT 'text'")
+        add_column_if_missing(conn, table_name, "file_url", "VARCHAR(255)")
+        add_column_if_missing(conn, table_name, "file_name", "VARCHAR(255)")
+        add_column_if_missing(conn, table_name, "file_mime", "VARCHAR(100)")
+        add_column_if_missing(conn, table_name, "edited", "BOOLEAN NOT NULL DEFAULT false")
+        add_column_if_missing(conn, table_name, "deleted", "BOOLEAN NOT NULL DEFAULT false")
+
+
+@migration(5, "converte o envelope __CHATJSON__ para as colunas novas", batched=True)
+def convert_legacy_payloads(engine):
+    for model in (Message, GroupMessage):
+        migrate_legacy_payloads(engine, model.__table__)
+
+
+@migration(6, "índice FTS5 de busca de mensagens (só SQLite)")
+def create_search_index(conn):
+    if conn.dialect.name != "sqlite":
+        return
+    rebuild_search_index(conn)
+
+
+# -------- PLANOS DE CONSULTA --------
+# As consultas quentes que os índices da migração 1 cobrem; `flask
+# bench-query-plans` mostra o plano de cada uma no banco configurado.
+HOT_QUERIES = {
+    "history": (
+        "SELECT id FROM messages"
+        " WHERE (sender_id = :a AND receiver_id = :b) OR (sender_id = :b AND receiver_id = :a)"
+        " ORDER BY id DESC LIMIT 51"
+    ),
+    "group history": "SELECT id FROM group_messages WHERE group_id = :g ORDER BY id DESC LIMIT 51",
+    "member by user": "SELECT group_id FROM group_members WHERE user_id = :a",
+    "membership": "SELECT 1 FROM group_members WHERE group_id = :g AND user_id = :a",
+    "unread": (
+        "SELECT sender_id, count(id) FROM messages"
+        " WHERE receiver_id = :a AND seen = false GROUP BY sender_id"
+    ),
+}
+
+
+def full_scan(dialect, detail):
+    """A linha do plano lê a tabela inteira (sem índice)?"""
+    if dialect == "sqlite":
+        return detail.startswith("SCAN ") and " USING " not in detail
+    return "Seq Scan" in detail
+
+
+def explain_hot_queries(conn):
+    """[(nome, [linhas do plano], faz scan completo)] para cada HOT_QUERIES."""
+    dialect = conn.dialect.name
+    prefix = "EXPLAIN QUERY PLAN " if dialect == "sqlite" else "EXPLAIN "
+    params = {"a": 1, "b": 2, "g": 1}
+
+    plans = []
+    for name, sql in HOT_QUERIES.items():
+        rows = conn.execute(text(prefix + sql), params).fetchall()
+        # SQLite: (id, parent, notused, detail); PostgreSQL: (QUERY PLAN,)
+        details = [str(row[-1]).strip() for row in rows]
+        plans.append((name, details, any(full_scan(dialect, d) for d in details)))
+    return plans
+
+
+# -------- RUNNER --------
+def ensure_migrations_table(conn):
+    conn.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            " version INTEGER PRIMARY KEY,"
+            " description VARCHAR(255) NOT NULL,"
+            " applied_at TIMESTAMP NOT NULL)"
+        )
+    )
+
+
+def applied_versions(conn):
+    rows = conn.execute(text("SELECT version FROM schema_migrations")).fetchall()
+    return {int(r[0]) for r in rows}
+
+
+def run_migrations(engine=None, log=logger.info):
+    engine = engine or db.engine
+
+    with engine.begin() as conn:
+        ensure_migrations_table(conn)
+        done = applied_versions(conn)
+
+    applied = []
+    for version, description, fn, batched in MIGRATIONS:
+        if version in done:
+            continue
+
+        if batched:
+            fn(engine)
+
+        with engine.begin() as conn:
+            if not batched:
+                fn(conn)
+            conn.execute(
+                text(
+                    "INSERT INTO schema_migrations (version, description, applied_at)"
+                    " VALUES (:version, :description, :applied_at)"
+                ),
+                {
+                    "version": version,
+                    "description": description,
+                    "applied_at": datetime.utcnow(),
+                },
+            )
+
+        applied.append(version)
+        if log:
+            log(f"[migrations] v{version}: {description}")
+
+    return applied
@@ -67,9 +67,22 @@ class Message(db.Model):
     receiver_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
 
     text = db.Column(db.Text, nullable=False)
+    kind = db.Column(db.String(20), default="text", nullable=False)
+    file_url = db.Column(db.String(255), nullable=True)
+    file_name = db.Column(db.String(255), nullable=True)
+    file_mime = db.Column(db.String(100), nullable=True)
+    edited = db.Column(db.Boolean, default=False, nullable=False)
+    deleted = db.Column(db.Boolean, default=False, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     seen = db.Column(db.Boolean, default=False, nullable=False)
 
+    __table_args__ = (
+        # histórico da conversa (or-of-ands sender/receiver) paginado por id
+        db.Index("ix_messages_sender_receiver_id", "sender_id", "receiver_id", "id"),
+        # não lidas por destinatário (unread_counts / mark_as_read)
+        db.Index("ix_messages_receiver_seen_sender", "receiver_id", "seen", "sender_id"),
+    )
+
 
 class Group(db.Model):
     __tablename__ = "groups"
@@ -107,6 +120,11 @@ class GroupMember(db.Model):
     role = db.Column(db.String(20), default="member", nullable=False)
     joined_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
+    __table_args__ = (
+        db.Index("ix_group_members_group_user", "group_id", "user_id"),
+        db.Index("ix_group_members_user_group", "user_id", "group_id"),
+    )
+
 
 class GroupMessage(db.Model):
     __tablename__ = "group_messages"
@@ -116,9 +134,18 @@ class GroupMessage(db.Model):
     sender_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
 
     text = db.Column(db.Text, nullable=False)
+    kind = db.Column(db.String(20), default="text", nullable=False)
     file_url = db.Column(db.String(255), nullable=True)
+    file_name = db.Column(db.String(255), nullable=True)
+    file_mime = db.Column(db.String(100), nullable=True)
+    edited = db.Column(db.Boolean, default=False, nullable=False)
+    deleted = db.Column(db.Boolean, default=False, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
+    __table_args__ = (
+        db.Index("ix_group_messages_group_id", "group_id", "id"),
+    )
+
 
 class GroupRead(db.Model):
     __tablename__ = "group_reads"
@@ -160,6 +187,129 @@ class GroupRead(db.Model):
         foreign_keys=[last_read_message_id],
     )
 
+
+class DeliveryWatermark(db.Model):
+    """
+    Maior id de mensagem privada de sender_id que já chegou a um socket de
+    receiver_id (o cliente confirma cada receive_message). Só avança; tudo
+    até ele aparece como "entregue" para o remetente.
+    """
+
+    __tablename__ = "delivery_watermarks"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    receiver_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    sender_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    delivered_message_id = db.Column(db.Integer, nullable=False)
+
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint("receiver_id", "sender_id", name="uq_delivery_watermarks_receiver_sender"),
+    )
+
+
+class ConversationSummary(db.Model):
+    """
+    Última mensagem de cada conversa, mantida na mesma transação do envio,
+    edição e exclusão. Conversas privadas têm uma linha por lado
+    (user_id = dono, target_id = contato); grupos têm uma linha só
+    (user_id nulo, target_id = grupo).
+    """
+
+    __tablename__ = "conversation_summaries"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    conversation_type = db.Column(db.String(10), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=True)
+    target_id = db.Column(db.Integer, nullable=False)
+
+    last_message_id = db.Column(db.Integer, nullable=False)
+    last_text = db.Column(db.Text, nullable=False, default="")
+    last_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint(
+            "user_id",
+            "conversation_type",
+            "target_id",
+            name="uq_conversation_summaries_user_conversation",
+        ),
+        db.Index(
+            "uq_conversation_summaries_group",
+            "target_id",
+            unique=True,
+            sqlite_where=db.text("conversation_type = 'group'"),
+            postgresql_where=db.text("conversation_type = 'group'"),
+        ),
+    )
+
+
+class UnreadCounter(db.Model):
+    """
+    Contador de não lidas por (usuário, conversa). Incrementado no envio e
+    zerado no mark_as_read, sempre na mesma transação da mensagem.
+    """
+
+    __tablename__ = "unread_counters"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    conversation_type = db.Column(db.String(10), nullable=False)
+    target_id = db.Column(db.Integer, nullable=False)
+
+    unread_count = db.Column(db.Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint(
+            "user_id",
+            "conversation_type",
+            "target_id",
+            name="uq_unread_counters_user_conversation",
+        ),
+    )
+
+
+class ModerationFlag(db.Model):
+    """Mensagens marcadas pela moderação (MESSAGE_MODERATION=flag) para revisão."""
+
+    __tablename__ = "moderation_flags"
+
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_type = db.Column(db.String(10), nullable=False)
+    message_id = db.Column(db.Integer, nullable=False)
+    sender_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    words = db.Column(db.String(255), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+class EventLog(db.Model):
+    """
+    Eventos entregues por socket, numerados (id = seq) para o cliente que
+    reconecta pedir só o que perdeu. Evento de um usuário tem user_id;
+    evento de grupo tem group_id (e exclude_user_id = quem o gerou).
+    """
+
+    __tablename__ = "event_log"
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=True)
+    group_id = db.Column(db.Integer, nullable=True)
+    exclude_user_id = db.Column(db.Integer, nullable=True)
+    event = db.Column(db.String(40), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_event_log_user_id", "user_id", "id"),
+        db.Index("ix_event_log_group_id", "group_id", "id"),
+        # seq nunca volta atrás, nem depois de apagar os eventos antigos
+        {"sqlite_autoincrement": True},
+    )
+
 # ========================== FUNÇÕES AUXILIARES ==========================
 
 # -------- USUÁRIOS --------
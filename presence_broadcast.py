@@ -0,0 +1,160 @@
+import time
+from collections import defaultdict
+from threading import Lock
+
+
+class PresenceBroadcaster:
+    """
+    Entrega de presença em lote e só para quem conhece o usuário.
+
+    Conexões e desconexões só marcam o usuário como pendente; `flush()`,
+    chamado a cada poucos centésimos de segundo, confere o estado real de
+    cada pendente, descarta o que não mudou desde o último anúncio e manda
+    para cada destinatário online um único frame com as diferenças:
+    {"online": [...], "offline": [...]}.
+
+    A saída só é conferida depois de `grace` segundos: quem reconecta nesse
+    meio-tempo (refresh, troca de rede) não gera nem offline nem online.
+
+    `load_audiences(user_ids)` devolve {user_id: ids que podem ver a
+    presença dele}; `settle(user_id)` devolve (online, mudou desde o último
+    anúncio) e grava o anúncio no presence store, que é compartilhado entre
+    workers: o offline pode ser conferido num worker que nunca anunciou o
+    online. `online_among(ids)` filtra os destinatários conectados e
+    `send(destinatário, frame)` faz o emit.
+    """
+
+    def __init__(self, load_audiences, settle, online_among, send, grace=5.0, clock=time.monotonic):
+        self.load_audiences = load_audiences
+        self.settle = settle
+        self.online_among = online_among
+        self.send = send
+        self.grace = grace
+        self.clock = clock
+
+        self._pending = {}
+        self._lock = Lock()
+
+        self.counters = {
+            "transitions": 0,
+            "announced": 0,
+            "suppressed": 0,
+            "frames": 0,
+        }
+
+    def online(self, user_id):
+        with self._lock:
+            self.counters["transitions"] += 1
+            self._pending[int(user_id)] = self.clock()
+
+    def offline(self, user_id):
+        with self._lock:
+            self.counters["transitions"] += 1
+            self._pending[int(user_id)] = self.clock() + self.grace
+
+    def _collect_changes(self):
+        now = self.clock()
+        with self._lock:
+            due = [uid for uid, at in self._pending.items() if at <= now]
+            for uid in due:
+                del self._pending[uid]
+
+        changes = {}
+        for uid in due:
+            online, changed = self.settle(uid)
+            with self._lock:
+                self.counters["announced" if changed else "suppressed"] += 1
+            if changed:
+                changes[uid] = online
+        return changes
+
+    def flush(self):
+        """Envia os frames das mudanças vencidas; devolve quantos enviou."""
+        changes = self._collect_changes()
+        if not changes:
+            return 0
+
+        audiences = self.load_audiences(sorted(changes))
+        audience_ids = set().union(*audiences.values()) if audiences else set()
+        connected = self.online_among(audience_ids)
+
+        frames = defaultdict(lambda: {"online": [], "offline": []})
+        for uid, online in changes.items():
+            for recipient in audiences.get(uid, ()):
+                if recipient == uid or recipient not in connected:
+                    continue
+                frames[recipient]["online" if online else "offline"].append(uid)
+
+        for recipient, frame in frames.items():
+            self.send(recipient, frame)
+
+        with self._lock:
+            self.counters["frames"] += len(frames)
+        return len(frames)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, pending=len(self._pending))
+
+
+def simulate_login_storm(users=2000, group_size=50, login_seconds=60.0, flush_seconds=1.0,
+                         grace=5.0, flap_every=20):
+    """
+    Teste de carga sem sockets: `users` pessoas em grupos de `group_size`
+    entram ao longo de `login_seconds` (1 em cada `flap_every` reconecta
+    logo em seguida). Conta os frames de presença do broadcast antigo (todo
+    mundo recebe toda transição) e do PresenceBroadcaster.
+    """
+    now = [0.0]
+    online = set()
+    announced = set()
+    sent = []
+
+    def settle(uid):
+        changed = (uid in online) != (uid in announced)
+        if changed:
+            (announced.add if uid in online else announced.discard)(uid)
+        return uid in online, changed
+
+    def audiences(user_ids):
+        result = {}
+        for uid in user_ids:
+            start = (uid - 1) // group_size * group_size + 1
+            result[uid] = set(range(start, start + group_size)) - {uid}
+        return result
+
+    broadcaster = PresenceBroadcaster(
+        audiences,
+        settle=settle,
+        online_among=lambda ids: online.intersection(ids),
+        send=lambda recipient, frame: sent.append(recipient),
+        grace=grace,
+        clock=lambda: now[0],
+    )
+
+    naive = 0
+    next_flush = flush_seconds
+    step = login_seconds / users
+    for uid in range(1, users + 1):
+        now[0] = uid * step
+        while now[0] >= next_flush:
+            broadcaster.flush()
+            next_flush += flush_seconds
+
+        online.add(uid)
+        broadcaster.online(uid)
+        naive += len(online) + 1  # "presence" para todos + online_list
+
+        if uid % flap_every == 0:
+            online.discard(uid)
+            broadcaster.offline(uid)
+            naive += len(online)
+            online.add(uid)
+            broadcaster.online(uid)
+            naive += len(online) + 1
+
+    now[0] += grace + flush_seconds
+    broadcaster.flush()
+
+    batched = len(sent) + users + users // flap_every  # + online_list de cada join
+    return {"users": users, "naive_frames": naive, "batched_frames": batched, **broadcaster.stats()}
@@ -0,0 +1,385 @@
+import os
+import time
+import uuid
+from collections import defaultdict
+from threading import Lock
+
+
+# ========================== PRESENÇA COMPARTILHADA ==========================
+#
+# Quem está online (sid <-> usuário) e quem está em cada chamada de grupo.
+# Com um processo só basta a memória; com vários workers/hosts o estado vai
+# para o Redis (PRESENCE_STORE_URL=redis://...), junto com a fila de
+# mensagens do Socket.IO (SOCKETIO_MESSAGE_QUEUE), para que todos vejam os
+# mesmos usuários e chamadas.
+#
+# No Redis cada worker tem um id e uma chave de vida com TTL renovada pelo
+# heartbeat. Se um worker morre (ou reinicia) sem desconectar os sockets,
+# outro worker percebe a chave expirada e remove os sids que eram dele.
+
+
+class MemoryPresenceStore:
+    """Estado em memória do processo: um worker só, e usado nos testes."""
+
+    shared = False
+
+    def __init__(self):
+        self._lock = Lock()
+        self._sid_user = {}
+        self._user_sids = defaultdict(set)
+        self._calls = defaultdict(set)
+        self._announced = set()
+
+    # -------- PRESENÇA --------
+    def add_sid(self, user_id, sid):
+        """Registra o socket; devolve True se o usuário já estava online."""
+        user_id = int(user_id)
+        with self._lock:
+            was_online = bool(self._user_sids.get(user_id))
+            self._sid_user[sid] = user_id
+            self._user_sids[user_id].add(sid)
+        return was_online
+
+    def remove_sid(self, sid):
+        """Remove o socket; devolve (user_id, ficou_offline) ou (None, False)."""
+        with self._lock:
+            user_id = self._sid_user.pop(sid, None)
+            if user_id is None:
+                return None, False
+
+            sids = self._user_sids.get(user_id)
+            if sids is not None:
+                sids.discard(sid)
+            if sids:
+                return user_id, False
+
+            self._user_sids.pop(user_id, None)
+            return user_id, True
+
+    def user_of(self, sid):
+        with self._lock:
+            return self._sid_user.get(sid)
+
+    def sids_of(self, user_id):
+        with self._lock:
+            return list(self._user_sids.get(int(user_id), ()))
+
+    def is_online(self, user_id):
+        with self._lock:
+            return bool(self._user_sids.get(int(user_id)))
+
+    def online_user_ids(self):
+        with self._lock:
+            return [uid for uid, sids in self._user_sids.items() if sids]
+
+    def online_among(self, user_ids):
+        with self._lock:
+            return {int(uid) for uid in user_ids if self._user_sids.get(int(uid))}
+
+    def settle_announcement(self, user_id):
+        """
+        Compara o estado real com o último anunciado e grava o novo, numa
+        operação só; devolve (online, mudou). Só quem recebe mudou=True
+        manda o presence_diff.
+        """
+        user_id = int(user_id)
+        with self._lock:
+            online = bool(self._user_sids.get(user_id))
+            changed = online != (user_id in self._announced)
+            if changed:
+                (self._announced.add if online else self._announced.discard)(user_id)
+        return online, changed
+
+    # -------- CHAMADAS EM GRUPO --------
+    def join_call(self, group_id, user_id):
+        """Entra na chamada; devolve quem já estava nela."""
+        with self._lock:
+            participants = self._calls[int(group_id)]
+            existing = sorted(uid for uid in participants if uid != int(user_id))
+            participants.add(int(user_id))
+        return existing
+
+    def leave_call(self, group_id, user_id):
+        """Sai da chamada; devolve True se o usuário estava nela."""
+        group_id = int(group_id)
+        with self._lock:
+            participants = self._calls.get(group_id)
+            if not participants or int(user_id) not in participants:
+                return False
+            participants.discard(int(user_id))
+            if not participants:
+                self._calls.pop(group_id, None)
+        return True
+
+    def leave_all_calls(self, user_id):
+        """Tira o usuário de todas as chamadas; devolve os group_ids."""
+        user_id = int(user_id)
+        with self._lock:
+            left = [gid for gid, participants in self._calls.items() if user_id in participants]
+            for gid in left:
+                self._calls[gid].discard(user_id)
+                if not self._calls[gid]:
+                    self._calls.pop(gid, None)
+        return left
+
+    # -------- WORKERS --------
+    def heartbeat(self, force=False):
+        """Nada a fazer em memória; devolve os usuários que ficaram offline."""
+        return []
+
+
+# Scripts Lua: cada operação de presença é atômica no Redis, então dois
+# workers não discordam sobre quem acabou de entrar/sair. Toda chave que o
+# script toca vem em KEYS (regra do Redis e condição para o Cluster); como
+# as chaves do usuário e do worker dependem do sid, o remove lê antes e o
+# script confere que o sid continua apontando para eles (senão devolve -1
+# e o Python relê).
+ADD_SID_SCRIPT = """
+local was_online = redis.call('SCARD', KEYS[2]) > 0
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[1])
+redis.call('HSET', KEYS[4], ARGV[1], ARGV[3])
+return was_online and 1 or 0
+"""
+
+REMOVE_SID_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] then
+  return -1
+end
+if (redis.call('HGET', KEYS[2], ARGV[1]) or '') ~= ARGV[3] then
+  return -1
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('SREM', KEYS[3], ARGV[1])
+redis.call('SREM', KEYS[4], ARGV[1])
+return redis.call('SCARD', KEYS[4]) == 0 and 1 or 0
+"""
+
+# Anúncio de presença: quem anunciou o usuário online fica no Redis, então
+# o offline é reconhecido em qualquer worker (o do último sid, o que limpou
+# um worker morto), e só um deles manda o presence_diff.
+SETTLE_ANNOUNCEMENT_SCRIPT = """
+local online = redis.call('SCARD', KEYS[1]) > 0
+local changed
+if online then
+  changed = redis.call('SADD', KEYS[2], ARGV[1])
+else
+  changed = redis.call('SREM', KEYS[2], ARGV[1])
+end
+return {online and 1 or 0, changed}
+"""
+
+
+class RedisPresenceStore:
+    """Estado no Redis, compartilhado por todos os workers e hosts."""
+
+    shared = True
+
+    def __init__(self, url, prefix="chat", worker_ttl=30, client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError as exc:  # pragma: no cover - depende do ambiente
+                raise RuntimeError("PRESENCE_STORE_URL=redis://... requer o pacote redis") from exc
+            client = redis.Redis.from_url(url, decode_responses=True)
+
+        self.redis = client
+        self.prefix = prefix
+        self.worker_ttl = worker_ttl
+        self.worker_id = uuid.uuid4().hex
+
+        self._add_sid = self.redis.register_script(ADD_SID_SCRIPT)
+        self._remove_sid = self.redis.register_script(REMOVE_SID_SCRIPT)
+        self._settle_announcement = self.redis.register_script(SETTLE_ANNOUNCEMENT_SCRIPT)
+        self._last_beat = 0.0
+
+    def _key(self, *parts):
+        # {prefix}: hash tag, todas as chaves de presença no mesmo slot do Cluster
+        return ":".join(("{%s}" % self.prefix, "presence") + tuple(str(p) for p in parts))
+
+    # -------- PRESENÇA --------
+    def add_sid(self, user_id, sid):
+        self.heartbeat()
+        return bool(
+            self._add_sid(
+                keys=[
+                    self._key("sid_user"),
+                    self._key("user", int(user_id)),
+                    self._key("worker", self.worker_id),
+                    self._key("sid_worker"),
+                ],
+                args=[sid, int(user_id), self.worker_id],
+            )
+        )
+
+    def remove_sid(self, sid, attempts=5):
+        for _ in range(attempts):
+            pipe = self.redis.pipeline()
+            pipe.hget(self._key("sid_user"), sid)
+            pipe.hget(self._key("sid_worker"), sid)
+            user_id, worker_id = pipe.execute()
+            if user_id is None:
+                return None, False
+
+            went_offline = self._remove_sid(
+                keys=[
+                    self._key("sid_user"),
+                    self._key("sid_worker"),
+                    self._key("worker", worker_id or "-"),
+                    self._key("user", user_id),
+                ],
+                args=[sid, user_id, worker_id or ""],
+            )
+            if went_offline != -1:
+                return int(user_id), bool(went_offline)
+        raise RuntimeError(f"sid {sid} mudou durante a remoção {attempts} vezes")
+
+    def user_of(self, sid):
+        user_id = self.redis.hget(self._key("sid_user"), sid)
+        return int(user_id) if user_id is not None else None
+
+    def sids_of(self, user_id):
+        return list(self.redis.smembers(self._key("user", int(user_id))))
+
+    def is_online(self, user_id):
+        return self.redis.scard(self._key("user", int(user_id))) > 0
+
+    def online_user_ids(self):
+        # HVALS em todos os sids: só para ferramentas, nunca no caminho quente
+        return sorted({int(uid) for uid in self.redis.hvals(self._key("sid_user"))})
+
+    def online_among(self, user_ids):
+        """Quais destes usuários estão online: um SCARD por id, numa ida ao Redis."""
+        user_ids = [int(uid) for uid in user_ids]
+        if not user_ids:
+            return set()
+        pipe = self.redis.pipeline(transaction=False)
+        for uid in user_ids:
+            pipe.scard(self._key("user", uid))
+        return {uid for uid, count in zip(user_ids, pipe.execute()) if count}
+
+    def settle_announcement(self, user_id):
+        online, changed = self._settle_announcement(
+            keys=[self._key("user", int(user_id)), self._key("announced")],
+            args=[int(user_id)],
+        )
+        return bool(online), bool(changed)
+
+    # -------- CHAMADAS EM GRUPO --------
+    def _call_key(self, group_id):
+        return self._key("call", int(group_id))
+
+    def _user_calls_key(self, user_id):
+        return self._key("user_calls", int(user_id))
+
+    def join_call(self, group_id, user_id):
+        pipe = self.redis.pipeline()
+        pipe.smembers(self._call_key(group_id))
+        pipe.sadd(self._call_key(group_id), int(user_id))
+        pipe.sadd(self._user_calls_key(user_id), int(group_id))
+        existing, _, _ = pipe.execute()
+        return sorted(int(uid) for uid in existing if int(uid) != int(user_id))
+
+    def leave_call(self, group_id, user_id):
+        pipe = self.redis.pipeline()
+        pipe.srem(self._call_key(group_id), int(user_id))
+        pipe.srem(self._user_calls_key(user_id), int(group_id))
+        removed, _ = pipe.execute()
+        return bool(removed)
+
+    def leave_all_calls(self, user_id):
+        group_ids = [int(gid) for gid in self.redis.smembers(self._user_calls_key(user_id))]
+        return [gid for gid in group_ids if self.leave_call(gid, user_id)]
+
+    # -------- WORKERS --------
+    def heartbeat(self, force=False):
+        """
+        Renova a chave de vida deste worker e limpa os sids de workers cuja
+        chave expirou. Devolve os user_ids que ficaram offline nessa limpeza.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_beat < self.worker_ttl / 3:
+            return []
+        self._last_beat = now
+
+        pipe = self.redis.pipeline()
+        pipe.set(self._key("alive", self.worker_id), 1, ex=self.worker_ttl)
+        pipe.sadd(self._key("workers"), self.worker_id)
+        pipe.smembers(self._key("workers"))
+        _, _, workers = pipe.execute()
+
+        went_offline = []
+        for worker_id in workers:
+            if worker_id == self.worker_id or self.redis.exists(self._key("alive", worker_id)):
+                continue
+            for sid in self.redis.smembers(self._key("worker", worker_id)):
+                user_id, offline = self.remove_sid(sid)
+                if offline:
+                    went_offline.append(user_id)
+            self.redis.srem(self._key("workers"), worker_id)
+            self.redis.delete(self._key("worker", worker_id))
+        return went_offline
+
+
+# -------- VERIFICAÇÃO --------
+def check_presence_store(store, peer=None, base_id=900_000_000):
+    """
+    Roteiro curto contra um store de verdade: sids múltiplos, entrada/saída,
+    chamadas e, com `peer` (outro worker no mesmo Redis), a limpeza dos sids
+    de um worker cuja chave de vida sumiu. Devolve as falhas (vazia = ok).
+    """
+    failures = []
+
+    def expect(label, got, wanted):
+        if got != wanted:
+            failures.append(f"{label}: {got!r} != {wanted!r}")
+
+    u1, u2, u3, group_id = base_id + 1, base_id + 2, base_id + 3, base_id + 1
+
+    expect("primeiro sid", store.add_sid(u1, "check-s1"), False)
+    expect("segundo sid", store.add_sid(u1, "check-s2"), True)
+    expect("user_of", store.user_of("check-s1"), u1)
+    expect("sai um sid", store.remove_sid("check-s1"), (u1, False))
+    expect("sai o último", store.remove_sid("check-s2"), (u1, True))
+    expect("sid desconhecido", store.remove_sid("check-s2"), (None, False))
+    expect("offline", store.is_online(u1), False)
+
+    store.add_sid(u2, "check-s3")
+    expect("online_among", store.online_among([u1, u2]), {u2})
+    expect("anuncia online", store.settle_announcement(u2), (True, True))
+    expect("já anunciado", store.settle_announcement(u2), (True, False))
+    store.remove_sid("check-s3")
+    expect("anuncia offline", store.settle_announcement(u2), (False, True))
+
+    expect("entra na chamada", store.join_call(group_id, u1), [])
+    expect("segundo na chamada", store.join_call(group_id, u2), [u1])
+    expect("sai das chamadas", store.leave_all_calls(u1), [group_id])
+    store.leave_call(group_id, u2)
+
+    if peer is not None:
+        peer.add_sid(u3, "check-p1")
+        expect("online no outro worker", peer.settle_announcement(u3), (True, True))
+        peer.heartbeat(force=True)
+        expect("worker vivo", store.heartbeat(force=True), [])
+        store.redis.delete(peer._key("alive", peer.worker_id))
+        expect("worker morto", store.heartbeat(force=True), [u3])
+        expect("sid do morto", store.is_online(u3), False)
+        # o offline é anunciado por este worker, que nunca anunciou o online
+        expect("offline do morto", store.settle_announcement(u3), (False, True))
+
+    return failures
+
+
+def presence_store_from_env():
+    url = os.environ.get("PRESENCE_STORE_URL", "").strip()
+    if not url or url.startswith("memory"):
+        return MemoryPresenceStore()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisPresenceStore(
+            url,
+            prefix=os.environ.get("PRESENCE_STORE_PREFIX", "chat"),
+            worker_ttl=int(os.environ.get("PRESENCE_WORKER_TTL", "30")),
+        )
+    raise RuntimeError(f"PRESENCE_STORE_URL não suportada: {url}")
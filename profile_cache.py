@@ -0,0 +1,69 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class ProfileCache:
+    """
+    Cache de perfis públicos (id -> display_name, username, avatar_url) com
+    TTL e limite de tamanho. `loader(ids)` busca de uma vez todos os ids que
+    faltam e devolve {id: perfil}. Ids que o loader não achou não entram
+    no cache. O /profile publica a invalidação ao salvar, e ela chega aos
+    outros workers pelo cache_invalidation.py; o TTL cobre o que se perder.
+    """
+
+    def __init__(self, loader, max_users=10000, ttl_seconds=300):
+        self.loader = loader
+        self.max_users = max_users
+        self.ttl = ttl_seconds
+
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, user_ids):
+        wanted = {int(uid) for uid in user_ids}
+        found = {}
+        now = time.monotonic()
+
+        with self._lock:
+            for uid in wanted:
+                entry = self._entries.get(uid)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(uid)
+                    found[uid] = entry[1]
+            self.hits += len(found)
+            self.misses += len(wanted) - len(found)
+
+        missing = wanted - found.keys()
+        if missing:
+            loaded = self.loader(sorted(missing))
+            expires = time.monotonic() + self.ttl
+            with self._lock:
+                for uid, profile in loaded.items():
+                    if not profile:
+                        continue
+                    self._entries[int(uid)] = (expires, profile)
+                    self._entries.move_to_end(int(uid))
+                while len(self._entries) > self.max_users:
+                    self._entries.popitem(last=False)
+            found.update(loaded)
+
+        return found
+
+    def get(self, user_id):
+        return self.get_many([user_id]).get(int(user_id))
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(int(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"users": len(self._entries), "hits": self.hits, "misses": self.misses}
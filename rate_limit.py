@@ -0,0 +1,175 @@
+import math
+import os
+import time
+from threading import Lock
+
+
+# ========================== RATE LIMIT ==========================
+#
+# Token bucket por (usuário, evento): cada evento tem uma taxa (fichas por
+# segundo) e uma rajada máxima. Em memória por padrão; com vários workers,
+# RATE_LIMIT_URL=redis://... divide os mesmos baldes entre todos.
+#
+# RATE_LIMITS sobrescreve os padrões: "send_message=5:20,typing=15:30"
+# (taxa:rajada; taxa 0 desliga o limite do evento).
+
+DEFAULT_LIMITS = {
+    "send_message": (5, 20),
+    "edit_message": (2, 10),
+    "delete_message": (2, 10),
+    # recibos: cobrados só quando abrem um recibo novo (ver ReceiptCoalescer)
+    "mark_as_read": (5, 20),
+    "message_received": (10, 50),
+    "typing": (15, 30),
+    "stop_typing": (15, 30),
+    "call_offer": (1, 5),
+    "call_answer": (1, 5),
+    "hangup": (2, 10),
+    "ice_candidate": (20, 100),
+    "invite_group_call": (0.2, 3),
+    "join_group_call": (1, 5),
+    "leave_group_call": (1, 5),
+    "group_webrtc_offer": (5, 20),
+    "group_webrtc_answer": (5, 20),
+    "group_webrtc_ice": (20, 100),
+    "upload_chat_file": (0.5, 5),
+}
+
+
+def parse_limits(spec, defaults=DEFAULT_LIMITS):
+    limits = dict(defaults)
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        event, _, value = item.partition("=")
+        rate, _, burst = value.partition(":")
+        try:
+            rate = float(rate)
+            burst = float(burst) if burst else max(rate, 1)
+        except ValueError:
+            continue
+        limits[event.strip()] = (rate, burst)
+    return limits
+
+
+class MemoryRateLimiter:
+    """Baldes no processo: rejeitar custa um lookup num dict e uma conta."""
+
+    def __init__(self, limits, max_keys=100000, clock=time.monotonic):
+        self.limits = limits
+        self.max_keys = max_keys
+        self.clock = clock
+
+        self._buckets = {}
+        self._lock = Lock()
+        self.counters = {}
+
+    def hit(self, key, event):
+        """Gasta uma ficha; devolve (permitido, segundos até a próxima)."""
+        rate, burst = self.limits.get(event, (0, 0))
+        if rate <= 0:
+            return True, 0.0
+
+        now = self.clock()
+        bucket_key = (key, event)
+        with self._lock:
+            tokens, updated = self._buckets.get(bucket_key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[bucket_key] = (tokens, now)
+
+            counts = self.counters.setdefault(event, [0, 0])
+            counts[0 if allowed else 1] += 1
+
+            if len(self._buckets) > self.max_keys:
+                self._evict_full(now)
+
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+    def _evict_full(self, now):
+        """Baldes que já encheram de novo são iguais a não ter balde."""
+        for bucket_key, (tokens, updated) in list(self._buckets.items()):
+            rate, burst = self.limits.get(bucket_key[1], (0, 0))
+            if rate <= 0 or tokens + (now - updated) * rate >= burst:
+                del self._buckets[bucket_key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "buckets": len(self._buckets),
+                "events": {e: {"allowed": a, "rejected": r} for e, (a, r) in self.counters.items()},
+            }
+
+
+# Balde atômico no Redis: fichas e instante da última atualização num hash,
+# com expiração quando o balde estaria cheio de novo.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 't', 'ts')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 't', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisRateLimiter:
+    """Os mesmos baldes para todos os workers/hosts."""
+
+    def __init__(self, url, limits, prefix="chat"):
+        try:
+            import redis
+        except ImportError as exc:  # pragma: no cover - depende do ambiente
+            raise RuntimeError("RATE_LIMIT_URL=redis://... requer o pacote redis") from exc
+
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.limits = limits
+        self.prefix = prefix
+        self._script = self.redis.register_script(TOKEN_BUCKET_SCRIPT)
+        self._lock = Lock()
+        self.counters = {}
+
+    def hit(self, key, event):
+        rate, burst = self.limits.get(event, (0, 0))
+        if rate <= 0:
+            return True, 0.0
+
+        allowed, tokens = self._script(
+            keys=[f"{self.prefix}:rate:{event}:{key}"],
+            args=[rate, burst, time.time()],
+        )
+        allowed = bool(allowed)
+        with self._lock:
+            counts = self.counters.setdefault(event, [0, 0])
+            counts[0 if allowed else 1] += 1
+        return allowed, 0.0 if allowed else (1 - float(tokens)) / rate
+
+    def stats(self):
+        with self._lock:
+            return {"events": {e: {"allowed": a, "rejected": r} for e, (a, r) in self.counters.items()}}
+
+
+def retry_after_header(seconds):
+    return str(max(1, math.ceil(seconds)))
+
+
+def rate_limiter_from_env():
+    limits = parse_limits(os.environ.get("RATE_LIMITS"))
+    url = os.environ.get("RATE_LIMIT_URL", "").strip()
+    if not url or url.startswith("memory"):
+        return MemoryRateLimiter(limits)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisRateLimiter(url, limits, prefix=os.environ.get("RATE_LIMIT_PREFIX", "chat"))
+    raise RuntimeError(f"RATE_LIMIT_URL não suportada: {url}")
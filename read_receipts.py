@@ -0,0 +1,70 @@
+import time
+from threading import Lock
+
+
+class ReceiptCoalescer:
+    """
+    Recibos pendentes (leitura ou entrega) por (usuário, tipo de conversa,
+    alvo).
+
+    Com a conversa aberta, o cliente manda um mark_as_read (e um ack de
+    entrega) para cada mensagem que chega. Aqui os pedidos da mesma
+    conversa dentro de `window` segundos viram um só, com o maior id
+    (`up_to`; None = tudo o que houver). O primeiro pedido marca o prazo e
+    os seguintes não o adiam, então o recibo sai no máximo `window` depois.
+    `due()`, chamado periodicamente, entrega os pedidos vencidos.
+
+    O rate limit vem depois do merge (`admit`): repetir um recibo pendente
+    não custa nada e nunca é descartado; só um recibo novo gasta ficha.
+    """
+
+    def __init__(self, window=0.25, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+
+        # chave -> [prazo, up_to]
+        self._pending = {}
+        self._lock = Lock()
+
+        self.counters = {"requests": 0, "coalesced": 0, "rejected": 0, "applied": 0}
+
+    def request(self, user_id, conversation_type, target_id, up_to=None, admit=None):
+        """Registra o pedido; devolve False se `admit()` recusou um recibo novo."""
+        key = (int(user_id), conversation_type, int(target_id))
+        with self._lock:
+            self.counters["requests"] += 1
+            if self._merge(key, up_to):
+                return True
+
+        # fora do lock: o limitador pode ir ao Redis
+        if admit is not None and not admit():
+            with self._lock:
+                self.counters["rejected"] += 1
+            return False
+
+        with self._lock:
+            if not self._merge(key, up_to):
+                self._pending[key] = [self.clock() + self.window, up_to]
+        return True
+
+    def _merge(self, key, up_to):
+        state = self._pending.get(key)
+        if state is None:
+            return False
+        self.counters["coalesced"] += 1
+        if state[1] is not None:
+            state[1] = None if up_to is None else max(state[1], up_to)
+        return True
+
+    def due(self):
+        """Tira e devolve [(usuário, tipo, alvo, up_to)] cujo prazo passou."""
+        now = self.clock()
+        with self._lock:
+            keys = [key for key, state in self._pending.items() if state[0] <= now]
+            due = [key + (self._pending.pop(key)[1],) for key in keys]
+            self.counters["applied"] += len(due)
+            return due
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, pending=len(self._pending))
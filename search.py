@@ -0,0 +1,259 @@
+import html
+import random
+import time
+
+from sqlalchemy import inspect, text
+
+
+# ========================== BUSCA (FTS5) ==========================
+#
+# `message_search` é uma tabela virtual FTS5 com o texto de mensagens
+# privadas e de grupo. O rowid é derivado do id da mensagem (par para
+# privadas, ímpar para grupo) para que envio, edição e exclusão consigam
+# atualizar a linha certa sem consulta extra. Só existe em SQLite.
+
+SEARCH_TABLE = "message_search"
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 100
+# casas decimais do bm25 no cursor: floats quase iguais viram o mesmo valor
+# e o desempate fica com o rowid, então a página seguinte não pula nem
+# repete linhas por diferença de arredondamento entre consultas
+SEARCH_RANK_DIGITS = 6
+
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_END = "\x03"
+
+CREATE_SEARCH_TABLE = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+    " body,"
+    " conversation_type UNINDEXED,"
+    " message_id UNINDEXED,"
+    " sender_id UNINDEXED,"
+    " target_id UNINDEXED,"
+    " tokenize = 'unicode61 remove_diacritics 2')"
+)
+
+
+def search_rowid(conversation_type, message_id):
+    return int(message_id) * 2 + (1 if conversation_type == "group" else 0)
+
+
+def search_available(bind):
+    return bind.dialect.name == "sqlite" and inspect(bind).has_table(SEARCH_TABLE)
+
+
+def searchable_body(message):
+    if message.deleted:
+        return ""
+    parts = [message.text or "", message.file_name or ""]
+    return " ".join(p for p in parts if p).strip()
+
+
+# -------- MANUTENÇÃO --------
+def unindex_message(session, conversation_type, message_id):
+    session.execute(
+        text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = :rowid"),
+        {"rowid": search_rowid(conversation_type, message_id)},
+    )
+
+
+def index_message(session, conversation_type, message):
+    """Insere/atualiza a mensagem no índice dentro da transação atual."""
+    unindex_message(session, conversation_type, message.id)
+
+    body = searchable_body(message)
+    if not body:
+        return
+
+    target_id = message.group_id if conversation_type == "group" else message.receiver_id
+    session.execute(
+        text(
+            f"INSERT INTO {SEARCH_TABLE}"
+            " (rowid, body, conversation_type, message_id, sender_id, target_id)"
+            " VALUES (:rowid, :body, :conversation_type, :message_id, :sender_id, :target_id)"
+        ),
+        {
+            "rowid": search_rowid(conversation_type, message.id),
+            "body": body,
+            "conversation_type": conversation_type,
+            "message_id": int(message.id),
+            "sender_id": int(message.sender_id),
+            "target_id": int(target_id),
+        },
+    )
+
+
+def rebuild_search_index(conn):
+    """Recria o índice inteiro a partir de messages e group_messages."""
+    conn.execute(text(CREATE_SEARCH_TABLE))
+    conn.execute(text(f"DELETE FROM {SEARCH_TABLE}"))
+
+    body = "trim(coalesce(text, '') || ' ' || coalesce(file_name, ''))"
+    conn.execute(
+        text(
+            f"INSERT INTO {SEARCH_TABLE}"
+            " (rowid, body, conversation_type, message_id, sender_id, target_id)"
+            f" SELECT id * 2, {body}, 'user', id, sender_id, receiver_id"
+            f" FROM messages WHERE deleted = 0 AND {body} != ''"
+        )
+    )
+    conn.execute(
+        text(
+            f"INSERT INTO {SEARCH_TABLE}"
+            " (rowid, body, conversation_type, message_id, sender_id, target_id)"
+            f" SELECT id * 2 + 1, {body}, 'group', id, sender_id, group_id"
+            f" FROM group_messages WHERE deleted = 0 AND {body} != ''"
+        )
+    )
+    conn.execute(text(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('optimize')"))
+
+
+# -------- CONSULTA --------
+def build_match_query(raw_query):
+    """
+    Converte o texto digitado numa expressão FTS5 segura: cada termo vira
+    uma frase entre aspas (sem operadores do usuário) e o último termo
+    casa por prefixo, para funcionar enquanto a pessoa digita.
+    """
+    terms = [t for t in (raw_query or "").split() if t.strip('"')]
+    if not terms:
+        return None
+
+    quoted = ['"' + t.replace('"', '""') + '"' for t in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def render_highlight(snippet):
+    escaped = html.escape(snippet or "")
+    return escaped.replace(HIGHLIGHT_START, "<mark>").replace(HIGHLIGHT_END, "</mark>")
+
+
+def search_messages(session, user_id, raw_query, cursor=None, limit=SEARCH_PAGE_SIZE):
+    """
+    Busca nas mensagens que `user_id` pode ver, ordenadas por relevância
+    (bm25) e paginadas por keyset em (rank arredondado, rowid). `cursor` é
+    o par devolvido em `next_cursor` pela página anterior.
+
+    O bm25 depende das estatísticas do índice inteiro: mensagens indexadas
+    entre uma página e outra mudam o rank de tudo, e a paginação pode então
+    pular ou repetir resultados. Dentro de um índice parado ela é estável.
+    """
+    match = build_match_query(raw_query)
+    if not match:
+        return [], None
+
+    params = {
+        "match": match,
+        "me": int(user_id),
+        "limit": int(limit) + 1,
+        "start": HIGHLIGHT_START,
+        "end": HIGHLIGHT_END,
+        "digits": SEARCH_RANK_DIGITS,
+    }
+
+    after_cursor = ""
+    if cursor is not None:
+        after_cursor = "AND (rank_key > :rank OR (rank_key = :rank AND rowid > :rowid))"
+        params["rank"] = round(float(cursor[0]), SEARCH_RANK_DIGITS)
+        params["rowid"] = int(cursor[1])
+
+    rows = session.execute(
+        text(
+            f"SELECT rowid, round(rank, :digits) AS rank_key, conversation_type, message_id,"
+            " sender_id, target_id,"
+            f" snippet({SEARCH_TABLE}, 0, :start, :end, '…', 16) AS snippet"
+            f" FROM {SEARCH_TABLE}"
+            f" WHERE {SEARCH_TABLE} MATCH :match"
+            " AND ("
+            "  (conversation_type = 'user' AND (sender_id = :me OR target_id = :me))"
+            "  OR (conversation_type = 'group' AND target_id IN"
+            "      (SELECT group_id FROM group_members WHERE user_id = :me))"
+            " )"
+            f" {after_cursor}"
+            " ORDER BY rank_key, rowid"
+            " LIMIT :limit"
+        ),
+        params,
+    ).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = [rows[-1].rank_key, rows[-1].rowid]
+
+    return rows, next_cursor
+
+
+# -------- BENCHMARK --------
+BENCH_COMMON_WORDS = (
+    "oi", "tudo", "bem", "reunião", "amanhã", "projeto", "café", "equipe",
+    "relatório", "prazo", "cliente", "entrega", "hoje", "obrigado", "foto",
+)
+
+BENCH_QUERIES = (
+    ("palavra comum", "projeto"),
+    ("dois termos", "relatório prazo"),
+    ("termo raro", "w00042"),
+    ("prefixo curto", "w0"),
+)
+
+
+def seed_search_benchmark(conn, rows, users=20, groups=200, batch_size=10000, seed=7):
+    """
+    Índice de busca sintético com `rows` mensagens (metade privadas, metade
+    de grupo) e group_members: o usuário u participa dos grupos g com
+    g % 10 == u % 10. Texto: palavras comuns + termos raros wNNNNN com
+    distribuição de cauda longa.
+    """
+    rng = random.Random(seed)
+    conn.execute(text(CREATE_SEARCH_TABLE))
+    conn.execute(
+        text(
+            "INSERT INTO group_members (group_id, user_id, role, joined_at)"
+            " VALUES (:g, :u, 'member', CURRENT_TIMESTAMP)"
+        ),
+        [{"g": g, "u": u} for g in range(1, groups + 1) for u in range(1, users + 1) if g % 10 == u % 10],
+    )
+
+    def body():
+        words = rng.choices(BENCH_COMMON_WORDS, k=rng.randint(2, 8))
+        words += [f"w{min(int(rng.paretovariate(0.6)), 99999):05d}" for _ in range(rng.randint(0, 3))]
+        rng.shuffle(words)
+        return " ".join(words)
+
+    insert = text(
+        f"INSERT INTO {SEARCH_TABLE}"
+        " (rowid, body, conversation_type, message_id, sender_id, target_id)"
+        " VALUES (:rowid, :body, :conversation_type, :message_id, :sender_id, :target_id)"
+    )
+    for start in range(1, rows + 1, batch_size):
+        batch = []
+        for message_id in range(start, min(start + batch_size, rows + 1)):
+            conversation_type = "group" if message_id % 2 else "user"
+            batch.append(
+                {
+                    "rowid": search_rowid(conversation_type, message_id),
+                    "body": body(),
+                    "conversation_type": conversation_type,
+                    "message_id": message_id,
+                    "sender_id": rng.randint(1, users),
+                    "target_id": rng.randint(1, groups if conversation_type == "group" else users),
+                }
+            )
+        conn.execute(insert, batch)
+    conn.execute(text(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('optimize')"))
+
+
+def benchmark_search(session, user_id=1, queries=BENCH_QUERIES, rounds=20, limit=SEARCH_PAGE_SIZE):
+    """{rótulo: (p50 ms, p95 ms, resultados na 1ª página)} de search_messages."""
+    results = {}
+    for label, raw_query in queries:
+        times = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            rows, _ = search_messages(session, user_id, raw_query, limit=limit)
+            times.append((time.perf_counter() - started) * 1000)
+        times.sort()
+        results[label] = (times[len(times) // 2], times[min(len(times) - 1, int(len(times) * 0.95))], len(rows))
+    return results
@@ -0,0 +1,86 @@
+import time
+from threading import Lock
+
+
+class TypingCoalescer:
+    """
+    Estado de "digitando" por (usuário, tipo de conversa, alvo).
+
+    O cliente manda `typing` a cada tecla e `stop_typing` a cada pausa
+    curta. Aqui só passa adiante o primeiro `typing` de uma sequência e
+    depois no máximo um a cada `interval` segundos (para quem abriu a
+    conversa no meio). O `stop_typing` não sai na hora: fica pendente por
+    `stop_grace` segundos e, se a pessoa voltar a digitar antes, nem o stop
+    nem o novo typing são repassados. Sem nenhum evento por `timeout`
+    segundos, o stop sai sozinho. Os stops pendentes/expirados são
+    entregues por `expired()`, chamado periodicamente.
+    """
+
+    def __init__(self, interval=5.0, timeout=6.0, stop_grace=1.5, clock=time.monotonic):
+        self.interval = interval
+        self.timeout = timeout
+        self.stop_grace = stop_grace
+        self.clock = clock
+
+        # chave -> [último typing repassado, prazo para o stop, stop pedido]
+        self._active = {}
+        self._lock = Lock()
+
+        self.counters = {
+            "typing_received": 0,
+            "typing_relayed": 0,
+            "typing_suppressed": 0,
+            "stop_received": 0,
+            "stop_suppressed": 0,
+            "stop_relayed": 0,
+            "stop_timed_out": 0,
+        }
+
+    def typing(self, key):
+        """Registra um `typing`; devolve True se deve ser repassado."""
+        now = self.clock()
+        with self._lock:
+            self.counters["typing_received"] += 1
+            state = self._active.get(key)
+
+            relay = state is None or now - state[0] >= self.interval
+            self._active[key] = [now if relay else state[0], now + self.timeout, False]
+
+            self.counters["typing_relayed" if relay else "typing_suppressed"] += 1
+            return relay
+
+    def stop(self, key):
+        """Registra um `stop_typing`; ele sai depois, por `expired()`."""
+        now = self.clock()
+        with self._lock:
+            self.counters["stop_received"] += 1
+            state = self._active.get(key)
+            if state is None or state[2]:
+                self.counters["stop_suppressed"] += 1
+                return
+            state[1] = min(state[1], now + self.stop_grace)
+            state[2] = True
+
+    def expired(self):
+        """Tira e devolve as chaves cujo stop_typing deve ser repassado agora."""
+        now = self.clock()
+        with self._lock:
+            keys = [key for key, state in self._active.items() if state[1] <= now]
+            for key in keys:
+                if not self._active.pop(key)[2]:
+                    self.counters["stop_timed_out"] += 1
+            self.counters["stop_relayed"] += len(keys)
+            return keys
+
+    def forget_user(self, user_id):
+        """Tira o usuário de todas as conversas (desconexão); devolve as chaves."""
+        with self._lock:
+            keys = [key for key in self._active if key[0] == user_id]
+            for key in keys:
+                del self._active[key]
+            self.counters["stop_relayed"] += len(keys)
+            return keys
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, active=len(self._active))
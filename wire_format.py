@@ -0,0 +1,201 @@
+import time
+
+from socketio import packet
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - depende do ambiente
+    msgpack = None
+
+
+# ========================== FORMATO COMPACTO ==========================
+#
+# O receive_message sai como um objeto JSON de ~17 chaves, repetindo campos
+# constantes (conversation_type, status, file_* nulos) para cada
+# destinatário. O cliente pode pedir no `join` um formato compacto:
+#
+#   compact   ["z", [evento, dados]] em JSON, com chaves curtas e sem os
+#             campos que têm o valor padrão
+#   msgpack   o mesmo [evento, dados] em MessagePack, num pacote binário
+#             do Socket.IO (precisa do pacote msgpack no servidor)
+#
+# O cliente desfaz com WIRE_KEYS/WIRE_DEFAULTS (repetidos em chat.html) e
+# entrega aos mesmos handlers. Quem não pede nada continua no JSON de sempre.
+
+WIRE_FORMATS = ("json", "compact", "msgpack")
+COMPACT_EVENTS = frozenset({"receive_message"})
+COMPACT_EVENT_NAME = "z"
+
+WIRE_KEYS = {
+    "id": "i",
+    "sender_id": "s",
+    "receiver_id": "r",
+    "text": "t",
+    "created_at": "c",
+    "seen": "n",
+    "status": "st",
+    "kind": "k",
+    "edited": "e",
+    "deleted": "d",
+    "file_url": "fu",
+    "file_name": "fn",
+    "file_mime": "fm",
+    "is_image": "ii",
+    "is_audio": "ia",
+    "conversation_type": "ct",
+    "target_id": "g",
+    "sender_name": "sn",
+    "group_name": "gn",
+    "seq": "q",
+}
+
+WIRE_DEFAULTS = {
+    "seen": False,
+    "status": "sent",
+    "kind": "text",
+    "edited": False,
+    "deleted": False,
+    "file_url": None,
+    "file_name": None,
+    "file_mime": None,
+    "is_image": False,
+    "is_audio": False,
+    "conversation_type": "user",
+}
+
+_MISSING = object()
+
+
+def negotiate_wire_format(requested):
+    """Formato que este servidor consegue mandar para o pedido do cliente."""
+    requested = (requested or "json").strip().lower()
+    if requested == "msgpack" and msgpack is None:
+        return "compact"
+    return requested if requested in WIRE_FORMATS else "json"
+
+
+def compact_payload(data):
+    compact = {}
+    for key, value in data.items():
+        if WIRE_DEFAULTS.get(key, _MISSING) == value:
+            continue
+        compact[WIRE_KEYS.get(key, key)] = value
+    return compact
+
+
+def expand_payload(compact):
+    """Inverso de compact_payload (o cliente faz o mesmo em JS)."""
+    long_keys = {short: key for key, short in WIRE_KEYS.items()}
+    data = dict(WIRE_DEFAULTS)
+    for key, value in compact.items():
+        data[long_keys.get(key, key)] = value
+    return data
+
+
+def wire_event(wire_format, event, data):
+    """(evento, argumentos) a emitir para um socket que usa `wire_format`."""
+    if wire_format == "json" or event not in COMPACT_EVENTS or not isinstance(data, dict):
+        return event, [data]
+
+    body = [event, compact_payload(data)]
+    if wire_format == "msgpack":
+        return COMPACT_EVENT_NAME, [msgpack.packb(body, use_bin_type=True)]
+    return COMPACT_EVENT_NAME, [body]
+
+
+def decode_compact(arg):
+    """Lê o argumento de um pacote "z" (JSON ou MessagePack) de volta para (evento, dados)."""
+    body = msgpack.unpackb(arg, raw=False) if isinstance(arg, (bytes, bytearray)) else arg
+    event, compact = body
+    return event, expand_payload(compact)
+
+
+# -------- BENCHMARK --------
+def encoded_size(event, args):
+    """Bytes que o pacote ocupa no WebSocket (texto + anexos binários)."""
+    pkt = packet.Packet(packet.EVENT, namespace="/", data=[event] + args)
+    encoded = pkt.encode()
+    if not isinstance(encoded, list):
+        encoded = [encoded]
+    # +1: prefixo do tipo de pacote do Engine.IO em cada frame de texto
+    return sum(len(p) if isinstance(p, bytes) else len(p.encode("utf-8")) + 1 for p in encoded)
+
+
+def benchmark_wire_formats(payloads, rounds=2000, event="receive_message"):
+    """
+    Para cada formato: bytes médios por mensagem no fio e µs de CPU para
+    montar e serializar o pacote (o que o servidor faz por emit).
+    """
+    results = {}
+    for wire_format in WIRE_FORMATS:
+        if wire_format == "msgpack" and msgpack is None:
+            continue
+
+        sizes = [encoded_size(*wire_event(wire_format, event, p)) for p in payloads]
+
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for p in payloads:
+                name, args = wire_event(wire_format, event, p)
+                packet.Packet(packet.EVENT, namespace="/", data=[name] + args).encode()
+        elapsed = time.perf_counter() - started
+
+        results[wire_format] = {
+            "bytes_per_message": sum(sizes) / len(sizes),
+            "us_per_message": elapsed / (rounds * len(payloads)) * 1e6,
+        }
+    return results
+
+
+def sample_message_payloads():
+    """Mensagens típicas (texto curto, longo, imagem, arquivo, grupo) para o benchmark."""
+    base = {
+        "id": 184233,
+        "sender_id": 42,
+        "receiver_id": 17,
+        "created_at": "2026-10-17T14:03:27.418529",
+        "seen": False,
+        "status": "sent",
+        "kind": "text",
+        "edited": False,
+        "deleted": False,
+        "file_url": None,
+        "file_name": None,
+        "file_mime": None,
+        "is_image": False,
+        "is_audio": False,
+        "conversation_type": "user",
+        "target_id": 17,
+        "sender_name": "Mariana",
+        "seq": 991204,
+    }
+    return [
+        dict(base, text="oi, tudo bem?"),
+        dict(base, text="Chego em 10 minutos, pode ir pedindo o café " * 3),
+        dict(
+            base,
+            text="",
+            kind="image",
+            file_url="/static/chat_uploads/3f9c1d2e4b5a6c7d8e9f0a1b2c3d4e5f.jpg",
+            file_name="foto.jpg",
+            file_mime="image/jpeg",
+            is_image=True,
+        ),
+        dict(
+            base,
+            text="",
+            kind="file",
+            file_url="/static/chat_uploads/0a1b2c3d4e5f60718293a4b5c6d7e8f9.pdf",
+            file_name="relatorio-trimestral.pdf",
+            file_mime="application/pdf",
+        ),
+        dict(
+            base,
+            text="reunião às 15h",
+            receiver_id=-8,
+            conversation_type="group",
+            target_id=8,
+            group_name="Equipe",
+        ),
+    ]
+
@@ -0,0 +1,144 @@
+import logging
+import queue
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBatcher:
+    """
+    Group commit para o envio de mensagens.
+
+    Cada job grava suas linhas na sessão (sem commit) e devolve uma função
+    que faz os emits. Uma única tarefa de fundo junta os jobs que chegam em
+    até `window_ms` (ou `max_batch` jobs), faz um commit só para todos e
+    depois chama os emits na ordem de chegada, então a ordem por conversa
+    é a mesma do modo sem lote. Se o commit do lote falhar, os jobs são
+    refeitos um a um para que uma linha ruim não derrube as outras.
+    """
+
+    def __init__(self, app, db, window_ms=5, max_batch=200, start_task=None):
+        self.app = app
+        self.db = db
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.start_task = start_task
+        self.queue = queue.Queue()
+
+        self.stats = {"batches": 0, "jobs": 0, "failed": 0}
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def submit(self, job):
+        self._ensure_started()
+        self.queue.put(job)
+
+    def _ensure_started(self):
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            if self.start_task:
+                self.start_task(self._run)
+            else:
+                threading.Thread(target=self._run, daemon=True).start()
+            self._started = True
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self.flush(batch)
+            except Exception:
+                logger.exception("Falha ao gravar lote de %d mensagens", len(batch))
+
+    def flush(self, batch):
+        with self.app.app_context():
+            try:
+                announcements = [job() for job in batch]
+                self.db.session.commit()
+            except Exception:
+                self.db.session.rollback()
+                announcements = self._flush_one_by_one(batch)
+
+            self.stats["batches"] += 1
+            self.stats["jobs"] += len(announcements)
+
+            for announce in announcements:
+                try:
+                    announce()
+                except Exception:
+                    logger.exception("Falha ao emitir mensagem gravada em lote")
+
+    def _flush_one_by_one(self, batch):
+        announcements = []
+        for job in batch:
+            try:
+                announce = job()
+                self.db.session.commit()
+                announcements.append(announce)
+            except Exception:
+                self.db.session.rollback()
+                self.stats["failed"] += 1
+                logger.exception("Mensagem descartada ao gravar lote")
+        return announcements
+
+
+# -------- BENCHMARK --------
+def benchmark_write_batching(app, db, make_job, senders=8, messages=300, window_ms=5, max_batch=200):
+    """
+    msg/s com `senders` threads mandando `messages` jobs cada, primeiro com
+    commit por job (o caminho sem MESSAGE_BATCH_WRITES) e depois pelo
+    WriteBatcher. `make_job(sender, i)` devolve o job da i-ésima mensagem.
+    """
+    total = senders * messages
+
+    def direct(sender):
+        with app.app_context():
+            for i in range(messages):
+                announce = make_job(sender, i)()
+                db.session.commit()
+                announce()
+            db.session.remove()
+
+    batcher = WriteBatcher(app, db, window_ms=window_ms, max_batch=max_batch)
+
+    def batched(sender):
+        for i in range(messages):
+            batcher.submit(make_job(sender, i))
+
+    def run(send, done):
+        started = time.perf_counter()
+        threads = [threading.Thread(target=send, args=(s,)) for s in range(senders)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        while not done():
+            time.sleep(0.001)
+        return total / (time.perf_counter() - started)
+
+    return {
+        "direct": run(direct, lambda: True),
+        "batched": run(batched, lambda: batcher.stats["jobs"] + batcher.stats["failed"] >= total),
+        "commits": batcher.stats["batches"],
+        "failed": batcher.stats["failed"],
+    }
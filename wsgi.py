@@ -0,0 +1,39 @@
+"""
+Ponto de entrada de produção.
+
+    gunicorn -k gevent -w 1 -b 0.0.0.0:$PORT wsgi:app
+
+Sem SOCKETIO_ASYNC_MODE definido, este módulo usa gevent: o gunicorn atual
+não tem mais o worker eventlet. Para eventlet, rode
+`SOCKETIO_ASYNC_MODE=eventlet python wsgi.py` (servidor WSGI do eventlet).
+
+Cada worker cooperativo atende milhares de sockets numa thread só. Para
+mais de um worker (ou host), use SOCKETIO_MESSAGE_QUEUE e PRESENCE_STORE_URL
+apontando para o mesmo Redis e sticky sessions no balanceador (o long-polling
+do Socket.IO precisa voltar sempre ao mesmo worker).
+"""
+import os
+
+os.environ.setdefault("SOCKETIO_ASYNC_MODE", "gevent")
+
+import async_runtime  # noqa: E402
+
+async_runtime.monkey_patch()
+
+from app import app, socketio  # noqa: E402
+
+
+def create_app():
+    """Para `gunicorn 'wsgi:create_app()'`: devolve o app já configurado."""
+    return app
+
+
+__all__ = ["app", "create_app", "socketio"]
+
+
+if __name__ == "__main__":
+    socketio.run(
+        app,
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", "5000")),
+    )